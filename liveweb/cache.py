@@ -2,6 +2,7 @@
 """
 
 from collections import namedtuple
+import json
 import logging
 import sqlite3
 
@@ -9,6 +10,12 @@ import redis
 
 from .proxy import Record
 
+def load_json(data):
+    """Returns the dict saved as JSON in data, with its unicode values encoded as utf-8.
+    """
+    return dict((k, isinstance(v, unicode) and v.encode("utf-8") or v)
+                for k, v in json.loads(data).items())
+
 class RedisCache:
     """Cache based on Redis.
 
@@ -21,8 +28,10 @@ class RedisCache:
         :param port: port to connect, defaults to 6379, the default redis server port
         :param db: db number, defaults to 0
         :param expire_time: amount of time in seconds after which the entry in the cache should expire, defaults to one hour.
+        :param validators_expire_time: amount of time in seconds for which the validators of a capture are kept, defaults to one day.
         """
         self.expire_time = int(params.pop('expire_time', 3600)) # default timeout
+        self.validators_expire_time = int(params.pop('validators_expire_time', 24*3600))
 
         # max size of record that can be cached. Defaults to 100K.
         self.max_record_size = params.pop('max_record_size', 100*1024)
@@ -48,6 +57,60 @@ class RedisCache:
             data = record.read_all()
             self.redis_client.setex(url, self.expire_time, data)
 
+    def get_validators(self, url):
+        """Returns the validators of the last capture of the url, None if not available.
+
+        The validators are a dict with etag and/or last_modified from
+        the response headers, and filename, offset and content_length
+        of the record.
+        """
+        data = self.redis_client.get("validators:" + url)
+        if data is not None:
+            return load_json(data)
+
+    def set_validators(self, url, validators):
+        """Saves the validators of the last capture of the url.
+
+        They are kept longer than the cached record, so that the url
+        can be revalidated after the cache entry expires.
+        """
+        self.redis_client.setex("validators:" + url, self.validators_expire_time, json.dumps(validators))
+
+    def acquire_fetch_lock(self, url, timeout):
+        """Marks the url as being fetched by this worker.
+
+        Returns False if some other worker is already fetching it. The
+        lock expires after timeout seconds, in case the worker holding
+        it dies.
+        """
+        # The lock and its expiry are set at once, so that the lock
+        # is not left behind if the worker dies in between.
+        if self.redis_client.set("fetching:" + url, 1, nx=True, ex=max(int(timeout), 1)):
+            # where the previous fetch left its record is stale now
+            self.redis_client.delete("fetched:" + url)
+            return True
+        return False
+
+    def release_fetch_lock(self, url):
+        self.redis_client.delete("fetching:" + url)
+
+    def set_fetched(self, url, record, timeout):
+        """Tells the workers waiting for the url where the record
+        fetched by this worker is, for records too big to be cached.
+        The entry expires after timeout seconds.
+        """
+        data = dict(filename=record.filename, offset=record.offset, content_length=record.content_length)
+        self.redis_client.setex("fetched:" + url, max(int(timeout), 1), json.dumps(data))
+
+    def get_fetched(self, url):
+        """Returns the dict with filename, offset and content_length of
+        the record last fetched by a worker holding the fetch lock,
+        None if not available.
+        """
+        data = self.redis_client.get("fetched:" + url)
+        if data is not None:
+            return load_json(data)
+
     def next(self):
         """Returns the next-value of the counter.
         Used by file_pool to get next sequence.
@@ -103,10 +166,21 @@ class SqliteCache:
             logging.info("cache miss - %s", url)
 
     def set(self, url, record):
+        # only the location of the record is stored, records not
+        # written to any file, like those of revisits, can't be cached
+        if record.filename is None:
+            return
         self.query("INSERT INTO cache (url, filename, offset, clen) VALUES (?, ?, ?, ?)", 
                    [url, record.filename, record.offset, record.content_length],
                    commit=True)
 
+    def get_validators(self, url):
+        # entries never expire, so there is nothing to revalidate
+        return None
+
+    def set_validators(self, url, validators):
+        pass
+
 class NoCache:
     def get(self, url):
         return None
@@ -114,6 +188,12 @@ class NoCache:
     def set(self, url, record):
         pass
 
+    def get_validators(self, url):
+        return None
+
+    def set_validators(self, url, validators):
+        pass
+
 def create(type, config):
     logging.info("creating cache %s", type)
 
@@ -122,7 +202,8 @@ def create(type, config):
                           port=config.redis_port, 
                           db=config.redis_db, 
                           expire_time=config.redis_expire_time, 
-                          max_record_size=config.redis_max_record_size)
+                          max_record_size=config.redis_max_record_size,
+                          validators_expire_time=config.redis_validators_expire_time)
     elif type == 'sqlite':
         return SqliteCache(config.sqlite_db)
     elif type == 'none' or type == None:
@@ -0,0 +1,101 @@
+"""CDX index of the records written to the ARC/WARC files.
+
+Each file of the pool gets a sidecar ``.cdx`` file, with a line for
+each record appended to it. The lines are sorted when the file is
+complete, so that the records can be looked up using a binary search
+on the URL key instead of scanning the whole file.
+
+The lines are in the usual 11 field CDX format::
+
+    urlkey timestamp url mimetype status digest redirect meta length offset filename
+"""
+
+import os
+import re
+import urlparse
+
+CDX_HEADER = " CDX N b a m s k r M S V g\n"
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+def surt(url):
+    """Returns the SURT form of the URL, used as the key of the CDX lines.
+
+    The host is lowercased, the leading www is dropped and its parts
+    are reversed, so that the URLs of a domain sort together. The
+    query parameters are sorted.
+
+        >>> surt("http://www.Example.com/Index.html?b=1&a=2")
+        'com,example)/index.html?a=2&b=1'
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    host = netloc.lower().rsplit("@", 1)[-1]
+    host, _, port = host.partition(":")
+    host = re.sub(r"^www\d*\.", "", host.strip("."))
+
+    key = ",".join(reversed(host.split(".")))
+    if port and port != DEFAULT_PORTS.get(scheme):
+        key += ":" + port
+    key += ")" + (path or "/")
+    if query:
+        key += "?" + "&".join(sorted(query.split("&")))
+    return key.lower()
+
+def make_entry(url, date, mimetype, status, digest, length):
+    """Returns the fields of the CDX line of a record, except the offset and the filename.
+
+    Those are known only when the record is appended to a file, and
+    are added by `format_line`.
+
+    :param date: capture time as datetime
+    :param digest: base32 SHA-1 of the payload or None
+    :param length: compressed length of the record
+    """
+    # the fields are separated by spaces
+    url = re.sub(r"\s", lambda m: "%%%02X" % ord(m.group()), url)
+    return [surt(url),
+            date.strftime("%Y%m%d%H%M%S"),
+            url,
+            clean(mimetype),
+            str(status),
+            digest or "-",
+            "-",
+            "-",
+            str(length)]
+
+def clean(value):
+    """Makes the value fit in a single field of the CDX line.
+    """
+    value = re.sub(r"\s+", "", value or "")
+    return value or "-"
+
+def format_line(entry, offset, filename):
+    """Returns the CDX line of the record with the given entry, at the given offset of the file.
+    """
+    return " ".join(entry + [str(offset), os.path.basename(filename)]) + "\n"
+
+def record_end(line):
+    """Returns the offset of the end of the record of the CDX line.
+    """
+    fields = line.split()
+    return int(fields[-2]) + int(fields[-3])
+
+def sort_file(src, dest, end=None):
+    """Writes the lines of the CDX file src to dest, sorted.
+
+    The lines are sorted bytewise, the same way as ``LC_ALL=C sort``.
+    dest is written to a temp file first and renamed, so that it is
+    never seen half written. When end is given, the lines of the
+    records not ending before that offset are left out.
+    """
+    with open(src) as f:
+        lines = [line for line in f if line != CDX_HEADER and line.endswith("\n")]
+    if end is not None:
+        lines = [line for line in lines if record_end(line) <= end]
+    lines.sort()
+
+    tmp = dest + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(CDX_HEADER)
+        f.writelines(lines)
+    os.rename(tmp, dest)
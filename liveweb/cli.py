@@ -22,6 +22,11 @@ def make_config():
                  default="false",
                  help="enables the http-passthrough mode")
 
+    c.add_option("--streaming",
+                 type="bool",
+                 default="false",
+                 help="in http-passthrough mode, sends the response to the client while it is being archived")
+
     c.add_option("--user-agent", 
                  default="ia_archiver(OS-Wayback)",
                  help="the user-agent string used by liveweb-proxy")
@@ -53,6 +58,16 @@ def make_config():
                  default="10",
                  help="the number of threads/process (default: %default)")
 
+    c.add_option("--max-batch-size",
+                 type="int",
+                 default="100",
+                 help="the maximum number of URLs in a batch request (default: %default)")
+
+    c.add_option("--batch-concurrency",
+                 type="int",
+                 default="10",
+                 help="the number of URLs of a batch request fetched in parallel (default: %default)")
+
     # storage options
     c.add_option("-o", "--output-directory", 
                  metavar="DIR", 
@@ -74,6 +89,50 @@ def make_config():
                  default="100MB",
                  help="specifies the recommended size limit for each file.")
 
+    c.add_option("--max-file-age",
+                 type="time",
+                 default="0",
+                 help="the maximum age of a file before it is moved to complete/, 0 for no limit (default: %default)")
+
+    c.add_option("--completion-command",
+                 help="the command to run with the path of each file moved to complete/")
+
+    c.add_option("--recovery-threads",
+                 type="int",
+                 default="4",
+                 help="the number of files left in partial/ by a crash recovered at a time on startup, 0 to not recover them (default: %default)")
+
+    c.add_option("--cdx",
+                 type="bool",
+                 default="true",
+                 help="writes a CDX index of the records of each file, next to the file (default: %default)")
+
+    c.add_option("--preallocate",
+                 type="bool",
+                 default="false",
+                 help="preallocates disk space for filesize-limit bytes when a file is created")
+
+    c.add_option("--file-shards",
+                 type="int",
+                 default="0",
+                 help="the number of files of each worker process, each thread writing to a file of its own; 0 to share the num-writers files among the threads (default: %default)")
+
+    c.add_option("--durability",
+                 type="choice",
+                 choices=["none", "on-rotate", "periodic", "group"],
+                 default="none",
+                 help="when the records are written to the disk using fsync (default: %default)")
+
+    c.add_option("--sync-interval",
+                 type="time",
+                 default="1s",
+                 help="the time between the syncs when durability is periodic (default: %default)")
+
+    c.add_option("--compression-level",
+                 type="int",
+                 default="9",
+                 help="the gzip compression level of the records, from 1 (fastest) to 9 (smallest) (default: %default)")
+
     # timeouts and limits
 
     c.add_option("--default-timeout", 
@@ -85,10 +144,35 @@ def make_config():
                  type="time",
                  help="maximum allowed time for domain name resolution")
 
+    c.add_option("--resolver",
+                 type="choice",
+                 choices=["system", "stub"],
+                 default="system",
+                 help="specifies how hostnames are resolved (default: %default)")
+
+    c.add_option("--nameservers",
+                 type="string",
+                 help="comma separated list of nameservers used by the stub resolver (default: from /etc/resolv.conf)")
+
+    c.add_option("--dns-cache-ttl",
+                 type="time",
+                 default="5m",
+                 help="the time for which resolved hostnames are cached, 0 disables the cache (default: %default)")
+
+    c.add_option("--dns-negative-ttl",
+                 type="time",
+                 default="30s",
+                 help="the time for which failed hostname resolutions are cached (default: %default)")
+
     c.add_option("--connect-timeout", 
                  type="time",
                  help="maximum allowed time for establishing connection")
 
+    c.add_option("--connect-attempt-delay",
+                 type="time",
+                 default="0.25s",
+                 help="the time after which a connection to the next address of the host is attempted in parallel (default: %default)")
+
     c.add_option("--initial-data-timeout",
                  type="time",
                  help="maximum wait time to receive status and headers from the remove server")
@@ -107,6 +191,38 @@ def make_config():
                  default="100MB",
                  help="the maximum allowed size of response")
 
+    # connection options
+    c.add_option("--fetch-engine",
+                 type="choice",
+                 choices=["threaded", "async"],
+                 default="threaded",
+                 help="specifies how the URLs are fetched (default: %default)")
+
+    c.add_option("--max-idle-connections",
+                 type="int",
+                 default="4",
+                 help="the maximum number of idle keep-alive connections kept per host, 0 disables connection reuse (default: %default)")
+
+    c.add_option("--max-total-idle-connections",
+                 type="int",
+                 default="1000",
+                 help="the maximum number of idle keep-alive connections kept for all the hosts together (default: %default)")
+
+    c.add_option("--idle-connection-timeout",
+                 type="time",
+                 default="30s",
+                 help="the time after which an idle keep-alive connection is closed (default: %default)")
+
+    c.add_option("--max-host-connections",
+                 type="int",
+                 default="0",
+                 help="the maximum number of concurrent fetches from a host, 0 means no limit (default: %default)")
+
+    c.add_option("--host-queue-timeout",
+                 type="time",
+                 default="10s",
+                 help="the maximum time a request waits for the fetches from the same host to finish (default: %default)")
+
     # cache options
     c.add_option("--cache", 
                  type="choice", 
@@ -134,6 +250,62 @@ def make_config():
                  type="bytes", 
                  default="100KB")
 
+    c.add_option("--redis-coalesce",
+                 type="bool",
+                 default="false",
+                 help="fetch a URL requested concurrently from many workers only once")
+
+    c.add_option("--redis-revalidate",
+                 type="bool",
+                 default="false",
+                 help="revalidate expired captures using ETag/Last-Modified instead of fetching them again")
+
+    c.add_option("--redis-validators-expire-time",
+                 type="time",
+                 default="24h",
+                 help="the time for which the validators of a capture are kept (default: %default)")
+
+    c.add_option("--prefetch",
+                 type="bool",
+                 default="false",
+                 help="fetch the images, stylesheets and scripts of the captured pages into the cache")
+
+    c.add_option("--prefetch-budget",
+                 type="int",
+                 default="20",
+                 help="the maximum number of resources prefetched for a page (default: %default)")
+
+    c.add_option("--prefetch-queue-size",
+                 type="int",
+                 default="1000",
+                 help="the maximum number of pages and resources waiting to be prefetched (default: %default)")
+
+    c.add_option("--prefetch-threads",
+                 type="int",
+                 default="2",
+                 help="the number of threads/process used for prefetching (default: %default)")
+
+    c.add_option("--dedup",
+                 type="choice",
+                 choices=["none", "redis", "sqlite"],
+                 default="none",
+                 help="the index of payload digests used to write duplicate payloads as revisit records, warc only (default: %default)")
+
+    c.add_option("--dedup-expire-time",
+                 type="time",
+                 default="168h",
+                 help="the time for which the payload digest of a capture is kept (default: %default)")
+
+    c.add_option("--dedup-min-size",
+                 type="bytes",
+                 default="1KB",
+                 help="payloads smaller than this are always written in full (default: %default)")
+
+    c.add_option("--dedup-db",
+                 type="string",
+                 default="dedup.db",
+                 help="the sqlite database of payload digests when dedup is sqlite (default: %default)")
+
     c.add_option("--sqlite-db",
                  type="string",
                  default="liveweb.db")
@@ -0,0 +1,136 @@
+"""
+Connection pool implementation
+"""
+
+import threading
+import time
+import logging
+
+class ConnectionPool(object):
+    """
+    Implements a pool of idle persistent HTTP connections.
+
+    Connections are keyed by (scheme, host, port). A connection is put
+    back into the pool only after its response has been read
+    completely and the server has not asked to close the connection.
+
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30, max_idle=1000):
+        """
+        Creates a pool that keeps at most max_per_host idle
+        connections for each (scheme, host, port) and at most
+        max_idle idle connections in all. Connections that are idle
+        for more than idle_timeout seconds are closed by a background
+        sweeper thread, even for hosts that are never fetched again.
+
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+
+        # key -> list of (connection, time when it was returned)
+        self._idle = {}
+        # number of idle connections in the pool
+        self._count = 0
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def get(self, key):
+        """Returns an idle connection for the given key or None if
+        there is no idle connection available.
+        """
+        with self._lock:
+            self._evict(key)
+            entries = self._idle.get(key)
+            if entries:
+                # The most recently used connection is the least
+                # likely to be closed by the server.
+                conn, _ = entries.pop()
+                self._count -= 1
+                logging.debug("reusing connection to %s", key)
+                return conn
+
+    def put(self, key, conn):
+        """Returns a connection to the pool.
+
+        The connection is closed if the pool already has max_per_host
+        idle connections for the key. When the pool has max_idle idle
+        connections, the one idle for the longest time is closed to
+        make room for it.
+        """
+        self._start_sweeper()
+        with self._lock:
+            self._evict(key)
+            entries = self._idle.setdefault(key, [])
+            if len(entries) < self.max_per_host:
+                if self._count >= self.max_idle:
+                    self._evict_oldest()
+                entries.append((conn, time.time()))
+                self._count += 1
+                return
+        conn.close()
+
+    def _evict_oldest(self):
+        """Closes the connection that has been idle for the longest time.
+
+        Must be called with the lock held.
+        """
+        # the oldest connection of each key is the first one
+        key = min((entries[0][1], key) for key, entries in self._idle.items() if entries)[1]
+        conn, _ = self._idle[key].pop(0)
+        self._count -= 1
+        if not self._idle[key]:
+            del self._idle[key]
+        conn.close()
+
+    def _evict(self, key):
+        """Closes the connections of key that have been idle for too long.
+
+        Must be called with the lock held.
+        """
+        entries = self._idle.get(key)
+        if not entries:
+            return
+
+        now = time.time()
+        fresh = [(conn, t) for conn, t in entries if now - t <= self.idle_timeout]
+        for conn, t in entries:
+            if now - t > self.idle_timeout:
+                conn.close()
+        self._count -= len(entries) - len(fresh)
+
+        if fresh:
+            self._idle[key] = fresh
+        else:
+            del self._idle[key]
+
+    def evict_idle(self):
+        """Closes all connections that have been idle for too long.
+        """
+        with self._lock:
+            for key in self._idle.keys():
+                self._evict(key)
+
+    def _start_sweeper(self):
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="connection-pool-sweeper")
+                self._sweeper.daemon = True
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        # the connections are closed at most half of idle_timeout late
+        while True:
+            time.sleep(max(self.idle_timeout / 2.0, 0.01))
+            self.evict_idle()
+
+    def close(self):
+        """Closes all idle connections and empties the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            self._count = 0
+
+        for entries in idle.values():
+            for conn, _ in entries:
+                conn.close()
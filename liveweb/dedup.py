@@ -0,0 +1,119 @@
+"""Index of payload digests for writing duplicate payloads as revisit records.
+
+The index maps the WARC-Payload-Digest of the captured responses to
+the WARC record that has the payload. When a payload is captured
+again, only a small revisit record referring to that record is
+written.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import redis
+
+from .cache import load_json
+
+class DigestIndex:
+    """Base class of the digest indexes, keeps the count of revisit records and the bytes saved.
+
+    A capture is a dict with url, date, record_id, filename, offset
+    and content_length of the WARC record having the payload.
+    """
+    def __init__(self):
+        self.revisits = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def revisited(self, nbytes):
+        """Called after writing a revisit record instead of a record of nbytes bytes.
+        """
+        with self._lock:
+            self.revisits += 1
+            self.bytes_saved += nbytes
+            revisits = self.revisits
+
+        if revisits % 1000 == 0:
+            logging.info("dedup stats: %s", self.stats())
+
+    def stats(self):
+        """Returns the number of revisit records written and the number of bytes saved.
+        """
+        return dict(revisits=self.revisits, bytes_saved=self.bytes_saved)
+
+class RedisDigestIndex(DigestIndex):
+    """Digest index in Redis. The entries expire after expire_time seconds.
+    """
+    def __init__(self, expire_time=7*24*3600, **params):
+        DigestIndex.__init__(self)
+        self.expire_time = int(expire_time)
+        self.redis_client = redis.StrictRedis(**params)
+
+    def get(self, digest):
+        """Returns the capture with the given payload digest or None.
+        """
+        data = self.redis_client.get("digest:" + digest)
+        if data is not None:
+            return load_json(data)
+
+    def set(self, digest, capture):
+        self.redis_client.setex("digest:" + digest, self.expire_time, json.dumps(capture))
+
+class SqliteDigestIndex(DigestIndex):
+    """Digest index in a sqlite database. The entries older than expire_time seconds are ignored.
+    """
+    SCHEMA = ("" +
+              "CREATE TABLE IF NOT EXISTS digests (" +
+              "    digest text primary key," +
+              "    capture text," +
+              "    timestamp int" +
+              ")")
+
+    def __init__(self, database, expire_time=7*24*3600):
+        DigestIndex.__init__(self)
+        self.database = database
+        self.expire_time = int(expire_time)
+        self.query(self.SCHEMA, commit=True)
+
+    def query(self, query, args=[], commit=False):
+        logging.debug("query: %r - %r", query, args)
+        conn = sqlite3.connect(self.database)
+        cursor = conn.execute(query, args)
+        rows = cursor.fetchall()
+        if commit:
+            conn.commit()
+        cursor.close()
+        conn.close()
+        return rows
+
+    def get(self, digest):
+        """Returns the capture with the given payload digest or None.
+        """
+        rows = self.query("SELECT capture FROM digests WHERE digest=? AND timestamp>?",
+                          [digest, int(time.time()) - self.expire_time])
+        if rows:
+            return load_json(rows[0][0])
+
+    def set(self, digest, capture):
+        self.query("INSERT OR REPLACE INTO digests (digest, capture, timestamp) VALUES (?, ?, ?)",
+                   [digest, json.dumps(capture), int(time.time())],
+                   commit=True)
+
+def create(type, config):
+    """Creates the digest index of the given type, None when type is "none".
+    """
+    logging.info("creating digest index %s", type)
+
+    if type == 'redis':
+        return RedisDigestIndex(host=config.redis_host,
+                                port=config.redis_port,
+                                db=config.redis_db,
+                                expire_time=config.dedup_expire_time)
+    elif type == 'sqlite':
+        return SqliteDigestIndex(config.dedup_db, expire_time=config.dedup_expire_time)
+    elif type == 'none' or type == None:
+        return None
+    else:
+        raise ValueError("Unknown digest index type %r" % type)
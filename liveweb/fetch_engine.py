@@ -0,0 +1,307 @@
+"""Event-loop based engine to fetch many URLs concurrently from a single thread.
+
+The threaded fetch path blocks one thread per capture for the whole
+duration of the request. The FetchEngine drives connect, sending the
+request and reading the response of all the in-flight captures from a
+single event-loop thread. The captured bytes are parsed with
+ProxyHTTPResponse, so the resulting responses are written to ARC
+files exactly like the ones fetched using the threaded path.
+
+`FetchEngine.fetch` waits for the fetch in the calling thread. Callers
+capturing many URLs at once use `FetchEngine.submit` with an on_done
+callback instead, so that no thread waits for each of them.
+"""
+
+import asyncore
+import errno
+import logging
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+
+from . import config
+from . import filetools
+from . import proxy
+
+# marks the end of HTTP headers, with and without the CR
+_HEADER_TERMINATORS = ["\n\r\n", "\n\n"]
+
+# how long wait waits beyond max_request_time for the event-loop to end the fetch
+WAIT_MARGIN = 10
+
+class _Waker(asyncore.file_dispatcher):
+    """Wakes up the event-loop when a new fetch is submitted.
+    """
+    def __init__(self, map):
+        self._rfd, self._wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._rfd, map=map)
+
+    def wake(self):
+        os.write(self._wfd, "x")
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(1024)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._wfd)
+
+class Fetch(asyncore.dispatcher):
+    """A single HTTP fetch driven by the FetchEngine.
+
+    Call the wait method to get the ProxyHTTPResponse once the fetch
+    is complete. When on_done is given, it is called with the fetch by
+    the event-loop thread once the fetch is complete, so that nothing
+    has to block in wait. It must return quickly.
+    """
+    def __init__(self, url, addrinfo, request_data, on_done=None):
+        self.url = url
+        self.on_done = on_done
+        self.addrinfo = addrinfo
+        self.request_data = request_data
+        # request_data is consumed as it is sent
+        self.request = request_data
+
+        # the response is spooled to a temp file once it is big
+        self.buf = filetools.MemFile()
+        self.bytes_read = 0
+        self.remoteip = None
+        self.error = None
+        self.phase = "connect"
+        self._tail = ""
+
+        self._done = threading.Event()
+
+    def start(self, map):
+        """Starts the fetch. Called from the event-loop thread.
+        """
+        asyncore.dispatcher.__init__(self, map=map)
+
+        self.start_time = time.time()
+        self._connect_next()
+
+    def _connect_next(self):
+        """Tries to connect to the next resolved address.
+
+        Each address gets the whole connect timeout, so that an
+        address that doesn't respond doesn't use up the time of the
+        next ones.
+        """
+        family, socktype, proto, _, sockaddr = self.addrinfo.pop(0)
+        self.remoteip = sockaddr[0]
+        self.deadline = time.time() + config.get_connect_timeout()
+        try:
+            # creating the socket fails too when the process is out of fds
+            self.create_socket(family, socktype)
+            self.connect(sockaddr)
+        except socket.error, e:
+            self._connect_failed(e)
+
+    def _connect_failed(self, e):
+        if self.socket is not None:
+            self.del_channel()
+            self.socket.close()
+            self.socket = None
+        if self.addrinfo:
+            self._connect_next()
+        elif e.errno == errno.ECONNREFUSED:
+            self.fail(proxy.ERR_CONN_REFUSED, e)
+        else:
+            self.fail(proxy.ERR_CONN_MISC, e)
+
+    def readable(self):
+        return self.phase in ("headers", "body")
+
+    def writable(self):
+        return self.phase in ("connect", "request")
+
+    def handle_connect(self):
+        self.phase = "request"
+
+    def handle_write(self):
+        sent = self.send(self.request_data)
+        self.request_data = self.request_data[sent:]
+        if not self.request_data:
+            self.phase = "headers"
+            self.last_read = time.time()
+            self.deadline = self.last_read + config.get_initial_data_timeout()
+
+    def handle_read(self):
+        data = self.recv(64 * 1024)
+        if not data:
+            return
+
+        self.buf.write(data)
+        self.bytes_read += len(data)
+        self.last_read = time.time()
+
+        if config.max_response_size is not None and self.bytes_read > config.max_response_size:
+            self.fail(proxy.ERR_RESPONSE_TOO_BIG, data={"max_size": config.max_response_size})
+        elif self.phase == "headers":
+            s = self._tail + data
+            if any(t in s for t in _HEADER_TERMINATORS):
+                self.phase = "body"
+            self._tail = s[-3:]
+
+    def handle_close(self):
+        self.finish()
+
+    def handle_error(self):
+        _, e, _ = sys.exc_info()
+        if self.phase == "connect" and isinstance(e, socket.error):
+            self._connect_failed(e)
+        else:
+            logging.error("error while fetching %s", self.url, exc_info=True)
+            self.fail(proxy.ERR_CONN_MISC, e)
+
+    def check_timeouts(self, now):
+        """Fails the fetch if any of the timeouts or limits has been crossed.
+        """
+        if config.max_request_time is not None and now - self.start_time > config.max_request_time:
+            self.fail(proxy.ERR_REQUEST_TIMEOUT, data={"max_time": config.max_request_time})
+        elif self.phase == "connect" and now > self.deadline and self.addrinfo:
+            self._connect_failed(socket.timeout("timed out"))
+        elif self.phase in ("connect", "request") and now > self.deadline:
+            self.fail(proxy.ERR_CONN_TIMEOUT, socket.timeout("timed out"),
+                      data={"conn_timeout": config.get_connect_timeout()})
+        elif self.phase == "headers" and now > self.deadline:
+            self.fail(proxy.ERR_INITIAL_DATA_TIMEOUT, socket.timeout("timed out"),
+                      data={"initial_data_timeout": config.get_initial_data_timeout()})
+        elif self.phase == "body" and now - self.last_read > config.get_read_timeout():
+            self.fail(proxy.ERR_READ_TIMEOUT, socket.timeout("timed out"),
+                      data={"read_timeout": config.get_read_timeout()})
+
+    def fail(self, error, cause=None, data=None):
+        self.error = proxy.ProxyError(error, cause, data)
+        self.finish()
+
+    def finish(self):
+        if self._done.is_set():
+            return
+        self.phase = "done"
+        if self.socket is not None:
+            self.close()
+        self._done.set()
+        if self.on_done:
+            try:
+                self.on_done(self)
+            except Exception:
+                logging.error("error in on_done of %s", self.url, exc_info=True)
+
+    def wait(self, timeout=None):
+        """Waits for the fetch to complete and returns the response.
+
+        Raises ProxyError if the fetch has failed. The event-loop ends
+        the fetch after max_request_time, waiting is given up a little
+        later in case the event-loop is stuck, or after timeout seconds
+        when given.
+        """
+        if timeout is None and config.max_request_time is not None:
+            timeout = config.max_request_time + WAIT_MARGIN
+        if not self._done.wait(timeout):
+            raise proxy.ProxyError(proxy.ERR_REQUEST_TIMEOUT, data={"max_time": config.max_request_time})
+        if self.error:
+            self.buf.close()
+            raise self.error
+
+        # Parsing is done here, in the thread waiting for the
+        # response, to keep the event-loop thread free.
+        self.buf.seek(0)
+        sock = proxy._FakeSocket(self.buf)
+        response = proxy.ProxyHTTPResponse(self.url, sock, method="GET")
+        response.remoteip = self.remoteip
+        response.request_data = self.request
+        response.begin()
+        return response
+
+class FetchEngine:
+    """Fetches URLs using non-blocking sockets driven by a single event-loop thread.
+    """
+    def __init__(self, poll_interval=0.1):
+        self.poll_interval = poll_interval
+
+        self.map = {}
+        self._pending = Queue.Queue()
+        self._waker = _Waker(self.map)
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name="fetch-engine")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the event-loop thread. In-flight fetches are abandoned.
+        """
+        self._running = False
+        self._waker.wake()
+        self._thread.join()
+        self._waker.close()
+
+    def run(self):
+        while self._running:
+            try:
+                self._start_pending()
+                asyncore.loop(timeout=self.poll_interval, use_poll=True, map=self.map, count=1)
+
+                now = time.time()
+                for obj in self.map.values():
+                    if isinstance(obj, Fetch):
+                        obj.check_timeouts(now)
+            except Exception:
+                # keep the loop running for the other fetches
+                logging.error("error in the fetch engine loop", exc_info=True)
+                time.sleep(self.poll_interval)
+
+    def _start_pending(self):
+        while True:
+            try:
+                fetch = self._pending.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                fetch.start(self.map)
+            except Exception, e:
+                logging.error("failed to start fetching %s", fetch.url, exc_info=True)
+                fetch.fail(proxy.ERR_CONN_MISC, e)
+
+    def submit(self, url, headers={}, on_done=None):
+        """Submits the url to fetch and returns a Fetch object.
+
+        on_done is called with the Fetch once it is complete, see
+        `Fetch`. The hostname is resolved in the calling thread.
+        """
+        type, host, selector = proxy.split_type_host(url)
+
+        # ProxyHTTPConnection is used only to parse host and port
+        conn = proxy.ProxyHTTPConnection(host, url=url)
+        try:
+            addrinfo = proxy.getaddrinfo(conn.host, conn.port)
+        except socket.gaierror, e:
+            raise proxy.dns_error(e)
+
+        lines = ["GET %s HTTP/1.1" % (selector or "/"),
+                 "Host: %s" % host,
+                 "Accept-Encoding: identity"]
+        lines += ["%s: %s" % (k, v) for k, v in headers.items()]
+        # The end of response is found when the server closes the connection.
+        lines.append("Connection: close")
+        request_data = "\r\n".join(lines) + "\r\n\r\n"
+
+        fetch = Fetch(url, addrinfo, request_data, on_done)
+        self._pending.put(fetch)
+        self._waker.wake()
+        return fetch
+
+    def fetch(self, url, headers={}):
+        """Fetches the url and returns a ProxyHTTPResponse.
+        """
+        return self.submit(url, headers).wait()
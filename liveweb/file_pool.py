@@ -2,23 +2,98 @@
 File pool implementation
 """
 
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
 import os
 import Queue
 import random
 import threading
 import socket
 import itertools
+import time
+from multiprocessing.pool import ThreadPool
+
+from . import cdx
+from . import filetools
 
 import logging
 logging.basicConfig(level = logging.DEBUG)
 
+# fallocate from libc, to preallocate disk space for the files
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+FALLOC_FL_KEEP_SIZE = 1
+
+def preallocate(fd, size):
+    """Allocates disk space for the first size bytes of the file
+    without changing the size of the file.
+
+    Returns False if that is not supported by the system or the
+    filesystem.
+    """
+    if _fallocate is None:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        logging.warn("fallocate failed: %s", os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
 class MemberFile(object):
     """
+    File of the pool. Keeps track of how much of the data written to it
+    is durable, that is written to the disk using fsync.
+
+    The file is opened with O_APPEND and written using os.write, without
+    any buffering in between. The offsets are tracked here instead of
+    asking the file for them. When preallocate is given, disk space for
+    that many bytes is allocated when the file is created and what is
+    not used is released when the file is closed.
+
+    When index is True, the CDX lines of the records written to the
+    file are written to a sidecar file, named index_name.
+
+    The size of the file is appended to a journal, named journal_name,
+    each time the file is flushed. As the file is flushed only after
+    whole gzip members are written, the journal has the offsets where
+    the file can be cut after a crash. The file is locked using flock
+    as long as it is open, so that it is not recovered by another
+    process while it is being written.
     """
-    def __init__(self, name, pool, *largs, **kargs):
-        self.fp = open(name, *largs, **kargs)
+    def __init__(self, name, pool, preallocate_size=0, index=False):
+        self.name = name
+        self.fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
         self.pool = pool
+        self.closed = False
+        # the FileShard having this file, in sharded mode
+        self.shard = None
+
+        self.size = os.fstat(self.fd).st_size
+        self.created = time.time()
+        self.preallocated = preallocate_size > self.size and preallocate(self.fd, preallocate_size)
+
+        # size of the file at the last flush and at the last fsync
+        self.flushed_size = self.size
+        self.durable_size = 0
+        self._sync_lock = threading.Lock()
+
+        self.journal_name = name + ".offsets"
+        self._journal = os.open(self.journal_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0666)
+
+        self.index_name = None
+        self._index = None
+        if index:
+            self.index_name = name + ".cdx"
+            self._index = os.open(self.index_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0666)
+            os.write(self._index, cdx.CDX_HEADER)
 
     def __enter__(self):
         return self
@@ -26,9 +101,104 @@ class MemberFile(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.pool.return_file(self)
 
+    def __repr__(self):
+        return "<MemberFile %s>" % self.name
+
+    def write(self, data):
+        while data:
+            n = os.write(self.fd, data)
+            self.size += n
+            data = data[n:]
+
+    def tell(self):
+        return self.size
+
+    def add_index(self, entries):
+        """Adds the CDX lines of records written to the file.
+
+        The entries are (entry, offset) pairs, with entry as returned by
+        `cdx.make_entry` and the offset of the record in the file. The
+        lines are written with a single write, without buffering, like
+        the data of the file. Must be called only by the thread holding
+        the file.
+        """
+        if self._index is None or not entries:
+            return
+        data = "".join(cdx.format_line(entry, offset, self.name) for entry, offset in entries)
+        while data:
+            n = os.write(self._index, data)
+            data = data[n:]
+
+    def fileno(self):
+        return self.fd
+
+    def flush(self):
+        # Nothing is buffered here, the data is already with the OS
+        if self.size > self.flushed_size:
+            os.write(self._journal, "%d\n" % self.size)
+        self.flushed_size = self.size
+
+    def close(self):
+        if self.closed:
+            return
+        if self.preallocated:
+            # release the space preallocated beyond the data
+            os.ftruncate(self.fd, self.size)
+        os.close(self.fd)
+        os.close(self._journal)
+        if self._index is not None:
+            os.close(self._index)
+        self.closed = True
+
+    def sync(self, size=None):
+        """Makes sure that the first size bytes of the file are durable,
+        calling fsync unless they already are.
+
+        Threads syncing the file at the same time wait for each other,
+        so that a single fsync makes the data written by all of them
+        durable (group commit). When size is None, the data flushed so
+        far is made durable.
+        """
+        with self._sync_lock:
+            if size is None:
+                size = self.flushed_size
+            if self.durable_size < size:
+                flushed_size = self.flushed_size
+                os.fsync(self.fd)
+                self.durable_size = flushed_size
+
+
+DURABILITY_MODES = ["none", "on-rotate", "periodic", "group"]
+
+# the files written next to the files of the pool
+SIDECAR_SUFFIXES = (".cdx", ".offsets", ".tmp")
+
+class PendingWrite(object):
+    """Data waiting to be appended to a file of the pool by a writer thread.
+    """
+    def __init__(self, data, index=None):
+        self.data = data
+        self.index = index
+        self.file = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        """Waits for the data to be written and returns (filename, offset, length).
+        """
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
 
-    def __getattr__(self, attr):
-        return getattr(self.fp, attr)
+class FileShard(object):
+    """File of a thread in the sharded mode of the FilePool.
+    """
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
 
 
 class FilePool(object):
@@ -36,22 +206,93 @@ class FilePool(object):
     Implements a pool of files from which a file can be requested.
 
     """
-    def __init__(self, directory, pattern="liveweb-%(timestamp)s-%(serial)05d.arc.gz", max_files=1, max_file_size=100*1024*1024, init_file_func=None):
+    def __init__(self, directory, pattern="liveweb-%(timestamp)s-%(serial)05d.arc.gz", max_files=1, max_file_size=100*1024*1024, init_file_func=None, max_batch_size=1024*1024, durability="none", sync_interval=1, shards=0, preallocate=False, max_file_age=None, index=False):
         """
         Creates a pool of files in the given directory with the
         specified pattern.
 
         The number of files is max_files and the maximum size of each
-        file is max_file_size.
+        file is max_file_size. When max_file_age is given, the files
+        are also complete once they are older than that many seconds,
+        even if no data is written to them anymore.
+
+        The complete files are closed and moved to complete/ by a
+        background finalizer thread, which then calls the functions
+        added using `add_completion_hook` with the new path.
+
+        When index is True, each file has a sidecar CDX file with the
+        index entries passed to `append` or `MemberFile.add_index`. It
+        is sorted and moved to complete/ along with the file.
 
         The `get_file` method returns a new file from the pool
 
+        When preallocate is True, disk space for max_file_size bytes is
+        allocated for each new file, to keep the files less fragmented.
+
+        The `append` method hands the data to a background writer
+        thread, which writes the data waiting to be written in batches
+        of up to max_batch_size bytes.
+
+        The durability decides when the data is written to the disk
+        using fsync:
+
+        none: never
+        on-rotate: when a file is complete and moved out of the pool
+        periodic: every sync_interval seconds
+        group: before append returns. The data of concurrent appends
+            is made durable by a single fsync.
+
+        In group mode, `append` and `wait_durable` return only after
+        the data is durable. In periodic mode they return right away,
+        and what must wait for the data to be durable is deferred to
+        the next sync using `when_durable`.
+
+        When shards is more than 0, the pool works in sharded mode
+        instead. There are as many files as shards and the threads are
+        assigned to the shards one after the other, so that each thread
+        has a file of its own when there are enough shards. `get_file`
+        returns the file of the shard of the calling thread and `append`
+        writes to it directly, without a writer thread.
         """
+        if durability not in DURABILITY_MODES:
+            raise ValueError("Unknown durability %r" % durability)
         self.directory = directory
         self.pattern = pattern
         self.max_files = max_files
         self.max_file_size = max_file_size
         self.init_file_func = init_file_func
+        self.max_batch_size = max_batch_size
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.preallocate = preallocate
+        self.max_file_age = max_file_age
+        self.index = index
+
+        # files waiting to be completed by the finalizer thread
+        self.completed = Queue.Queue()
+        self.completion_hooks = []
+        self._finalizer = None
+        self._finalizer_lock = threading.Lock()
+
+        self.shards = [FileShard() for i in range(shards)]
+        self._shard_counter = itertools.count()
+        self._local = threading.local()
+
+        # open files of the pool, synced by the syncer thread in periodic mode
+        self._files = set()
+        # functions to call after the next periodic sync
+        self._when_synced = []
+        self._when_synced_lock = threading.Lock()
+        self._closed = False
+        if self.durability == "periodic":
+            self._syncer = threading.Thread(target=self._sync_loop, name="file-pool-syncer")
+            self._syncer.daemon = True
+            self._syncer.start()
+
+        # data waiting to be written by the writer threads
+        self.pending = Queue.Queue()
+        self._writers = []
+        self._writers_lock = threading.Lock()
 
         self.queue = Queue.Queue(self.max_files)
 
@@ -66,6 +307,10 @@ class FilePool(object):
         for i in range(self.max_files):
             self.queue.put(None)
 
+        # The finalizer completes the old files as well
+        if self.max_file_age:
+            self._start_finalizer()
+
     def set_sequence(self, counter):
         """Sets the sequence counter used to generate filename.
 
@@ -94,30 +339,284 @@ class FilePool(object):
 
         logging.info("Creating new file %s", absolute_name)
 
-        fp = MemberFile(absolute_name, self, mode = "ab")
+        fp = MemberFile(absolute_name, self,
+                        preallocate_size=self.max_file_size if self.preallocate else 0,
+                        index=self.index)
         # Initialize the file object like writing file headers etc.
         if self.init_file_func:
             self.init_file_func(fp)
+
+        self._files.add(fp)
         return fp
 
     def return_file(self, f):
         """Returns a file to the pool. Will discard the file and
         insert a new one if the file is above max_file_size."""
         logging.debug("Returning %s",f)
-        file_size = f.tell()
-        if file_size < self.max_file_size:
+        if self.shards:
+            return self._return_shard_file(f)
+
+        if not self._is_complete(f):
             logging.debug(" Put it back")
             self.queue.put(f)
         else:
             logging.debug(" Closing and creating a new file")
-            f.close()
-            complete_dir = os.path.join(self.directory, 'complete')
-            basename = os.path.basename(f.name)
-            complete_name = os.path.join(complete_dir, basename)
-            os.rename(f.name, complete_name)
+            self._finish_file(f)
             self.queue.put(None)
 
+    def _is_complete(self, f):
+        """Returns True if the file is too big or too old to write more records to it.
+        """
+        if f.tell() >= self.max_file_size:
+            return True
+        return bool(self.max_file_age) and time.time() - f.created >= self.max_file_age
+
+    def add_completion_hook(self, hook):
+        """Adds a function to call with the path of each complete file, after it is moved to complete/.
+        """
+        self.completion_hooks.append(hook)
+
+    def _finish_file(self, f):
+        """Hands over the complete file to the finalizer thread.
+        """
+        self._start_finalizer()
+        self.completed.put(f)
+
+    def wait_completed(self):
+        """Waits until the finalizer is done with all the complete files handed over to it.
+        """
+        self.completed.join()
+
+    def _start_finalizer(self):
+        with self._finalizer_lock:
+            if self._finalizer is None:
+                self._finalizer = threading.Thread(target=self._finalize_loop, name="file-pool-finalizer")
+                self._finalizer.daemon = True
+                self._finalizer.start()
+
+    def _finalize_loop(self):
+        # old files are looked for a few times within max_file_age
+        check_interval = self.max_file_age and min(self.max_file_age / 4.0, 60)
+        next_check = time.time() + (check_interval or 0)
+
+        while True:
+            try:
+                if check_interval:
+                    f = self.completed.get(timeout=max(next_check - time.time(), 0.01))
+                else:
+                    f = self.completed.get()
+            except Queue.Empty:
+                f = False
+
+            if f is None:
+                self.completed.task_done()
+                break
+            elif f is not False:
+                try:
+                    self._complete_file(f)
+                finally:
+                    self.completed.task_done()
+
+            if check_interval and time.time() >= next_check:
+                self._complete_old_files()
+                next_check = time.time() + check_interval
+
+    def _complete_old_files(self):
+        """Completes the files in the pool that are too old, but are not written to.
+        """
+        if self.shards:
+            for shard in self.shards:
+                if shard.lock.acquire(False):
+                    try:
+                        if shard.file and self._is_complete(shard.file):
+                            f, shard.file = shard.file, None
+                            self._complete_file(f)
+                    finally:
+                        shard.lock.release()
+        else:
+            for i in range(self.max_files):
+                try:
+                    f = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if f is not None and self._is_complete(f):
+                    self._complete_file(f)
+                    f = None
+                self.queue.put(f)
+
+    def _complete_file(self, f):
+        """Closes the file, moves it to complete/ and calls the completion hooks.
+
+        """
+        try:
+            self._close_file(f)
+            complete_name = self._move_to_complete(f.name)
+        except (IOError, OSError):
+            logging.error("failed to complete %s", f.name, exc_info=True)
+            return
+
+        logging.info("completed %s", complete_name)
+        self._run_completion_hooks(complete_name)
+
+    def _move_to_complete(self, name, end=None):
+        """Moves the closed file to complete/ and returns the new path.
+
+        The journal is removed and the sorted CDX file is moved to
+        complete/ before the file, so that it is there by the time the
+        file shows up. When end is given, the CDX lines of the records
+        beyond end are left out.
+        """
+        complete_name = os.path.join(self.directory, 'complete', os.path.basename(name))
+        if os.path.exists(name + ".offsets"):
+            os.remove(name + ".offsets")
+        if os.path.exists(name + ".cdx"):
+            cdx.sort_file(name + ".cdx", complete_name + ".cdx", end)
+            os.remove(name + ".cdx")
+        os.rename(name, complete_name)
+        return complete_name
+
+    def _run_completion_hooks(self, complete_name):
+        for hook in self.completion_hooks:
+            try:
+                hook(complete_name)
+            except Exception:
+                logging.error("completion hook failed for %s", complete_name, exc_info=True)
+
+    def recover(self, num_threads=4):
+        """Completes the files left in partial/ by processes that died.
+
+        The files are cut at the end of their last complete gzip member
+        and moved to complete/, num_threads files at a time. Files still
+        being written by a running process are left alone. Returns the
+        new paths of the recovered files.
+        """
+        partial_dir = os.path.join(self.directory, 'partial')
+        names = [os.path.join(partial_dir, name) for name in sorted(os.listdir(partial_dir))
+                 if not name.endswith(SIDECAR_SUFFIXES)]
+        if not names:
+            return []
+
+        logging.info("recovering %d files in %s", len(names), partial_dir)
+        threadpool = ThreadPool(min(num_threads, len(names)))
+        try:
+            recovered = [path for path in threadpool.map(self._recover_file, names) if path]
+        finally:
+            threadpool.close()
+
+        for complete_name in recovered:
+            self._run_completion_hooks(complete_name)
+        return recovered
+
+    def _recover_file(self, name):
+        """Cuts the file at the end of its last complete gzip member
+        and moves it to complete/. Returns the new path or None if the
+        file is not recovered.
+
+        The last offset in the journal that is within the file is the
+        end of a complete member, so only the data after it, written
+        just before the crash, has to be read.
+        """
+        try:
+            f = open(name, "r+b")
+        except IOError:
+            # completed by its process meanwhile
+            return None
+
+        try:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                logging.info("not recovering %s, it is being written", name)
+                return None
+
+            stat = os.fstat(f.fileno())
+            if not os.path.exists(name) or stat.st_size == 0 and time.time() - stat.st_mtime < 60:
+                # completed meanwhile or just created by another process
+                return None
+
+            end = filetools.find_members_end(f, self._journal_offset(name, stat.st_size))
+            if end < stat.st_size:
+                logging.warn("truncating %s from %d to %d bytes", name, stat.st_size, end)
+            # also releases the space preallocated beyond the data
+            os.ftruncate(f.fileno(), end)
+
+            if end == 0:
+                logging.warn("removing %s, it has no complete records", name)
+                for path in [name] + [name + suffix for suffix in SIDECAR_SUFFIXES]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                return None
+
+            complete_name = self._move_to_complete(name, end)
+            logging.info("recovered %s", complete_name)
+            return complete_name
+        except (IOError, OSError):
+            logging.error("failed to recover %s", name, exc_info=True)
+        finally:
+            f.close()
+
+    def _journal_offset(self, name, size):
+        """Returns the last offset in the journal of the file that is within size.
+        """
+        offset = 0
+        try:
+            f = open(name + ".offsets")
+        except IOError:
+            return offset
+        with f:
+            for line in f:
+                if line.endswith("\n") and line[:-1].isdigit() and int(line) <= size:
+                    offset = max(offset, int(line))
+        return offset
+
+    def _get_shard(self):
+        """Returns the shard of the calling thread.
+        """
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = self.shards[self._shard_counter.next() % len(self.shards)]
+        return shard
+
+    def _get_shard_file(self):
+        shard = self._get_shard()
+        shard.lock.acquire()
+        try:
+            if shard.file is None:
+                shard.file = self._new_file()
+                shard.file.shard = shard
+        except:
+            shard.lock.release()
+            raise
+        return shard.file
+
+    def _return_shard_file(self, f):
+        shard = f.shard
+        try:
+            if self._is_complete(f):
+                logging.debug(" Closing and creating a new file")
+                shard.file = None
+                self._finish_file(f)
+        finally:
+            shard.lock.release()
+
+    def locate(self, filename):
+        """Returns the current path of a file created by this pool or
+        None if it doesn't exist anymore.
+
+        The files are moved from partial/ to complete/ once they are full.
+        """
+        if os.path.exists(filename):
+            return filename
+        complete_name = os.path.join(self.directory, 'complete', os.path.basename(filename))
+        if os.path.exists(complete_name):
+            return complete_name
+
     def get_file(self):
+        if self.shards:
+            return self._get_shard_file()
+
         f = self.queue.get()
         # f is None when new file needs to be created
         if f is None:
@@ -125,9 +624,168 @@ class FilePool(object):
         logging.debug("Getting %s",f)
         return f
 
+    def append(self, data, index=None):
+        """Appends data to a file from the pool and returns (filename, offset, length).
+
+        index is the CDX entry of the record at the beginning of the
+        data, as returned by `cdx.make_entry`.
+
+        The data is written by a background writer thread, along with
+        the data appended by other threads in the meanwhile, and the
+        file is flushed once for the whole batch.
+
+        In sharded mode, the data is written directly to the file of
+        the calling thread.
+        """
+        if self.shards:
+            with self.get_file() as f:
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                if index:
+                    f.add_index([(index, offset)])
+                filename = f.name
+            self.wait_durable(f, offset + len(data))
+            return filename, offset, len(data)
+
+        self._start_writers()
+        write = PendingWrite(data, index)
+        self.pending.put(write)
+        filename, offset, length = write.wait()
+        self.wait_durable(write.file, offset + length)
+        return filename, offset, length
+
+    def wait_durable(self, f, size):
+        """Waits until the first size bytes of the file f are durable,
+        as per the durability of the pool.
+
+        Returns immediately unless durability is group.
+        """
+        if self.durability == "group":
+            f.sync(size)
+
+    def when_durable(self, func):
+        """Calls func once the data appended so far is durable.
+
+        In periodic mode, func is called by the syncer thread after the
+        next sync, so that the caller doesn't wait for it. In the other
+        modes, it is called right away.
+        """
+        if self.durability == "periodic":
+            with self._when_synced_lock:
+                if not self._closed:
+                    self._when_synced.append(func)
+                    return
+        func()
+
+    def _sync_loop(self):
+        while not self._closed:
+            time.sleep(self.sync_interval)
+            # the data of these was written before the sync starts
+            with self._when_synced_lock:
+                funcs, self._when_synced = self._when_synced, []
+            for f in list(self._files):
+                try:
+                    f.sync()
+                except (IOError, OSError, ValueError):
+                    logging.error("failed to sync %s", f.name, exc_info=True)
+            self._call_all(funcs)
+
+    def _call_all(self, funcs):
+        for func in funcs:
+            try:
+                func()
+            except Exception:
+                logging.error("failed to call %r after sync", func, exc_info=True)
+
+    def _close_file(self, f):
+        """Closes the file, making it durable first unless durability is none.
+        """
+        if self.durability != "none":
+            f.flush()
+            f.sync()
+        f.close()
+        self._files.discard(f)
+
+    def _start_writers(self):
+        with self._writers_lock:
+            # one writer for each file of the pool
+            while len(self._writers) < self.max_files:
+                t = threading.Thread(target=self._write_loop, name="file-pool-writer-%d" % len(self._writers))
+                t.daemon = True
+                t.start()
+                self._writers.append(t)
+
+    def _write_loop(self):
+        while True:
+            write = self.pending.get()
+            if write is None:
+                break
+            batch = [write]
+            size = len(write.data)
+            while size < self.max_batch_size:
+                try:
+                    write = self.pending.get_nowait()
+                except Queue.Empty:
+                    break
+                if write is None:
+                    # stop after writing this batch
+                    self.pending.put(None)
+                    break
+                batch.append(write)
+                size += len(write.data)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """Writes the data of all the pending writes in the batch to a file with a single write and flush.
+        """
+        try:
+            with self.get_file() as f:
+                logging.debug("writing %d records to file %s", len(batch), f.name)
+                offset = f.tell()
+                f.write("".join(write.data for write in batch))
+                f.flush()
+                entries = []
+                for write in batch:
+                    write.file = f
+                    write.result = (f.name, offset, len(write.data))
+                    if write.index:
+                        entries.append((write.index, offset))
+                    offset += len(write.data)
+                # the CDX lines of the whole batch are written at once
+                f.add_index(entries)
+        except Exception, e:
+            logging.error("failed to write %d records", len(batch), exc_info=True)
+            for write in batch:
+                write.error = e
+
+        for write in batch:
+            write.done.set()
+
     def close(self):
         logging.debug("Closing all descriptors. Emptying pool.")
+        with self._writers_lock:
+            for t in self._writers:
+                self.pending.put(None)
+            for t in self._writers:
+                t.join()
+            self._writers = []
+        with self._finalizer_lock:
+            if self._finalizer:
+                self.completed.put(None)
+                self._finalizer.join()
+                self._finalizer = None
+        with self._when_synced_lock:
+            self._closed = True
+            funcs, self._when_synced = self._when_synced, []
         while not self.queue.empty():
             fp = self.queue.get_nowait()
             if fp:
-                fp.close()
+                self._close_file(fp)
+        for shard in self.shards:
+            with shard.lock:
+                if shard.file:
+                    self._close_file(shard.file)
+                    shard.file = None
+        # the files are synced when they are closed
+        self._call_all(funcs)
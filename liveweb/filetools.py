@@ -3,6 +3,9 @@ import httplib
 import tempfile
 import logging
 import os
+import struct
+import time
+import zlib
 
 from . import config
 
@@ -130,13 +133,112 @@ class MemFile:
         """Deletes the temp file if created.
         """
         if self._fileobj and not self.in_memory():
-            logging.info("removing temp file %s", self._fileobj.name)
-            os.unlink(self._fileobj.name)
+            # the TemporaryFile is deleted when it is closed
+            logging.info("removing temp file")
+            self._fileobj.close()
+
+class GzipMember:
+    """File-like object that compresses the data written to it into a single gzip member.
+
+    Works like gzip.GzipFile in write mode, but compresses using a zlib
+    compressobj directly and writes the compressed data to fileobj as
+    it is produced. When fileobj is None, the compressed data is kept
+    in memory as a list of chunks and is available from getvalue once
+    the member is closed.
+    """
+    def __init__(self, fileobj=None, level=9):
+        self.fileobj = fileobj
+        self.chunks = []
+        # size of the compressed data
+        self.size = 0
+
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        self._crc = zlib.crc32("")
+        self._length = 0
+
+        # magic, method, flags, mtime, extra flags, OS (unknown)
+        xfl = "\002" if level == 9 else "\004" if level == 1 else "\000"
+        self._output("\037\213\010\000" + struct.pack("<I", int(time.time())) + xfl + "\377")
+
+    def _output(self, data):
+        if data:
+            self.size += len(data)
+            if self.fileobj is None:
+                self.chunks.append(data)
+            else:
+                self.fileobj.write(data)
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._length += len(data)
+        self._output(self._compressobj.compress(data))
+
+    def close(self):
+        """Writes the end of the member.
+        """
+        self._output(self._compressobj.flush() + struct.pack("<II", self._crc & 0xffffffff, self._length & 0xffffffff))
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+def find_members_end(fileobj, offset=0, chunk_size=64*1024):
+    """Returns the offset of the end of the last complete gzip member
+    in the file, reading it from offset, which must be the beginning
+    of a member or the end of the file.
+
+    Reading stops at the first member that is cut short or corrupt,
+    so any garbage after the complete members is not included. The
+    uncompressed data is not kept, at most chunk_size * 16 bytes of it
+    are in memory at a time.
+    """
+    fileobj.seek(offset)
+    max_length = chunk_size * 16
+
+    # end of the last complete member and offset of the data read
+    end = pos = offset
+    data = ""
+    d = None
+    while True:
+        if not data:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+        if d is None:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            d.decompress(data, max_length)
+            # unconsumed_tail is not cleared at the end of the member
+            while d.unconsumed_tail and not d.unused_data:
+                d.decompress(d.unconsumed_tail, max_length)
+        except zlib.error:
+            return end
+
+        if d.unused_data:
+            # the member is complete, the unused data is the beginning of the next one
+            pos += len(data) - len(d.unused_data)
+            end = pos
+            data = d.unused_data
+            d = None
+        else:
+            pos += len(data)
+            data = ""
+
+    # At the end of the file, the last member is complete if a byte
+    # fed after it is left unused.
+    if d is not None:
+        try:
+            d.decompress("\0")
+            if d.unused_data == "\0":
+                end = pos
+        except zlib.error:
+            pass
+    return end
 
 class DummyFilePool:
     """Simple implementation of FilePool.
     """
     counter = 0
+    index = False
     
     def get_file(self):
         filename = "/tmp/record-%d.arc.gz" % self.counter
@@ -145,6 +247,18 @@ class DummyFilePool:
             filename = "/tmp/record-%d.arc.gz" % self.counter
         return open(filename, "w")
 
+    def append(self, data, index=None):
+        f = self.get_file()
+        f.write(data)
+        f.close()
+        return f.name, 0, len(data)
+
+    def wait_durable(self, f, size):
+        pass
+
+    def when_durable(self, func):
+        func()
+
 def fileiter(file, size, chunk_size=1024*10):
     """Returns an iterator over the file for specified size.
     
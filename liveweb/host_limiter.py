@@ -0,0 +1,74 @@
+"""Limiting the number of concurrent fetches from each host.
+"""
+
+import collections
+import threading
+
+class HostLimiter:
+    """Limits the number of fetches in flight for each host.
+
+    Fetches beyond the limit wait in a FIFO queue for a slot. The
+    oldest waiter gets the slot when a fetch from the host finishes.
+    A fetch gives up if it couldn't get a slot within queue_timeout
+    seconds, so that a slow host can't hold all the threads of a
+    worker.
+    """
+    def __init__(self, max_per_host=4, queue_timeout=10):
+        self.max_per_host = max_per_host
+        self.queue_timeout = queue_timeout
+
+        # host -> number of fetches in flight
+        self._active = {}
+        # host -> deque of threading.Event of the waiting fetches
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """Waits for a slot to fetch from the host.
+
+        Returns False if no slot was available within queue_timeout.
+        """
+        with self._lock:
+            if self._active.get(host, 0) < self.max_per_host and not self._waiters.get(host):
+                self._active[host] = self._active.get(host, 0) + 1
+                return True
+            waiter = threading.Event()
+            self._waiters.setdefault(host, collections.deque()).append(waiter)
+
+        waiter.wait(self.queue_timeout)
+
+        with self._lock:
+            # The slot may have been handed over just after the timeout
+            if waiter.is_set():
+                return True
+            queue = self._waiters[host]
+            queue.remove(waiter)
+            if not queue:
+                del self._waiters[host]
+            return False
+
+    def release(self, host):
+        """Releases the slot acquired for the host.
+        """
+        with self._lock:
+            queue = self._waiters.get(host)
+            if queue:
+                # The slot is handed over to the oldest waiter, the
+                # number of fetches in flight stays the same.
+                queue.popleft().set()
+                if not queue:
+                    del self._waiters[host]
+            else:
+                self._active[host] -= 1
+                if self._active[host] == 0:
+                    del self._active[host]
+
+    def in_flight(self, host):
+        """Returns the number of fetches in flight for the host.
+        """
+        return self._active.get(host, 0)
+
+    def waiting(self, host):
+        """Returns the number of fetches waiting for the host.
+        """
+        return len(self._waiters.get(host, []))
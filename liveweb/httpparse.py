@@ -0,0 +1,322 @@
+"""Parsing of HTTP responses in the capture path.
+
+httplib reads the status line and headers one line at a time and
+parses them with rfc822. The parsers here work on blocks of data as
+they are received from the socket.
+"""
+
+import httplib
+
+# limits, same as httplib
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+def parse_content_type(ctype):
+    """Returns the mimetype from the value of a content-type header.
+    """
+    # If there are multiple content-type headers, httplib joins them using ", "
+    # Take the last one in that case
+    ctype = ctype.split(",")[-1]
+
+    # content-type can have parameters separated by semicolon.
+    # For example: text/html; charset=UTF-8
+    ctype = ctype.split(";")[0]
+
+    # strip leading and trailing whitespace
+    ctype =  ctype.strip()
+
+    # remove any whitespace as it may interfere with arc header
+    ctype = ctype.replace(" ", "")
+    return ctype
+
+class ResponseHead:
+    """The status line and headers of an HTTP response.
+    """
+    def __init__(self, version, status, reason, headers):
+        """
+        :param version: HTTP version as used by httplib, 9, 10 or 11
+        :param status: status code as int
+        :param reason: reason phrase
+        :param headers: list of (name, value) in the order they appear in the response
+        """
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+        # lower-case name -> value. Repeated headers are joined with ", " like httplib does.
+        self._dict = {}
+        self._names = []
+        for name, value in headers:
+            key = name.lower()
+            if key in self._dict:
+                self._dict[key] += ", " + value
+            else:
+                self._dict[key] = value
+                self._names.append(key)
+
+        ctypes = [value for name, value in headers if name.lower() == "content-type"]
+        self.content_type = ctypes and parse_content_type(ctypes[-1]) or None
+
+        tr_enc = self._dict.get("transfer-encoding")
+        self.transfer_encoding = tr_enc and tr_enc.strip().lower()
+        self.chunked = self.transfer_encoding == "chunked"
+
+        # Content-Length is ignored for chunked responses
+        self.content_length = None
+        length = self._dict.get("content-length")
+        if length and not self.chunked:
+            try:
+                self.content_length = int(length)
+            except ValueError:
+                pass
+            else:
+                if self.content_length < 0:
+                    self.content_length = None
+
+    def getheader(self, name, default=None):
+        return self._dict.get(name.lower(), default)
+
+    def getheaders(self):
+        """Returns list of (name, value) with lower-case names, like httplib does.
+        """
+        return [(name, self._dict[name]) for name in self._names]
+
+    def will_close(self):
+        """Returns True if the server is going to close the connection after this response.
+        """
+        conn = self.getheader("connection", "").lower()
+        if self.version == 11:
+            return "close" in conn
+        # HTTP/1.0 keep-alive
+        if self.getheader("keep-alive") or "keep-alive" in conn:
+            return False
+        pconn = self.getheader("proxy-connection", "").lower()
+        return "keep-alive" not in pconn
+
+def _is_http09(data):
+    """Returns True if the response data doesn't start with a HTTP/1.x status line.
+    """
+    return not (data.startswith("HTTP/") or "HTTP/".startswith(data))
+
+class ResponseHeadParser:
+    """Incremental parser for the status line and headers of an HTTP response.
+
+    The data is fed in blocks as it is received. Once the end of the
+    headers is found, the parsed head is available as the head
+    attribute. Interim 1xx responses are skipped and their data is
+    included in head_data.
+    """
+    def __init__(self, max_size=len("HTTP/1.1 200 OK\r\n") + MAX_HEADERS * MAX_LINE):
+        self.max_size = max_size
+        self.head = None
+        # total size of the head, including the interim responses
+        self.size = 0
+
+        self._data = ""
+        # offset in _data till where the end of headers has been searched
+        self._offset = 0
+
+    def feed(self, data):
+        """Feeds the next block of data.
+
+        Returns True when the head is complete. The head data is
+        available as head_data and the data received after the head,
+        which is the beginning of the payload, as rest.
+
+        Raises httplib.HTTPException if the head is malformed.
+        """
+        self._data += data
+
+        if self.size == 0 and _is_http09(self._data):
+            # Not a HTTP/1.x response, consider it as HTTP/0.9 and
+            # everything as payload, like httplib does.
+            self.head = ResponseHead(9, 200, "", [])
+            return True
+
+        while True:
+            end = self._find_end(self._data, self._offset)
+            if end < 0:
+                if len(self._data) - self.size > self.max_size:
+                    raise httplib.LineTooLong("headers")
+                self._offset = len(self._data)
+                return False
+
+            head = self._parse(self._data[self.size:end])
+            self.size = self._offset = end
+            if not 100 <= head.status < 200:
+                self.head = head
+                return True
+
+    def feed_eof(self):
+        """Called when the connection is closed before the head is complete.
+
+        Raises httplib.BadStatusLine.
+        """
+        line = self._data[self.size:].split("\n", 1)[0]
+        raise httplib.BadStatusLine(line)
+
+    @property
+    def head_data(self):
+        return self._data[:self.size]
+
+    @property
+    def rest(self):
+        return self._data[self.size:]
+
+    def _find_end(self, data, offset):
+        """Returns the offset after the empty line that ends the headers, -1 if not found.
+        """
+        # Look a little before offset as the previous block may have ended in the middle of CRLFCRLF
+        begin = max(offset - 3, self.size)
+        i = data.find("\n\r\n", begin)
+        j = data.find("\n\n", begin)
+        if i < 0 and j < 0:
+            return -1
+        elif j < 0 or 0 <= i < j:
+            return i + 3
+        else:
+            return j + 2
+
+    def _parse(self, data):
+        lines = data.split("\n")
+        statusline = lines[0].rstrip("\r")
+        version, status, reason = self._parse_status(statusline)
+
+        headers = []
+        for line in lines[1:]:
+            line = line.rstrip("\r")
+            if len(line) > MAX_LINE:
+                raise httplib.LineTooLong("header line")
+            if not line:
+                continue
+            if line[0] in " \t" and headers:
+                # continuation of the previous header
+                name, value = headers[-1]
+                headers[-1] = (name, value + " " + line.strip())
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                headers.append((name.strip(), value.strip()))
+        if len(headers) > MAX_HEADERS:
+            raise httplib.HTTPException("got more than %d headers" % MAX_HEADERS)
+        return ResponseHead(version, status, reason, headers)
+
+    def _parse_status(self, line):
+        if len(line) > MAX_LINE:
+            raise httplib.LineTooLong("status line")
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            raise httplib.BadStatusLine(line)
+        version, status = parts[0], parts[1]
+        reason = parts[2].strip() if len(parts) == 3 else ""
+
+        try:
+            status = int(status)
+        except ValueError:
+            raise httplib.BadStatusLine(line)
+        if not 100 <= status <= 999:
+            raise httplib.BadStatusLine(line)
+
+        if version == "HTTP/1.0":
+            version = 10
+        elif version.startswith("HTTP/1."):
+            version = 11
+        else:
+            raise httplib.UnknownProtocol(version)
+        return version, status, reason
+
+class ChunkedDecoder:
+    """Decoder for the chunked transfer-coding.
+
+    The raw payload is fed in blocks. The decoder finds where the
+    chunked payload ends and collects the decoded data.
+    """
+    def __init__(self, decode=True):
+        """
+        :param decode: if False, only the end of the payload is tracked and the decoded data is not collected.
+        """
+        self.decode = decode
+        self.done = False
+
+        self._state = "size"
+        self._line = ""
+        self._remaining = 0
+        self._decoded = []
+
+    def feed(self, data):
+        """Feeds the next block of raw data.
+
+        Returns the number of bytes of data that belong to the chunked
+        payload. It is less than len(data) only when the end of the
+        payload is found in the middle of the block.
+
+        Raises httplib.IncompleteRead if the chunk size is invalid.
+        """
+        offset = 0
+        n = len(data)
+        while offset < n and not self.done:
+            if self._state == "data":
+                end = min(n, offset + self._remaining)
+                if self.decode:
+                    self._decoded.append(data[offset:end])
+                self._remaining -= end - offset
+                offset = end
+                if self._remaining == 0:
+                    self._state = "data-end"
+                continue
+
+            # all the other states read lines
+            i = data.find("\n", offset)
+            if i < 0:
+                self._line += data[offset:]
+                if len(self._line) > MAX_LINE:
+                    raise httplib.LineTooLong("chunk size")
+                offset = n
+                break
+
+            line = (self._line + data[offset:i]).rstrip("\r")
+            self._line = ""
+            offset = i + 1
+            self._process_line(line)
+        return offset
+
+    def _process_line(self, line):
+        if self._state == "size":
+            try:
+                # ignore the chunk extensions
+                size = int(line.split(";", 1)[0], 16)
+            except ValueError:
+                raise httplib.IncompleteRead("".join(self._decoded))
+            if size == 0:
+                self._state = "trailer"
+            else:
+                self._remaining = size
+                self._state = "data"
+        elif self._state == "data-end":
+            self._state = "size"
+        elif self._state == "trailer":
+            # trailers end with an empty line
+            if not line:
+                self.done = True
+
+    def complete_at_eof(self):
+        """Returns True if the payload can be considered complete when
+        the connection is closed at this point.
+
+        Like httplib, the missing trailer section after the last chunk is tolerated.
+        """
+        return self.done or self._state == "trailer"
+
+    def read(self):
+        """Returns the data decoded so far and clears it.
+        """
+        data = "".join(self._decoded)
+        self._decoded = []
+        return data
+
+def decode_chunked(data):
+    """Decodes the chunked payload.
+    """
+    decoder = ChunkedDecoder()
+    decoder.feed(data)
+    return decoder.read()
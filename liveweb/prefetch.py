@@ -0,0 +1,191 @@
+"""Prefetching the embedded resources of captured HTML pages.
+
+When a page is captured, the requests for its images, stylesheets and
+scripts usually follow soon after. The Prefetcher fetches them in the
+background so that those requests are served from the cache.
+"""
+
+import logging
+import Queue
+import threading
+import urlparse
+import zlib
+from HTMLParser import HTMLParser, HTMLParseError
+
+from . import httpparse
+
+# Only the beginning of big pages is looked at
+MAX_HTML_SIZE = 1024 * 1024
+
+class ResourceParser(HTMLParser):
+    """Collects the URLs of images, stylesheets, scripts and icons in a HTML page.
+    """
+    def __init__(self, base_url):
+        HTMLParser.__init__(self)
+        self.base_url = base_url
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "base" and attrs.get("href"):
+            self.base_url = urlparse.urljoin(self.base_url, attrs["href"])
+        elif tag in ("img", "script") and attrs.get("src"):
+            self.add(attrs["src"])
+        elif tag == "link" and attrs.get("href"):
+            rel = (attrs.get("rel") or "").lower().split()
+            if "stylesheet" in rel or "icon" in rel:
+                self.add(attrs["href"])
+
+    handle_startendtag = handle_starttag
+
+    def add(self, url):
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        url = urlparse.urldefrag(urlparse.urljoin(self.base_url, url.strip()))[0]
+        if url.startswith(("http://", "https://")) and url not in self.urls:
+            self.urls.append(url)
+
+def extract_resources(html, base_url):
+    """Returns the URLs of the resources embedded in the HTML page, in the order they appear.
+    """
+    parser = ResourceParser(base_url)
+    try:
+        parser.feed(html)
+        parser.close()
+    except (HTMLParseError, UnicodeDecodeError):
+        # keep what was found before the error
+        pass
+    return parser.urls
+
+def get_html(response):
+    """Returns the HTML of the page in the response, decoding the
+    transfer and content encodings, or None if it can't be decoded.
+    """
+    chunks = []
+    size = 0
+    for chunk in response.get_payload():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= MAX_HTML_SIZE:
+            break
+    data = "".join(chunks)
+
+    if response.chunked:
+        data = httpparse.decode_chunked(data)
+
+    encoding = (response.getheader("content-encoding") or "").strip().lower()
+    try:
+        if encoding in ("gzip", "x-gzip"):
+            data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, MAX_HTML_SIZE)
+        elif encoding == "deflate":
+            data = zlib.decompressobj().decompress(data, MAX_HTML_SIZE)
+        elif encoding and encoding != "identity":
+            return None
+    except zlib.error:
+        return None
+    return data[:MAX_HTML_SIZE]
+
+class Prefetcher:
+    """Fetches the resources of the captured pages using a few background threads.
+
+    The pages and resources to fetch wait in a queue of bounded size.
+    Work is dropped when the queue is full. At most budget resources
+    are fetched for a page. The HTML of the pages is decoded and parsed
+    by the background threads. As the pages in the queue hold their
+    response, only max_pages of them can be waiting at a time.
+
+    When submit is given, the resources it can fetch without waiting
+    are not waited for by the background threads. Once fetched, the
+    function completing their capture is queued ahead of the limit of
+    the queue, as it must be called.
+    """
+    def __init__(self, fetch, num_threads=2, queue_size=1000, budget=20, max_pages=10, submit=None):
+        """
+        :param fetch: function called with a URL to fetch it into the cache
+        :param submit: function called with a URL and a callback to start
+            fetching it into the cache without waiting. Returns False if
+            it can't, otherwise the callback is called with a function
+            completing the capture once the URL is fetched.
+        """
+        self.fetch = fetch
+        self.submit = submit
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+        self.budget = budget
+        self.max_pages = max_pages
+
+        self.queue = Queue.Queue()
+        self.dropped = 0
+        self._pages = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.num_threads):
+            t = threading.Thread(target=self.run, name="prefetch-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def page_captured(self, response):
+        """Called after a response is captured. Schedules the
+        resources of HTML pages to be prefetched.
+
+        Nothing is read from the response here, the page is parsed
+        by the background threads.
+        """
+        if response.status != 200 or response.content_type != "text/html":
+            return
+
+        with self._lock:
+            if self._pages >= self.max_pages:
+                self.dropped += 1
+                return
+            self._pages += 1
+
+        if not self._put(("page", response.url, response)):
+            self._page_done()
+
+    def _page_done(self):
+        with self._lock:
+            self._pages -= 1
+
+    def _put(self, job, force=False):
+        if not force and self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            return False
+        self.queue.put(job)
+        return True
+
+    def _completed(self, url, complete):
+        # called by the fetch engine, which must not wait
+        self._put(("complete", url, complete), force=True)
+
+    def run(self):
+        while True:
+            # the response of a page or the function completing the capture of a resource
+            kind, url, arg = self.queue.get()
+            # a submitted resource is done only once its capture is complete
+            submitted = False
+            try:
+                if kind == "page":
+                    try:
+                        html = get_html(arg)
+                    finally:
+                        self._page_done()
+                    urls = html and extract_resources(html, url) or []
+                    logging.debug("prefetching %d of %d resources of %s", min(len(urls), self.budget), len(urls), url)
+                    for resource_url in urls[:self.budget]:
+                        self._put(("resource", resource_url, None))
+                elif kind == "complete":
+                    arg()
+                else:
+                    submitted = self.submit and self.submit(url, lambda complete, url=url: self._completed(url, complete))
+                    if not submitted:
+                        self.fetch(url)
+            except Exception:
+                logging.error("prefetch failed - %s", url, exc_info=True)
+            finally:
+                if kind == "complete":
+                    # the resource job is done as well
+                    self.queue.task_done()
+                if not submitted:
+                    self.queue.task_done()
@@ -1,28 +1,59 @@
 """The proxy functionality.
 """
 
+import base64
 import datetime
-import gzip
+import hashlib
 import httplib
 import logging
 import os
+import shutil
 import socket
 import urllib
 from cStringIO import StringIO
 import tempfile
 import sys
 import errno
+import threading
 import time
 
 from warc import arc
+from warc import warc
 from warc.utils import FilePart
+from . import cdx
 from . import filetools
 from . import config
+from . import resolver
+from . import httpparse
 
 MEG = 1024 * 1024
 
 EMPTY_BUFFER = filetools.MemFile()
 
+# Pool of persistent connections to the origin servers.
+# Initialized by webapp.setup, connections are not reused when it is None.
+connection_pool = None
+
+# Resolver used to lookup hostnames, socket.getaddrinfo is used when it is None.
+# Initialized by webapp.setup when resolver is "stub".
+dns_resolver = None
+
+# Cache of resolved hostnames.
+# Initialized by webapp.setup, hostnames are resolved every time when it is None.
+dns_cache = None
+
+# FetchEngine used to fetch http URLs.
+# Initialized by webapp.setup when fetch-engine is "async".
+fetch_engine = None
+
+# SSL context shared by the HTTPS connections, so that the CA certificates are loaded only once.
+# Initialized by webapp.setup, each connection creates a new SSL context when it is None.
+ssl_context = None
+
+# HostLimiter to limit the concurrent fetches from each host.
+# Initialized by webapp.setup, there is no limit when it is None.
+host_limiter = None
+
 # 1x - bad input
 ERR_INVALID_URL = 10, "invalid URL"
 
@@ -41,11 +72,13 @@ ERR_CONN_MISC = 39, "unexpected connection error"
 # 4x - resource errors
 ERR_RESPONSE_TOO_BIG = 40, "response too big"
 ERR_REQUEST_TIMEOUT = 41, "request took too long to finish"
+ERR_HOST_BUSY = 42, "too many concurrent requests to the host"
 
 
 class ProxyError(Exception):
     def __init__(self, error, cause=None, data=None):
         self.errcode, self.errmsg = error
+        self.cause = cause
 
         if isinstance(cause, socket.error) and cause.errno:
             cause_msg = "%s: %s" % (errno.errorcode.get(cause.errno, cause.errno), cause.strerror)
@@ -77,6 +110,7 @@ class Record:
         self.offset = offset
         self.content_length = content_length
         self.content_iter = content_iter
+        self._lock = threading.Lock()
 
         if self.content_length is None:
             self.content_length = os.stat(filename).st_size
@@ -97,6 +131,19 @@ class Record:
         self.content_iter = iter([data])
         return data
 
+    def copy(self):
+        """Returns a new Record over the same content with an independent content_iter.
+
+        Used when the same record is handed to multiple consumers. The
+        content of big records is read again from the file, small ones
+        are read into memory once.
+        """
+        with self._lock:
+            if self.filename is not None and self.content_length >= MEG:
+                return Record(self.filename, offset=self.offset, content_length=self.content_length)
+            data = self.read_all()
+        return Record(self.filename, offset=self.offset, content_length=self.content_length, content_iter=iter([data]))
+
     def __iter__(self):
         return iter(self.content_iter)
 
@@ -108,41 +155,229 @@ def split_type_host(url):
     return type, host, selector
 
 
+# WARC-Profile of the revisit records of duplicate payloads
+REVISIT_PROFILE = "http://netpreserve.org/warc/1.0/revisit/identical-payload-digest"
+
+def warc_digest(digest):
+    """Returns the value of WARC digest header for the given hashlib sha1 object.
+    """
+    return "sha1:" + base64.b32encode(digest.digest())
+
+def write_warc_record(fileobj, header, block):
+    """Writes a WARC record with the given header and the block read from the given file.
+    """
+    header.write_to(fileobj)
+    shutil.copyfileobj(block, fileobj, 10*MEG)
+    fileobj.write("\r\n\r\n")
+
+def getaddrinfo(host, port):
+    """Returns the addrinfo list to connect to host and port, using the dns_cache when available.
+    """
+    if dns_cache:
+        return dns_cache.getaddrinfo(host, port)
+    elif dns_resolver:
+        return dns_resolver.getaddrinfo(host, port)
+    else:
+        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+def dns_error(e):
+    """Returns the ProxyError for the given socket.gaierror.
+    """
+    # -3: Temporary failure in name resolution
+    # Happens when DNS request is timeout
+    if e.errno == -3:
+        return ProxyError(ERR_DNS_TIMEOUT, e, data={"dns_timeout": config.get_dns_timeout()})
+    else:
+        return ProxyError(ERR_INVALID_DOMAIN, e)
+
 def log_error(err):
     code, msg = err
     exc_type, exc_value, _ = sys.exc_info()
     logging.error("E%02d - %s (%s)", code, msg, str(exc_value))
 
-def urlopen(url):
+def urlopen(url, stream=False, headers=None):
     """Works like urllib.urlopen, but returns a ProxyHTTPResponse object instead.
+
+    When stream is True, only the headers are read and the payload
+    must be read using the iter_payload method of the response.
+
+    The optional headers are sent along with the extra_headers from the config.
+
+    The errors are returned as a 502 response, except ERR_HOST_BUSY,
+    which is raised. There were too many fetches from the host in this
+    worker, which says nothing about the URL, so there is nothing to
+    archive.
     """
     logging.info("urlopen %s", url)
  
     try:
-        return _urlopen(url)
+        return _urlopen(url, stream=stream, headers=headers)
     except ProxyError, e:
-        logging.error("%s - %s", str(e), url)
-        response = ProxyHTTPResponse(url, None, method="GET")
-        response.error_bad_gateway()
-        return response
+        if e.errcode == ERR_HOST_BUSY[0]:
+            raise
+        return error_response(url, e)
 
-def _urlopen(url):
+def error_response(url, e):
+    """Returns the 502 response archived for the url when fetching it failed with the ProxyError e.
+    """
+    logging.error("%s - %s", str(e), url)
+    response = ProxyHTTPResponse(url, None, method="GET")
+    response.error_bad_gateway()
+    return response
+
+def can_submit(url):
+    """Returns True if the url can be fetched using `submit`.
+
+    Only http URLs can be, and only when there is a fetch_engine.
+    """
+    return fetch_engine is not None and split_type_host(url)[0].lower() == "http"
+
+def submit(url, on_done, headers=None):
+    """Starts fetching the url using the fetch_engine and returns the Fetch, without waiting for it.
+
+    on_done is called with the Fetch by the event-loop thread once the
+    fetch is complete, and `get_response` then returns the response
+    without blocking. The url must be one for which `can_submit` is
+    True.
+
+    Raises ProxyError if the fetch can't be started, ERR_HOST_BUSY
+    when there are too many fetches from the host.
+    """
+    logging.info("submit %s", url)
+    headers = _request_headers(headers)
+
+    if not host_limiter:
+        return fetch_engine.submit(url, headers, on_done)
+
+    hostname = _acquire_host(split_type_host(url)[1])
+    def done(fetch):
+        host_limiter.release(hostname)
+        on_done(fetch)
+    try:
+        return fetch_engine.submit(url, headers, done)
+    except:
+        host_limiter.release(hostname)
+        raise
+
+def get_response(fetch, timeout=None):
+    """Returns the response of a Fetch started by `submit`, waiting
+    for it at most timeout seconds when given.
+
+    The errors are returned as a 502 response, like urlopen does.
+    """
+    try:
+        return fetch.wait(timeout)
+    except ProxyError, e:
+        return error_response(fetch.url, e)
+
+def _request_headers(headers):
+    """Returns the headers to send, the given ones along with the extra_headers from the config.
+    """
+    headers = dict(config.get("extra_headers",{}), **(headers or {}))
+    headers['User-Agent'] = config.user_agent
+    return headers
+
+def _acquire_host(host):
+    """Waits for a slot of the host_limiter and returns the hostname to release it with.
+
+    Raises ERR_HOST_BUSY if no slot was available in time.
+    """
+    hostname = urllib.splitport(host.lower())[0]
+    if not host_limiter.acquire(hostname):
+        raise ProxyError(ERR_HOST_BUSY, data={"max_host_connections": host_limiter.max_per_host,
+                                              "host_queue_timeout": host_limiter.queue_timeout})
+    return hostname
+
+def _urlopen(url, stream=False, headers=None):
     """urlopen without the exception handling.
     
     Called by urlopen and test cases.
     """
-    headers = config.get("extra_headers",{})
-    headers['User-Agent'] = config.user_agent
+    headers = _request_headers(headers)
 
     type, host, selector = split_type_host(url)
 
+    if not host_limiter:
+        return _fetch(url, type, host, selector, headers, stream)
+
+    hostname = _acquire_host(host)
+    try:
+        response = _fetch(url, type, host, selector, headers, stream)
+    except:
+        host_limiter.release(hostname)
+        raise
+
+    if response.stream:
+        # the fetch is over only after the payload is read
+        response.on_finish = lambda: host_limiter.release(hostname)
+    else:
+        host_limiter.release(hostname)
+    return response
+
+def _fetch(url, type, host, selector, headers, stream=False):
+    """Fetches the url using a pooled or new connection or the fetch_engine.
+    """
+    # The fetch engine doesn't support https yet
+    if fetch_engine and type.lower() == "http":
+        return fetch_engine.fetch(url, headers)
+
+    key = _connection_key(type, host)
+
+    conn = connection_pool and connection_pool.get(key)
+    if conn:
+        conn.reset(url)
+        try:
+            return _request(conn, key, selector, headers, stream)
+        except ProxyError, e:
+            conn.close()
+            if not _is_stale_connection_error(e):
+                raise
+            # The server has closed the idle connection. Try again with a new one.
+            logging.info("reused connection failed (%s), retrying - %s", str(e), url)
+
     if type.lower() == "https":
         conn = ProxyHTTPSConnection(host, url=url)
     else:
         conn = ProxyHTTPConnection(host, url=url)
 
+    return _request(conn, key, selector, headers, stream)
+
+def _request(conn, key, selector, headers, stream=False):
+    """Sends a GET request on the given connection and returns the response.
+
+    The connection is returned to the connection_pool if the server
+    allows it to be reused.
+    """
+    conn.stream = stream
     conn.request("GET", selector, headers=headers)
-    return conn.getresponse()
+    response = conn.getresponse()
+
+    # ProxyHTTPResponse.begin reads the whole payload, so the connection
+    # is ready for the next request as soon as the response is available.
+    # In stream mode, that happens only after the payload is read.
+    if connection_pool and not response.will_close:
+        if stream:
+            response.on_complete = lambda: connection_pool.put(key, conn)
+        else:
+            connection_pool.put(key, conn)
+    return response
+
+def _connection_key(type, host):
+    """Returns the (scheme, host, port) tuple used to identify connections in the connection_pool.
+    """
+    type = type.lower()
+    host, port = urllib.splitport(host.lower())
+    if not port:
+        port = httplib.HTTPS_PORT if type == "https" else httplib.HTTP_PORT
+    return type, host, int(port)
+
+def _is_stale_connection_error(e):
+    """Returns True if the error indicates that a reused connection has
+    been closed by the server while it was idle.
+    """
+    if isinstance(e.cause, socket.error) and e.cause.errno in (errno.ECONNRESET, errno.EPIPE):
+        return True
+    return isinstance(e.cause, httplib.BadStatusLine)
 
 class _FakeSocket:
     """Faking a socket with makefile method.
@@ -168,7 +403,15 @@ class SocketWrapper:
         self._sock = sock
         self._max_time = max_time
         self._max_size = max_size
+        self._makefile_refs = 0
         
+        self.reset()
+
+    def reset(self):
+        """Resets the max-time and max-size counters.
+
+        Called when a persistent connection is reused for a new request.
+        """
         self._start_time = time.time()
         self._bytes_read = 0
 
@@ -177,24 +420,116 @@ class SocketWrapper:
 
     def recv(self, bufsize):
         data = self._sock.recv(bufsize)
-        self._bytes_read += len(data)
+        self._check_limits(len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = self._sock.recv_into(buffer, nbytes)
+        self._check_limits(nbytes)
+        return nbytes
+
+    def _check_limits(self, nbytes):
+        # The limits are checked once for every block received. The
+        # SocketReader returned by makefile reads in blocks even when
+        # reading headers line by line.
+        self._bytes_read += nbytes
 
-        # TODO: optimize this
-        # Each time.time() call takes about 0.35 ns. 
-        # For reading headers, this function is called once of each byte.
-        # Assuming that the headers is 1000 bytes long, it will add an overhead of 0.35ms.
-        # We should optimize this if we care about half-a-milli-second.
-        
         if self._max_time is not None and time.time() - self._start_time > self._max_time:
             raise ProxyError(ERR_REQUEST_TIMEOUT, data={"max_time": self._max_time})
 
         if self._max_size is not None and self._bytes_read > self._max_size:
             raise ProxyError(ERR_RESPONSE_TOO_BIG, data={"max_size": self._max_size})
 
+    def makefile(self, mode='r', bufsize=-1):
+        # Like socket.makefile, the file keeps working after the socket
+        # is closed. httplib closes the connection as soon as the headers
+        # are read when the server doesn't support keep-alive.
+        self._makefile_refs += 1
+        return SocketReader(self)
+
+    def close(self):
+        # The real socket is closed only when all the files made from it are closed
+        if self._makefile_refs < 1:
+            self._sock.close()
+        else:
+            self._makefile_refs -= 1
+
+class SocketReader:
+    """Read-only file object over a socket that receives data in blocks
+    into a preallocated buffer using recv_into.
+
+    socket._fileobject, as used by httplib, calls recv once for every
+    byte when reading the headers and makes several copies of the data
+    when reading the payload. This reads whole blocks into a reusable
+    bytearray and copies each byte out of it only once.
+
+    The data read from the socket beyond the current response, if any,
+    is lost when this file is closed. That is fine as requests are
+    never pipelined.
+    """
+    def __init__(self, sock, bufsize=64*1024):
+        self._sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._pos = 0
+        self._end = 0
+
+    def _fill(self):
+        """Receives the next block into the buffer. Returns the number of bytes received.
+        """
+        while True:
+            try:
+                self._end = self._sock.recv_into(self._view, len(self._buf))
+                self._pos = 0
+                return self._end
+            except socket.error, e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos == self._end and not self._fill():
+                break
+            end = self._end if size < 0 else min(self._end, self._pos + size)
+            chunks.append(self._view[self._pos:end].tobytes())
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return "".join(chunks)
+
+    def read1(self, size):
+        """Returns the buffered data, up to size bytes, receiving a
+        new block only when the buffer is empty.
+        """
+        if self._pos == self._end and not self._fill():
+            return ""
+        end = min(self._end, self._pos + size)
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
         return data
 
-    def makefile(self, mode='r', bufsize=-1):
-        return socket._fileobject(self, mode, bufsize)
+    def readline(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._pos == self._end and not self._fill():
+                break
+            end = self._end if size < 0 else min(self._end, self._pos + size)
+            newline = self._buf.find("\n", self._pos, end)
+            if newline >= 0:
+                end = newline + 1
+            chunks.append(self._view[self._pos:end].tobytes())
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+            if newline >= 0:
+                break
+        return "".join(chunks)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
 
 class ProxyHTTPResponse(httplib.HTTPResponse):
     """HTTPResponse wrapper to record the HTTP payload.
@@ -204,6 +539,10 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
     DEFAULT_CONTENT_TYPE = "unk"
     
     def __init__(self, url, sock, *a, **kw):
+        # When stream is True, begin reads only the headers and the
+        # payload is read by iter_payload.
+        self.stream = kw.pop("stream", False)
+
         self.sock = sock or _FakeSocket()
         httplib.HTTPResponse.__init__(self, self.sock, *a, **kw)
         
@@ -211,58 +550,212 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
         self.remoteip = self.sock.getpeername()[0]
         self.content_type = self.DEFAULT_CONTENT_TYPE
         self.buf = EMPTY_BUFFER
+        self.head = None
         
         # Length of header data
         self.header_offset = 0
+
+        # The HTTP request sent to the server, when known
+        self.request_data = None
+
+        # sha1 of the recorded response and of its payload, updated as the response is read
+        self.block_digest = None
+        self.payload_digest = None
+        self.payload_length = 0
+
+        # Set when the response is written as a WARC record
+        self.warc_record_id = None
+        self.warc_date = None
+
+        # Time of the capture, set when the response is written
+        self.capture_date = None
         
         self.arc_size = None
         self.arc_data = None
 
+        # called after the payload is read completely in stream mode
+        self.on_complete = None
+
+        # called when iter_payload is over, whether the payload is read completely or not
+        self.on_finish = None
+
     def begin(self):
-        self.fp = filetools.SpyFile(self.fp, spy=filetools.MemFile())
-        self.buf = self.fp.buf
-        
+        self.buf = filetools.MemFile()
+        self.block_digest = hashlib.sha1()
+        self.payload_digest = hashlib.sha1()
+
+        # SocketReader can return the data already received without
+        # blocking for more. Other file objects are read in blocks.
+        self._read_block = getattr(self.fp, "read1", self.fp.read)
+        self._pending = ""
+
         try:
             self.sock.settimeout(config.get_initial_data_timeout())
-            httplib.HTTPResponse.begin(self)
-
-            ctype = self.getheader("content-type", self.DEFAULT_CONTENT_TYPE)
-            self.content_type = self.parse_content_type(ctype)
-            self.header_offset = self.buf.tell()
+            self._begin()
         except socket.error, e:
             raise ProxyError(ERR_INITIAL_DATA_TIMEOUT, e, {"initial_data_timeout": config.get_initial_data_timeout()})
         except httplib.HTTPException, e:
             raise ProxyError(ERR_CONN_MISC, e)
 
+        self.sock.settimeout(config.get_read_timeout())
+        if self.stream:
+            return
+
+        # This will read the whole payload, taking care of content-length,
+        # chunked transfer-encoding etc.. The raw HTTP payload is recorded
+        # in buf.
+        while self._read(64*1024):
+            pass
+
+    def _begin(self):
+        """Reads and parses the status line and headers.
+
+        The head is read in blocks and the data received beyond the
+        headers is kept aside to be read as payload.
+        """
+        parser = httpparse.ResponseHeadParser()
+        while True:
+            block = self._read_block(64*1024)
+            if not block:
+                parser.feed_eof()
+            if parser.feed(block):
+                break
+
+        self._record(parser.head_data, payload=False)
+        self._pending = parser.rest
+
+        head = self.head = parser.head
+        self.version = head.version
+        self.status = head.status
+        self.reason = head.reason
+        self.chunked = head.chunked
+        self.header_offset = self.buf.tell()
+        self.content_type = head.content_type or self.DEFAULT_CONTENT_TYPE
+
+        # The length of the payload
+        self.length = head.content_length
+        if (head.status == httplib.NO_CONTENT or head.status == httplib.NOT_MODIFIED
+            or 100 <= head.status < 200 or self._method == "HEAD"):
+            self.length = 0
+            self.chunked = False
+
+        if head.version == 9:
+            self.will_close = 1
+        else:
+            self.will_close = head.will_close()
+            # without length, the end of payload is marked by closing the connection
+            if not self.will_close and not self.chunked and self.length is None:
+                self.will_close = 1
+
+        self._decoder = httpparse.ChunkedDecoder(decode=False) if self.chunked else None
+        if self.length == 0:
+            self._finish()
+
+    def getheader(self, name, default=None):
+        if self.head is None:
+            raise httplib.ResponseNotReady()
+        return self.head.getheader(name, default)
+
+    def getheaders(self):
+        if self.head is None:
+            raise httplib.ResponseNotReady()
+        return self.head.getheaders()
+
+    def _read_raw(self, amt):
+        """Reads up to amt bytes of the raw payload and records them in buf.
+
+        Returns an empty string when the whole payload has been read.
+        """
+        if self.fp is None:
+            return ""
+
+        if self._pending:
+            data, self._pending = self._pending[:amt], self._pending[amt:]
+        else:
+            data = self._read_block(amt)
+
+        if self.length is not None:
+            data = data[:self.length]
+            if not data and self.length:
+                raise httplib.IncompleteRead("", self.length)
+            self.length -= len(data)
+            if self.length == 0:
+                self._finish()
+        elif self._decoder:
+            if not data:
+                if not self._decoder.complete_at_eof():
+                    raise httplib.IncompleteRead("")
+                self._finish()
+            else:
+                data = data[:self._decoder.feed(data)]
+                if self._decoder.done:
+                    self._finish()
+        elif not data:
+            # payload till the end of the connection
+            self._finish()
+
+        self._record(data)
+        return data
+
+    def _record(self, data, payload=True):
+        """Records the data received from the server in buf and updates the digests.
+        """
+        self.buf.write(data)
+        self.block_digest.update(data)
+        if payload:
+            self.payload_digest.update(data)
+            self.payload_length += len(data)
+
+    def _finish(self):
+        """Called when the payload is read completely.
+        """
+        # Closing fp marks the response as closed, which tells httplib
+        # that the connection is ready for the next request.
+        self.close()
+
+    def _read(self, amt):
+        """Reads from the payload converting the errors into ProxyError.
+        """
         try:
-            # This will read the whole payload, taking care of content-length,
-            # chunked transfer-encoding etc.. The spy file will record the real
-            # HTTP payload.
-            self.sock.settimeout(config.get_read_timeout())
-            self.read()
+            return self._read_raw(amt)
         except httplib.IncompleteRead, e:
             raise ProxyError(ERR_CONN_DROPPED, e)
-        except httplib.HTTPException:
+        except httplib.HTTPException, e:
             raise ProxyError(ERR_CONN_MISC, e)
         except socket.error, e:
             raise ProxyError(ERR_READ_TIMEOUT, e, data={"read_timeout": config.get_read_timeout()})
 
-    def parse_content_type(self, ctype):
-        # If there are multiple content-type headers, httplib joins them using ", "
-        # Take the last one in that case
-        ctype = ctype.split(",")[-1]
+    def iter_payload(self, chunk_size=64*1024):
+        """Reads the payload from the server and yields the raw HTTP payload as it arrives.
 
-        # content-type can have parameters separated by semicolon.
-        # For example: text/html; charset=UTF-8
-        ctype = ctype.split(";")[0]
+        This is used when the response is created in stream mode. The
+        payload is recorded in buf as usual, so write_arc can be called
+        once the iteration is over. If reading the payload fails, the
+        response is turned into 502 Bad Gateway like urlopen does and
+        the iteration stops.
+        """
+        try:
+            try:
+                while True:
+                    data = self._read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            except ProxyError, e:
+                logging.error("%s - %s", str(e), self.url)
+                self.error_bad_gateway()
+                return
 
-        # strip leading and trailing whitespace
-        ctype =  ctype.strip()
+            if self.on_complete:
+                self.on_complete()
+        finally:
+            if self.on_finish:
+                self.on_finish()
+                self.on_finish = None
+
+    def parse_content_type(self, ctype):
+        return httpparse.parse_content_type(ctype)
 
-        # remove any whitespace as it may interfere with arc header
-        ctype = ctype.replace(" ", "")
-        return ctype
-        
     def error_bad_gateway(self):
         """Resets the status code to "502 Bad Gateway" indicating that there was 
         some network error when trying to accessing the server.
@@ -287,44 +780,105 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
             
         self.buf = EMPTY_BUFFER
         self.header_offset = 0
+        self.block_digest = None
+        self.payload_digest = None
+        self.payload_length = 0
     
+    def get_validators(self):
+        """Returns the ETag and Last-Modified headers of the response as
+        a dict with keys etag and last_modified.
+
+        The dict is empty if the response is not a successful one or
+        there are no validators.
+        """
+        validators = {}
+        if self.status == 200:
+            if self.getheader("etag"):
+                validators["etag"] = self.getheader("etag")
+            if self.getheader("last-modified"):
+                validators["last_modified"] = self.getheader("last-modified")
+        return validators
+
     def write_arc(self, pool):
         record = self._make_arc_record()
+        return self._write_members(pool, record.header.length, [record.write_to])
 
-        # if small enough, store in memory
-        if record.header.length < MEG: 
-            # write ARC record into memory
-            buf = StringIO()
-            begin, record_size = self._write_arc_record(record, buf)
-                        
-            # write the ARC record data in memory into file
-            with pool.get_file() as f:
-                logging.info("writing arc record to file %s", f.name)
-                begin = f.tell()
-                f.write(buf.getvalue())
-                filename = f.name
-                
-            return Record(filename, offset=begin, content_length=record_size, content_iter=iter([buf.getvalue()]))
+    def _write_members(self, pool, length, writers, mimetype=None):
+        """Compresses what each of the writers writes into a gzip
+        member, appends the members to a file from the pool and returns
+        the Record of the first member.
+
+        The members are compressed before taking a file from the pool,
+        so that the file is held only for appending the compressed
+        data. zlib releases the GIL while compressing, so the request
+        threads compress their records in parallel.
+
+        The CDX entry of the first member is added to the index of the
+        file, when the pool keeps one.
+
+        :param length: the uncompressed size of the first member
+        :param writers: functions called with a file object to write the uncompressed data
+        :param mimetype: mimetype for the CDX entry, content_type of the response by default
+        """
+        if length < MEG: 
+            # if small enough, compress in memory
+            members = []
+            for write_to in writers:
+                member = filetools.GzipMember(level=config.compression_level)
+                write_to(member)
+                member.close()
+                members.append(member.getvalue())
+
+            # the writer threads of the pool batch the small records
+            # of concurrent requests into larger writes
+            index = None
+            if pool.index:
+                index = self._index_entry(len(members[0]), mimetype)
+            filename, begin, size = pool.append("".join(members), index)
+            logging.info("wrote record to file %s", filename)
+
+            # the same compressed data is used for the cache
+            data = members[0]
+            return Record(filename, offset=begin, content_length=len(data), content_iter=iter([data]))
         else:
-            with pool.get_file() as f:
-                logging.info("writing arc record to file %s", f.name)
-                filename = f.name
-                begin, record_size = self._write_arc_record(record, f)
+            # big records are compressed into a temp file
+            compressed = filetools.MemFile(MEG)
+            try:
+                sizes = [self._compress(write_to, compressed) for write_to in writers]
+                compressed.seek(0)
 
-            return Record(filename, offset=begin, content_length=record_size)
+                with pool.get_file() as f:
+                    logging.info("writing record to file %s", f.name)
+                    begin = f.tell()
+                    shutil.copyfileobj(compressed, f, MEG)
+                    f.flush()
+                    if pool.index:
+                        f.add_index([(self._index_entry(sizes[0], mimetype), begin)])
+                    filename = f.name
+                    end = f.tell()
+            finally:
+                compressed.close()
+
+            pool.wait_durable(f, end)
+
+            return Record(filename, offset=begin, content_length=sizes[0])
                 
-    def _write_arc_record(self, record, fileobj):
-        """Writes the give ARC record into the given fileobj as gzip data and returns the start offset in the file and and record size.
+    def _index_entry(self, length, mimetype=None):
+        """Returns the CDX entry of the record of this response, of the given compressed length.
         """
-        begin = fileobj.tell()
-        
-        zfile = gzip.GzipFile(fileobj=fileobj, filename=None, mode="w")
-        record.write_to(zfile)
-        zfile.close()
-        fileobj.flush()
-        
-        end = fileobj.tell()
-        return begin, end-begin
+        digest = None
+        if self.payload_digest is not None:
+            digest = base64.b32encode(self.payload_digest.digest())
+        return cdx.make_entry(self.url, self.capture_date, mimetype or self.content_type,
+                              self.status, digest, length)
+
+    def _compress(self, write_to, fileobj):
+        """Writes the data written by write_to into the given fileobj as gzip data and returns the compressed size.
+        """
+        member = filetools.GzipMember(fileobj, level=config.compression_level)
+        write_to(member)
+        member.close()
+        return member.size
                         
     def _make_arc_record(self):
         if self.status == 502:
@@ -344,8 +898,9 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
             remoteip = self.remoteip
             content_type = self.content_type
     
+        self.capture_date = self._utcnow()
         headers = dict(url = self.url,
-                       date = self._utcnow(),
+                       date = self.capture_date,
                        content_type = self.content_type,
                        ip_address = self.remoteip,
                        length = payload_length)
@@ -361,8 +916,132 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
         return datetime.datetime.utcnow()
     
     def write_warc(self, pool):
-        raise NotImplementedError()
-        
+        """Writes the response and the request as WARC records and returns the Record of the response.
+
+        The digests are computed while the response is read, so the
+        payload is read just once more, to compress it.
+        """
+        headers, block, block_length = self._response_block()
+        return self._write_warc(pool, headers, block, block_length)
+
+    def make_warc_record(self):
+        """Returns the Record of the WARC response record of this
+        response, compressed but not written to the pool.
+
+        Used to send the response back to the client when only a
+        revisit record is written for it. Must be called after the
+        revisit record is written, the WARC-Date is the same.
+        """
+        headers, block, block_length = self._response_block()
+        header = self._warc_header(headers, block_length)
+
+        compressed = filetools.MemFile(MEG)
+        size = self._compress(lambda f: write_warc_record(f, header, block), compressed)
+        compressed.seek(0)
+        return Record(None, offset=0, content_length=size, content_iter=filetools.fileiter(compressed, size))
+
+    def _response_block(self):
+        """Returns the WARC headers specific to the response record, the block and its length.
+        """
+        if self.block_digest is None:
+            # Error made up by the proxy, there is no response from the server
+            data = "HTTP/1.1 %d %s\r\nContent-Length: 0\r\n\r\n" % (self.status, self.reason)
+            block = StringIO(data)
+            block_length = len(data)
+            block_digest = hashlib.sha1(data)
+            payload_digest = hashlib.sha1()
+        else:
+            self.buf.seek(0, 2)
+            block_length = self.buf.tell()
+            self.buf.seek(0)
+            block = self.buf
+            block_digest = self.block_digest
+            payload_digest = self.payload_digest
+
+        headers = {
+            "WARC-Type": "response",
+            "WARC-Block-Digest": warc_digest(block_digest),
+            "WARC-Payload-Digest": warc_digest(payload_digest)
+        }
+        return headers, block, block_length
+
+    def write_revisit(self, pool, original):
+        """Writes a WARC revisit record, with just the status line and
+        headers of the response, followed by the request. The payload
+        is the same as that of the original record.
+
+        :param original: dict with url, date and record_id of the WARC record having the payload
+        """
+        self.buf.seek(0)
+        head = self.buf.read(self.header_offset)
+        headers = {
+            "WARC-Type": "revisit",
+            "WARC-Profile": REVISIT_PROFILE,
+            "WARC-Refers-To": original["record_id"],
+            "WARC-Refers-To-Target-URI": original["url"],
+            "WARC-Refers-To-Date": original["date"],
+            "WARC-Block-Digest": warc_digest(hashlib.sha1(head)),
+            "WARC-Payload-Digest": warc_digest(self.payload_digest)
+        }
+        return self._write_warc(pool, headers, StringIO(head), len(head), mimetype="warc/revisit")
+
+    def _write_warc(self, pool, headers, block, block_length, mimetype=None):
+        """Writes a WARC record with the given headers and block, and
+        the request record concurrent to it. Returns the Record of the
+        first one.
+
+        The WARC-Record-ID and WARC-Date of the record are available as
+        warc_record_id and warc_date after this.
+        """
+        self.capture_date = self._utcnow()
+        self.warc_date = self.capture_date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        response = self._warc_header(headers, block_length)
+        self.warc_record_id = response.record_id
+        writers = [lambda f: write_warc_record(f, response, block)]
+
+        if self.request_data is not None:
+            request = warc.WARCHeader({
+                "WARC-Type": "request",
+                "WARC-Target-URI": self.url,
+                "WARC-Date": self.warc_date,
+                "WARC-Concurrent-To": response.record_id,
+                "WARC-Block-Digest": warc_digest(hashlib.sha1(self.request_data)),
+                "Content-Type": "application/http; msgtype=request",
+                "Content-Length": str(len(self.request_data))
+            }, defaults=True)
+            writers.append(lambda f: write_warc_record(f, request, StringIO(self.request_data)))
+
+        return self._write_members(pool, block_length, writers, mimetype)
+
+    def _warc_header(self, headers, block_length):
+        """Returns the WARCHeader of a record of this response with the given extra headers.
+        """
+        headers = dict(headers, **{
+            "WARC-Target-URI": self.url,
+            "WARC-Date": self.warc_date,
+            "Content-Type": "application/http; msgtype=response",
+            "Content-Length": str(block_length)
+        })
+        if self.remoteip != "0.0.0.0":
+            headers["WARC-IP-Address"] = self.remoteip
+        return warc.WARCHeader(headers, defaults=True)
+
+    def get_payload_digest(self):
+        """Returns the WARC-Payload-Digest of the response, None if the
+        response is an error made up by the proxy.
+        """
+        if self.payload_digest is not None:
+            return warc_digest(self.payload_digest)
+
+    def write_record(self, pool):
+        """Writes the response in the configured archive format and returns the Record.
+        """
+        if config.archive_format == "warc":
+            return self.write_warc(pool)
+        else:
+            return self.write_arc(pool)
+
     def get_arc(self):
         """Returns size and fileobj to read arc data.
         
@@ -372,10 +1051,6 @@ class ProxyHTTPResponse(httplib.HTTPResponse):
             self.write_arc()
         return self.arc_size, self.arc_data
     
-    def get_warc(self):
-        """Returns size and fileobj to read warc data."""
-        raise NotImplementedError()
-        
     def get_payload(self):
         """Returns size and fileobj to read HTTP payload.
         """
@@ -395,27 +1070,37 @@ class ProxyConnectionMixin:
 
     def __init__(self, host, url):
         try:
-            self._base_connection_class.__init__(self, host)
+            self._base_connection_class.__init__(self, host, **self._connection_args())
         except httplib.InvalidURL, e:
             raise ProxyError(ERR_INVALID_URL, e)
 
         self.url = url
-        self.response_class = lambda *a, **kw: self._proxy_response_class(self.url, *a, **kw)
+        self.stream = False
+        self.request_data = []
+        self.response_class = lambda *a, **kw: self._proxy_response_class(self.url, *a, stream=self.stream, **kw)
 
         # This is used when creating the socket connection
         self.timeout = config.get_connect_timeout()
 
+        # httplib uses this to create the socket connection
+        self._create_connection = self.create_connection
+
+    def _connection_args(self):
+        """Returns the extra keyword arguments to pass to the base connection class.
+        """
+        return {}
+
+    def create_connection(self, address, timeout, source_address=None):
+        return resolver.create_connection(address, timeout, source_address,
+                                          getaddrinfo=getaddrinfo,
+                                          attempt_delay=config.connect_attempt_delay)
+
     def connect(self):
         try:
             self._base_connection_class.connect(self)
             self.sock = SocketWrapper(self.sock, config.max_request_time, config.max_response_size)
         except socket.gaierror, e:
-            # -3: Temporary failure in name resolution
-            # Happens when DNS request is timeout
-            if e.errno == -3:
-                raise ProxyError(ERR_DNS_TIMEOUT, e, data={"dns_timeout": config.get_dns_timeout()})
-            else:
-                raise ProxyError(ERR_INVALID_DOMAIN, e)
+            raise dns_error(e)
         except socket.timeout, e:
             raise ProxyError(ERR_CONN_TIMEOUT, e, data={"conn_timeout": config.get_connect_timeout()})
         except socket.error, e:
@@ -426,12 +1111,30 @@ class ProxyConnectionMixin:
                 raise ProxyError(ERR_CONN_MISC, e)
         return self.sock
 
+    def reset(self, url):
+        """Prepares a pooled connection for making a request to the given url.
+        """
+        self.url = url
+        if isinstance(self.sock, SocketWrapper):
+            self.sock.reset()
+
     def request(self, method, url, body=None, headers={}):
+        self.request_data = []
         try:
             self._base_connection_class.request(self, method, url, body=body, headers=headers)
         except socket.error, e:
             raise ProxyError(ERR_CONN_MISC, e)
 
+    def send(self, data):
+        # The request is recorded to write it to WARC files
+        self.request_data.append(data)
+        self._base_connection_class.send(self, data)
+
+    def getresponse(self, *a, **kw):
+        response = self._base_connection_class.getresponse(self, *a, **kw)
+        response.request_data = "".join(self.request_data)
+        return response
+
 
 class ProxyHTTPConnection(ProxyConnectionMixin, httplib.HTTPConnection):
     """HTTPConnection wrapper to add extra hooks to handle errors.
@@ -440,5 +1143,12 @@ class ProxyHTTPConnection(ProxyConnectionMixin, httplib.HTTPConnection):
 
 class ProxyHTTPSConnection(ProxyConnectionMixin, httplib.HTTPSConnection):
     """HTTPSConnection wrapper to add extra hooks to handle errors.
+
+    Uses the shared ssl_context when available.
     """
     _base_connection_class = httplib.HTTPSConnection
+
+    def _connection_args(self):
+        if ssl_context:
+            return {"context": ssl_context}
+        return {}
@@ -0,0 +1,489 @@
+"""Hostname resolution for the proxy.
+
+Provides a cache of resolved addresses shared by all the threads of a
+worker process and a stub resolver that talks to the nameservers
+directly over UDP.
+"""
+
+import errno
+import logging
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from . import config
+from .singleflight import SingleFlight
+
+# getaddrinfo error codes, as used by socket.gaierror
+EAI_NONAME = -2
+EAI_AGAIN = -3
+EAI_NODATA = -5
+
+# DNS record types and response codes
+TYPE_A = 1
+TYPE_AAAA = 28
+RCODE_NXDOMAIN = 3
+
+class AddrInfoList(list):
+    """List of addrinfo tuples along with the time for which it is valid.
+    """
+    def __init__(self, addrinfo, ttl=None):
+        list.__init__(self, addrinfo)
+        self.ttl = ttl
+
+class DNSCache:
+    """Cache of getaddrinfo results.
+
+    Successful lookups are cached for ttl seconds. Failed lookups
+    (invalid domain, dns timeout) are cached for negative_ttl seconds
+    so that requests to failing domains fail immediately instead of
+    waiting for the DNS again.
+
+    Concurrent lookups of the same host are coalesced into one.
+    """
+    def __init__(self, ttl=300, negative_ttl=30, max_entries=10000, getaddrinfo=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._getaddrinfo = getaddrinfo or self._system_getaddrinfo
+
+        # (host, port) -> (expiry_time, addrinfo list or socket.gaierror)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._inflight = SingleFlight()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def _system_getaddrinfo(self, host, port):
+        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    def getaddrinfo(self, host, port):
+        """Returns the addrinfo list for connecting to (host, port).
+
+        Raises socket.gaierror if the host can't be resolved.
+        """
+        key = (host, port)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                result = entry[1]
+                if isinstance(result, socket.gaierror):
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+            else:
+                result = None
+                self.misses += 1
+            lookups = self.hits + self.negative_hits + self.misses
+
+        if lookups % 1000 == 0:
+            logging.info("dns cache stats: %s", self.stats())
+
+        if result is None:
+            result = self._inflight.do(key, self._resolve, host, port)
+
+        if isinstance(result, socket.gaierror):
+            raise result
+        return list(result)
+
+    def _resolve(self, host, port):
+        try:
+            result = self._getaddrinfo(host, port)
+            ttl = self.ttl
+            # Use the TTL of the DNS records when the resolver provides it.
+            if getattr(result, "ttl", None) is not None:
+                ttl = min(ttl, result.ttl)
+        except socket.gaierror, e:
+            result = e
+            ttl = self.negative_ttl
+
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[host, port] = (time.time() + ttl, result)
+        return result
+
+    def _evict(self):
+        """Removes the expired entries. Empties the cache if all of
+        the entries are still valid.
+
+        Must be called with the lock held.
+        """
+        now = time.time()
+        for key, (expiry, _) in self._entries.items():
+            if expiry <= now:
+                del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the number of hits, negative hits, misses and the hit rate as a dict.
+        """
+        lookups = self.hits + self.negative_hits + self.misses
+        hit_rate = lookups and float(self.hits + self.negative_hits) / lookups
+        return dict(hits=self.hits,
+                    negative_hits=self.negative_hits,
+                    misses=self.misses,
+                    entries=len(self._entries),
+                    hit_rate=hit_rate)
+
+class StubResolver:
+    """Minimal DNS client that resolves A and AAAA records over UDP.
+
+    Both the queries are sent in parallel and the lookup fails with a
+    DNS timeout error if there is no answer within dns_timeout. Unlike
+    the libc resolver, the timeout is enforced for each lookup.
+
+    IP addresses and the names in the hosts file are resolved without
+    querying the nameservers.
+    """
+    def __init__(self, nameservers=None, resolv_conf="/etc/resolv.conf", hosts_file="/etc/hosts"):
+        """Creates a new resolver.
+
+        :param nameservers: list of nameserver IPs or (ip, port) tuples, defaults to the nameservers from resolv_conf.
+        :param resolv_conf: path to the resolv.conf file
+        :param hosts_file: path to the hosts file
+        """
+        nameservers = nameservers or read_nameservers(resolv_conf) or ["127.0.0.1"]
+        self.nameservers = [ns if isinstance(ns, tuple) else (ns, 53) for ns in nameservers]
+        self.hosts = read_hosts(hosts_file)
+
+    def getaddrinfo(self, host, port):
+        """Works like socket.getaddrinfo for SOCK_STREAM sockets.
+
+        The returned list has the TTL of the DNS records in the ttl attribute.
+        """
+        addresses, ttl = self.resolve(host)
+        addrinfo = []
+        for family, ip in addresses:
+            if family == socket.AF_INET6:
+                sockaddr = (ip, port, 0, 0)
+            else:
+                sockaddr = (ip, port)
+            addrinfo.append((family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr))
+        return AddrInfoList(addrinfo, ttl)
+
+    def resolve(self, host, timeout=None):
+        """Returns the list of (family, ip) for the host and the TTL of the records.
+
+        Raises socket.gaierror if the host could not be resolved.
+        """
+        for family in [socket.AF_INET, socket.AF_INET6]:
+            try:
+                socket.inet_pton(family, host)
+                return [(family, host)], None
+            except (socket.error, ValueError):
+                pass
+
+        name = host.lower().rstrip(".")
+        if name in self.hosts:
+            return self.hosts[name], None
+
+        if timeout is None:
+            timeout = config.get_dns_timeout()
+
+        try:
+            qname = encode_name(name)
+        except ValueError:
+            raise socket.gaierror(EAI_NONAME, "Name or service not known")
+
+        # split the time among the nameservers
+        for nameserver in self.nameservers:
+            answers = self._query(nameserver, qname, float(timeout) / len(self.nameservers))
+            if answers:
+                break
+
+        addresses = []
+        ttls = []
+        rcodes = []
+        for qtype in [TYPE_A, TYPE_AAAA]:
+            if qtype in answers:
+                rcode, records = answers[qtype]
+                rcodes.append(rcode)
+                addresses += [(family, ip) for family, ip, ttl in records]
+                ttls += [ttl for family, ip, ttl in records]
+
+        if addresses:
+            return addresses, min(ttls)
+        elif not rcodes or set(rcodes) - set([0, RCODE_NXDOMAIN]):
+            # no answer in time or SERVFAIL
+            raise socket.gaierror(EAI_AGAIN, "Temporary failure in name resolution")
+        elif RCODE_NXDOMAIN in rcodes:
+            raise socket.gaierror(EAI_NONAME, "Name or service not known")
+        else:
+            raise socket.gaierror(EAI_NODATA, "No address associated with hostname")
+
+    def _query(self, nameserver, qname, timeout):
+        """Sends A and AAAA queries to the nameserver and waits for
+        the answers until the timeout.
+
+        Returns a dict mapping qtype to (rcode, records).
+        """
+        deadline = time.time() + timeout
+        family = socket.AF_INET6 if ":" in nameserver[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.connect(nameserver)
+            pending = {}
+            for qtype in [TYPE_A, TYPE_AAAA]:
+                qid = random.randint(0, 0xffff)
+                pending[qid] = qtype
+                sock.send(make_query(qid, qname, qtype))
+
+            answers = {}
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                r, _, _ = select.select([sock], [], [], remaining)
+                if not r:
+                    break
+                try:
+                    data = sock.recv(4096)
+                    qid, rcode, records = parse_response(data)
+                except socket.error, e:
+                    # ICMP port unreachable from the nameserver
+                    if e.errno == errno.ECONNREFUSED:
+                        break
+                    raise
+                except (ValueError, struct.error, IndexError):
+                    logging.warn("ignoring bad DNS response from %s", nameserver[0])
+                    continue
+                if qid in pending:
+                    answers[pending.pop(qid)] = (rcode, records)
+                    # Don't wait long for the other answer if we already have the addresses.
+                    # Some nameservers never answer AAAA queries.
+                    if records:
+                        deadline = min(deadline, time.time() + 0.1)
+            return answers
+        finally:
+            sock.close()
+
+def encode_name(name):
+    """Encodes the domain name in the DNS wire format.
+
+    Raises ValueError if the name is not a valid domain name.
+    """
+    name = name.decode("utf-8").encode("idna")
+    labels = name.split(".")
+    if not name or len(name) > 253 or [label for label in labels if not 0 < len(label) < 64]:
+        raise ValueError("invalid domain name: %r" % name)
+    return "".join(chr(len(label)) + label for label in labels) + "\0"
+
+def make_query(qid, qname, qtype):
+    """Makes a DNS query packet with recursion desired.
+    """
+    header = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+    return header + qname + struct.pack("!HH", qtype, 1)
+
+def _skip_name(data, offset):
+    """Returns the offset after the (possibly compressed) name starting at offset.
+    """
+    while True:
+        length = ord(data[offset])
+        if length == 0:
+            return offset + 1
+        elif length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def parse_response(data):
+    """Parses a DNS response and returns (qid, rcode, records).
+
+    Records is a list of (family, ip, ttl) for the A and AAAA records
+    in the answer section.
+    """
+    qid, flags, qdcount, ancount, nscount, arcount = struct.unpack("!HHHHHH", data[:12])
+    rcode = flags & 0xF
+
+    offset = 12
+    for i in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+
+    records = []
+    for i in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset+10])
+        offset += 10
+        rdata = data[offset:offset+rdlength]
+        offset += rdlength
+
+        if rtype == TYPE_A and rdlength == 4:
+            records.append((socket.AF_INET, socket.inet_ntop(socket.AF_INET, rdata), ttl))
+        elif rtype == TYPE_AAAA and rdlength == 16:
+            records.append((socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    return qid, rcode, records
+
+def read_nameservers(path):
+    """Returns the nameservers listed in the resolv.conf file.
+    """
+    if not os.path.exists(path):
+        return []
+    nameservers = []
+    for line in open(path):
+        tokens = line.split()
+        if len(tokens) >= 2 and tokens[0] == "nameserver":
+            nameservers.append(tokens[1])
+    return nameservers
+
+def read_hosts(path):
+    """Returns a dict mapping names in the hosts file to list of (family, ip).
+    """
+    hosts = {}
+    if not os.path.exists(path):
+        return hosts
+    for line in open(path):
+        tokens = line.split("#")[0].split()
+        if len(tokens) < 2:
+            continue
+        ip = tokens[0]
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        for name in tokens[1:]:
+            hosts.setdefault(name.lower(), []).append((family, ip))
+    return hosts
+
+def interleave_families(addrinfo):
+    """Reorders the addrinfo list so that the address families alternate.
+
+    The order of addresses within a family is kept and the family of
+    the first address comes first.
+    """
+    families = []
+    by_family = {}
+    for ai in addrinfo:
+        if ai[0] not in by_family:
+            families.append(ai[0])
+            by_family[ai[0]] = []
+        by_family[ai[0]].append(ai)
+
+    result = []
+    while len(result) < len(addrinfo):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+    return result
+
+def create_connection(address, timeout, source_address=None, getaddrinfo=None, attempt_delay=0.25):
+    """Works like socket.create_connection, but takes a getaddrinfo
+    function to resolve the host and races the connection attempts.
+
+    getaddrinfo is called with host and port and must return a list of
+    addrinfo tuples for SOCK_STREAM sockets.
+
+    Instead of waiting for the timeout on each address that doesn't
+    respond, a new attempt to the next address is started every
+    attempt_delay seconds, or as soon as an attempt fails. The address
+    families are alternated, so that broken IPv6 connectivity doesn't
+    delay the connection. The first connection established is returned
+    and the other attempts are abandoned. Each attempt can take up to
+    timeout seconds.
+    """
+    host, port = address
+    if getaddrinfo is None:
+        addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    else:
+        addrinfo = getaddrinfo(host, port)
+
+    if not addrinfo:
+        raise socket.error("getaddrinfo returns an empty list")
+
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+
+    addrinfo = interleave_families(addrinfo)
+    poll = select.poll()
+    # fd -> (socket, sockaddr, start time)
+    pending = {}
+    err = None
+    next_attempt = time.time()
+
+    try:
+        while addrinfo or pending:
+            now = time.time()
+            if addrinfo and (now >= next_attempt or not pending):
+                af, socktype, proto, canonname, sa = addrinfo.pop(0)
+                next_attempt = now + attempt_delay
+                try:
+                    sock = _start_connect(af, socktype, proto, sa, source_address)
+                except socket.error, e:
+                    _log_attempt(host, sa, now, e)
+                    err = e
+                    continue
+                pending[sock.fileno()] = (sock, sa, now)
+                poll.register(sock, select.POLLOUT)
+
+            # wait till the next attempt is due or the oldest attempt times out
+            wait_until = []
+            if addrinfo:
+                wait_until.append(next_attempt)
+            if timeout is not None:
+                wait_until.append(min(start for _, _, start in pending.values()) + timeout)
+            if wait_until:
+                wait = max(0, min(wait_until) - time.time()) * 1000
+            else:
+                wait = None
+
+            try:
+                events = poll.poll(wait)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+
+            for fd, event in events:
+                sock, sa, start = pending.pop(fd)
+                poll.unregister(fd)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    _log_attempt(host, sa, start)
+                    sock.settimeout(timeout)
+                    return sock
+                sock.close()
+                err = socket.error(code, os.strerror(code))
+                _log_attempt(host, sa, start, err)
+                # start the next attempt right away
+                next_attempt = time.time()
+
+            if timeout is not None:
+                now = time.time()
+                for fd, (sock, sa, start) in pending.items():
+                    if now - start >= timeout:
+                        del pending[fd]
+                        poll.unregister(fd)
+                        sock.close()
+                        err = socket.timeout("timed out")
+                        _log_attempt(host, sa, start, err)
+    finally:
+        # abandon the attempts still in progress
+        for sock, sa, start in pending.values():
+            sock.close()
+
+    raise err
+
+def _start_connect(af, socktype, proto, sa, source_address):
+    """Creates a non-blocking socket and starts connecting it to sa.
+    """
+    sock = socket.socket(af, socktype, proto)
+    try:
+        if source_address:
+            sock.bind(source_address)
+        sock.setblocking(0)
+        code = sock.connect_ex(sa)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(code, os.strerror(code))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def _log_attempt(host, sa, start, err=None):
+    status = err and "failed (%s)" % err or "succeeded"
+    logging.debug("connect to %s (%s) %s in %.3fs", host, sa[0], status, time.time() - start)
@@ -0,0 +1,81 @@
+"""Coalescing of concurrent calls for the same key.
+"""
+
+import sys
+import threading
+
+class _Call:
+    """A call in flight.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight:
+    """Makes sure that only one call per key is in flight at a time.
+
+    Callers asking for a key that is already being computed wait for
+    the call in flight to finish and get its result instead of making
+    a call of their own.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) and returns its result, unless a
+        call for the same key is already in flight, in which case that
+        call's result is returned.
+
+        If the call raises an exception, it is raised in all the
+        waiting callers too.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            result = func(*args, **kwargs)
+        except:
+            self.end(key, exc_info=sys.exc_info())
+            raise
+        self.end(key, result)
+        return result
+
+    def begin(self, key):
+        """Marks a call for the key as in flight, for calls that are
+        not made by `do`, unless one already is.
+
+        Returns False if a call for the key is already in flight.
+        Otherwise the caller must call `end` once the result is known,
+        which is then returned to the callers of `do` in the meanwhile.
+        """
+        with self._lock:
+            if key in self._calls:
+                return False
+            self._calls[key] = _Call()
+            return True
+
+    def end(self, key, result=None, exc_info=None):
+        """Ends the call in flight for the key, with its result or the
+        exc_info of the exception it raised.
+        """
+        with self._lock:
+            call = self._calls.pop(key)
+        call.result = result
+        call.exc_info = exc_info
+        call.done.set()
+
+    def in_flight(self):
+        """Returns the number of calls in flight.
+        """
+        return len(self._calls)
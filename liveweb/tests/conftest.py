@@ -42,3 +42,102 @@ def pytest_funcarg__webtest(request):
             time.sleep(0.1)
 
     return x
+
+def pytest_funcarg__keepalive_server(request):
+    """Starts an HTTP/1.1 server, that keeps the connections alive, in a background thread.
+
+    The responses have an ETag and conditional requests get 304 Not Modified.
+    """
+    return _start_keepalive_server(request)
+
+def pytest_funcarg__tls_server(request):
+    """Starts the keepalive server over TLS with a self-signed certificate.
+
+    The certificate is available as tls_server.certfile.
+    """
+    import pytest
+    import ssl
+    tmpdir = request.getfuncargvalue("tmpdir")
+    certfile = tmpdir.join("cert.pem").strpath
+    keyfile = tmpdir.join("key.pem").strpath
+    try:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                               "-keyout", keyfile, "-out", certfile, "-days", "1",
+                               "-subj", "/CN=localhost"],
+                              stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    except OSError:
+        pytest.skip("openssl is not available")
+
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.load_cert_chain(certfile, keyfile)
+    server = _start_keepalive_server(request, context)
+    server.url = server.url.replace("http://", "https://")
+    server.certfile = certfile
+    return server
+
+def _start_keepalive_server(request, ssl_context=None):
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+
+        def do_GET(self):
+            # /delay/<seconds> sleeps before responding
+            if self.path.startswith("/delay/"):
+                time.sleep(float(self.path[len("/delay/"):]))
+
+            body = "hello, world!\n"
+            etag = '"hello"'
+            if self.headers.get("If-None-Match") == etag:
+                self.server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def get_request(self):
+            sock, addr = self.socket.accept()
+            if ssl_context:
+                sock = ssl_context.wrap_socket(sock, server_side=True)
+            return sock, addr
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.connections = 0
+    server.not_modified = 0
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    request.addfinalizer(server.shutdown)
+    return server
+
+def pytest_funcarg__dnsserver(request):
+    """Starts a stand-in DNS server in a background thread.
+
+    The test can add records to dnsserver.records and names to dnsserver.ignore.
+    """
+    from .dnsserver import DNSServer
+    server = DNSServer()
+    server.start()
+    request.addfinalizer(server.stop)
+    return server
@@ -0,0 +1,83 @@
+"""Stand-in DNS server to test the stub resolver.
+
+Answers A and AAAA queries from a dict of records. Names that are not
+in the records get NXDOMAIN and the names in the ignore list get no
+answer at all, to simulate DNS timeouts.
+"""
+
+import socket
+import struct
+import threading
+
+class DNSServer:
+    def __init__(self, records=None, ignore=None, ttl=60):
+        """Creates a new DNS server listening on a random UDP port on localhost.
+
+        :param records: dict mapping names to list of IP addresses
+        :param ignore: list of names for which the queries are not answered
+        :param ttl: TTL of the records in the answers
+        """
+        self.records = records or {}
+        self.ignore = ignore or []
+        self.ttl = ttl
+        self.queries = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.sock.close()
+
+    def serve_forever(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.error:
+                # socket closed
+                break
+            response = self.handle_query(data)
+            if response:
+                self.sock.sendto(response, addr)
+
+    def handle_query(self, data):
+        qid, flags, qdcount = struct.unpack("!HHH", data[:6])
+
+        # read the qname
+        labels = []
+        offset = 12
+        while ord(data[offset]):
+            length = ord(data[offset])
+            labels.append(data[offset+1:offset+1+length])
+            offset += length + 1
+        offset += 1
+        qtype, qclass = struct.unpack("!HH", data[offset:offset+4])
+        question = data[12:offset+4]
+
+        name = ".".join(labels)
+        self.queries.append((name, qtype))
+
+        if name in self.ignore:
+            return None
+
+        if name not in self.records:
+            header = struct.pack("!HHHHHH", qid, 0x8183, 1, 0, 0, 0)
+            return header + question
+
+        answers = []
+        for ip in self.records[name]:
+            family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+            rtype = 28 if family == socket.AF_INET6 else 1
+            if rtype != qtype:
+                continue
+            rdata = socket.inet_pton(family, ip)
+            # 0xc00c is a pointer to the qname in the question
+            answers.append(struct.pack("!HHHIH", 0xc00c, rtype, 1, self.ttl, len(rdata)) + rdata)
+
+        header = struct.pack("!HHHHHH", qid, 0x8180, 1, len(answers), 0, 0)
+        return header + question + "".join(answers)
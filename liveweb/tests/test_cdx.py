@@ -0,0 +1,33 @@
+import datetime
+import os
+
+from .. import cdx
+
+def test_surt():
+    assert cdx.surt("http://www.example.com/") == "com,example)/"
+    assert cdx.surt("http://Example.COM") == "com,example)/"
+    assert cdx.surt("https://www2.example.com:443/a/B.html") == "com,example)/a/b.html"
+    assert cdx.surt("http://foo.example.com:8080/x?b=2&a=1") == "com,example,foo:8080)/x?a=1&b=2"
+    assert cdx.surt("http://user@example.com/") == "com,example)/"
+
+def test_format_line():
+    date = datetime.datetime(2012, 5, 1, 10, 20, 30)
+    entry = cdx.make_entry("http://example.com/a b", date, "text/html; charset=utf-8", 200, "ABCD", 123)
+    line = cdx.format_line(entry, 456, "/tmp/partial/foo.warc.gz")
+    assert line == "com,example)/a%20b 20120501102030 http://example.com/a%20b text/html;charset=utf-8 200 ABCD - - 123 456 foo.warc.gz\n"
+
+    entry = cdx.make_entry("http://example.com/", date, "", 502, None, 10)
+    assert cdx.format_line(entry, 0, "foo.arc.gz").split()[3:6] == ["-", "502", "-"]
+
+def test_sort_file(tmpdir):
+    src = tmpdir.join("a.cdx").strpath
+    dest = tmpdir.join("b.cdx").strpath
+    with open(src, "w") as f:
+        f.write(cdx.CDX_HEADER)
+        f.write("org,example)/ 2\n")
+        f.write("com,example)/b 1\n")
+        f.write("com,example)/a 3\n")
+
+    cdx.sort_file(src, dest)
+    assert open(dest).read() == cdx.CDX_HEADER + "com,example)/a 3\ncom,example)/b 1\norg,example)/ 2\n"
+    assert not os.path.exists(dest + ".tmp")
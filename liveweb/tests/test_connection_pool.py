@@ -0,0 +1,82 @@
+import time
+
+from ..connection_pool import ConnectionPool
+
+class DummyConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+KEY = ("http", "example.com", 80)
+
+def test_get_put():
+    pool = ConnectionPool(max_per_host=2)
+    assert pool.get(KEY) is None
+
+    conn = DummyConnection()
+    pool.put(KEY, conn)
+    assert pool.get(KEY) is conn
+
+    # the connection is taken out of the pool
+    assert pool.get(KEY) is None
+
+    # different host
+    pool.put(KEY, conn)
+    assert pool.get(("https", "example.com", 443)) is None
+
+def test_max_per_host():
+    pool = ConnectionPool(max_per_host=2)
+    conns = [DummyConnection() for i in range(3)]
+    for c in conns:
+        pool.put(KEY, c)
+
+    # the extra connection should be closed
+    assert [c.closed for c in conns] == [False, False, True]
+
+    assert pool.get(KEY) is conns[1]
+    assert pool.get(KEY) is conns[0]
+    assert pool.get(KEY) is None
+
+def test_idle_timeout(monkeypatch):
+    pool = ConnectionPool(max_per_host=2, idle_timeout=10)
+    conn = DummyConnection()
+    pool.put(KEY, conn)
+
+    t = time.time() + 11
+    monkeypatch.setattr(time, "time", lambda: t)
+
+    assert pool.get(KEY) is None
+    assert conn.closed
+
+def test_close():
+    pool = ConnectionPool()
+    conn = DummyConnection()
+    pool.put(KEY, conn)
+    pool.close()
+    assert conn.closed
+    assert pool.get(KEY) is None
+
+def test_max_idle():
+    pool = ConnectionPool(max_per_host=2, max_idle=2)
+    conns = [DummyConnection() for i in range(3)]
+    for i, c in enumerate(conns):
+        pool.put(("http", "example%d.com" % i, 80), c)
+
+    # the connection idle for the longest time is closed
+    assert [c.closed for c in conns] == [True, False, False]
+    assert pool.get(("http", "example0.com", 80)) is None
+    assert pool.get(("http", "example2.com", 80)) is conns[2]
+
+def test_sweeper():
+    # the connections to hosts that are never fetched again are closed too
+    pool = ConnectionPool(idle_timeout=0.1)
+    conn = DummyConnection()
+    pool.put(KEY, conn)
+
+    deadline = time.time() + 5
+    while not conn.closed and time.time() < deadline:
+        time.sleep(0.05)
+    assert conn.closed
+    assert pool._idle == {}
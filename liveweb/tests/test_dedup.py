@@ -0,0 +1,43 @@
+import time
+
+from .. import dedup
+
+CAPTURE = {
+    "url": "http://example.com/logo.png",
+    "date": "2012-06-12T10:12:39Z",
+    "record_id": "<urn:uuid:5c3b1c2e-b48e-11e1-a1b2-001e4f36d5e3>",
+    "filename": "/tmp/records/live-1.warc.gz",
+    "offset": 1234,
+    "content_length": 5678
+}
+
+class TestSqliteDigestIndex:
+    def test_get_set(self, tmpdir):
+        index = dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath)
+        assert index.get("sha1:AAAA") is None
+
+        index.set("sha1:AAAA", CAPTURE)
+        assert index.get("sha1:AAAA") == CAPTURE
+        assert isinstance(index.get("sha1:AAAA")["url"], str)
+
+        # the latest capture replaces the old one
+        index.set("sha1:AAAA", dict(CAPTURE, offset=4321))
+        assert index.get("sha1:AAAA")["offset"] == 4321
+
+    def test_expire(self, tmpdir, monkeypatch):
+        t = time.time()
+        monkeypatch.setattr(time, "time", lambda: t)
+
+        index = dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath, expire_time=60)
+        index.set("sha1:AAAA", CAPTURE)
+
+        t += 30
+        assert index.get("sha1:AAAA") == CAPTURE
+        t += 60
+        assert index.get("sha1:AAAA") is None
+
+def test_stats(tmpdir):
+    index = dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath)
+    index.revisited(1000)
+    index.revisited(500)
+    assert index.stats() == dict(revisits=2, bytes_saved=1500)
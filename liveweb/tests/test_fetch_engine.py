@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+from .. import proxy, config
+from ..fetch_engine import FetchEngine
+
+def pytest_funcarg__engine(request):
+    engine = FetchEngine()
+    engine.start()
+    request.addfinalizer(engine.stop)
+    return engine
+
+def test_fetch(engine, webtest):
+    response = engine.fetch(webtest.url + "/echo/hello?repeats=3")
+    assert response.status == 200
+    assert "".join(response.get_payload()) == "hello\n" * 3
+    assert response.remoteip == "127.0.0.1"
+
+    arc = response._make_arc_record()
+    assert arc.header.length == len(response.buf.getvalue())
+
+def test_concurrent(engine, keepalive_server):
+    t0 = time.time()
+    fetches = [engine.submit(keepalive_server.url + "/delay/0.5") for i in range(10)]
+    responses = [f.wait() for f in fetches]
+    assert [r.status for r in responses] == [200] * 10
+
+    # fetching them one after another would take at least 5 seconds
+    assert time.time() - t0 < 2
+
+def test_on_done(engine, webtest):
+    import Queue
+    done = Queue.Queue()
+    fetches = [engine.submit(webtest.url + "/echo/hello", on_done=done.put) for i in range(3)]
+    completed = [done.get(timeout=5) for i in range(3)]
+    assert sorted(completed) == sorted(fetches)
+    assert [f.wait(0).status for f in completed] == [200] * 3
+
+class TestErrors:
+    def verify(self, engine, err, url):
+        with pytest.raises(proxy.ProxyError) as excinfo:
+            engine.fetch(url)
+        e = excinfo.value
+        assert (e.errcode, e.errmsg) == err
+
+    def test_invalid_url(self, engine):
+        self.verify(engine, proxy.ERR_INVALID_URL, "http://localhost:foo/")
+
+    def test_invalid_domain(self, engine):
+        self.verify(engine, proxy.ERR_INVALID_DOMAIN, "http://invalid.com2/")
+
+    def test_conn_refused(self, engine):
+        self.verify(engine, proxy.ERR_CONN_REFUSED, "http://localhost:1234/")
+
+    def test_initial_data_timeout(self, monkeypatch, engine, webtest):
+        monkeypatch.setattr(config, "initial_data_timeout", 0.1)
+        self.verify(engine, proxy.ERR_INITIAL_DATA_TIMEOUT, webtest.url + "/delay-headers/0.3")
+
+    def test_read_timeout(self, monkeypatch, engine, webtest):
+        monkeypatch.setattr(config, "read_timeout", 0.1)
+        self.verify(engine, proxy.ERR_READ_TIMEOUT, webtest.url + "/delay/0.3?repeats=2")
+
+    def test_conn_dropped(self, engine, webtest):
+        self.verify(engine, proxy.ERR_CONN_DROPPED, webtest.url + "/drop")
+
+    def test_response_too_big(self, monkeypatch, engine, webtest):
+        monkeypatch.setattr(config, "max_response_size", 1000)
+        engine.fetch(webtest.url + "/echo/helloworld?repeats=50")
+        self.verify(engine, proxy.ERR_RESPONSE_TOO_BIG, webtest.url + "/echo/helloworld?repeats=100")
+
+    def test_request_took_too_long(self, monkeypatch, engine, webtest):
+        monkeypatch.setattr(config, "max_request_time", 0.1)
+        self.verify(engine, proxy.ERR_REQUEST_TIMEOUT, webtest.url + "/echo/helloworld?repeats=20&delay=0.02")
+
+    def test_socket_error(self, monkeypatch, engine, webtest):
+        # e.g. EMFILE when the process is out of file descriptors
+        import errno
+        import socket
+        from .. import fetch_engine
+
+        def create_socket(self, family, type):
+            raise socket.error(errno.EMFILE, "Too many open files")
+        monkeypatch.setattr(fetch_engine.Fetch, "create_socket", create_socket)
+        self.verify(engine, proxy.ERR_CONN_MISC, webtest.url + "/echo/hello")
+
+        # the event-loop is still running
+        monkeypatch.undo()
+        assert engine._thread.is_alive()
+        assert engine.fetch(webtest.url + "/echo/hello").status == 200
+
+    def test_wait_timeout(self, monkeypatch, webtest):
+        from .. import fetch_engine
+        monkeypatch.setattr(config, "max_request_time", 0.1)
+        monkeypatch.setattr(fetch_engine, "WAIT_MARGIN", 0.1)
+
+        # the event-loop is not running
+        self.verify(fetch_engine.FetchEngine(), proxy.ERR_REQUEST_TIMEOUT, webtest.url + "/echo/hello")
+
+def test_dead_address(monkeypatch, engine, webtest):
+    from .test_resolver import blackhole_address, addrinfo
+    socks, dead = blackhole_address()
+    good = ("127.0.0.1", webtest.port)
+    monkeypatch.setattr(proxy, "getaddrinfo", lambda host, port: addrinfo(dead, good))
+    monkeypatch.setattr(config, "connect_timeout", 0.3)
+
+    # the second address is tried once the first one times out
+    response = engine.fetch(webtest.url + "/echo/hello")
+    assert response.status == 200
+    assert response.remoteip == "127.0.0.1"
+
+def test_big_response(engine, webtest):
+    # big responses are spooled to a temp file
+    fetch = engine.submit(webtest.url + "/echo/%s?repeats=%d" % ("x" * 99, 20000))
+    response = fetch.wait()
+    assert not fetch.buf.in_memory()
+    assert "".join(response.get_payload()) == ("x" * 99 + "\n") * 20000
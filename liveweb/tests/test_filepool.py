@@ -18,7 +18,7 @@ def test_creation(pooldir):
         pool.get_file()
 
     # Get files in pool directory.
-    pool_files = set(glob.glob(pooldir + "/partial/*"))
+    pool_files = set(glob.glob(pooldir + "/partial/test-?????"))
 
     # Check if this is the same as what we expect
     expected_files = set(["%s/partial/test-%05d"%(pooldir,x) for x in range(0,10)])
@@ -71,6 +71,9 @@ def test_max_file_size(pooldir):
     # queue should have all Nones now.
     assert list(pool.queue.queue) == [None] * 10
 
+    # the file is moved to complete/ by the finalizer thread
+    pool.wait_completed()
+
     complete_files = set(glob.glob(pooldir + "/complete/*"))
     expected_complete_files = set(("%s/complete/test-%05d"%(pooldir,0),))
     assert expected_complete_files == complete_files
@@ -112,3 +115,310 @@ def test_member_file_context(pooldir):
     pool.close()
 
     assert open(name).read() == "Hello"
+
+def test_append(pooldir):
+    """
+    Tests that the data appended from many threads is written in
+    batches and the location of each one is returned.
+    """
+    import threading
+    from ..file_pool import FilePool
+
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_files = 2)
+
+    results = {}
+    def append(i):
+        results[i] = pool.append("record-%d;" % i)
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for i, (filename, offset, length) in results.items():
+        f = open(filename)
+        f.seek(offset)
+        assert f.read(length) == "record-%d;" % i
+
+    pool.close()
+    assert len(set(filename for filename, offset, length in results.values())) <= 2
+
+def test_durability_group(pooldir, monkeypatch):
+    """
+    Tests that append returns only after fsync in group mode.
+    """
+    import threading
+    from .. import file_pool
+
+    synced = []
+    fsync = os.fsync
+    def fake_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(file_pool.os, "fsync", fake_fsync)
+
+    pool = file_pool.FilePool(pooldir, pattern = "test-%(serial)05d", durability = "group")
+    results = []
+    def append(i):
+        filename, offset, length = pool.append("record-%d;" % i)
+        f = pool._files.copy().pop()
+        results.append(f.durable_size >= offset + length)
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [True] * 20
+    assert 1 <= len(synced) <= 20
+
+def test_durability_periodic(pooldir):
+    """
+    Tests that append doesn't wait for the periodic sync and that
+    when_durable is called only after it.
+    """
+    import threading
+    from .. import file_pool
+
+    pool = file_pool.FilePool(pooldir, pattern = "test-%(serial)05d", durability = "periodic", sync_interval = 0.2)
+    filename, offset, length = pool.append("hello")
+    f = pool._files.copy().pop()
+    assert f.durable_size < offset + length
+
+    called = threading.Event()
+    sizes = []
+    def durable():
+        sizes.append(f.durable_size)
+        called.set()
+    pool.when_durable(durable)
+    assert sizes == []
+
+    called.wait(2)
+    assert sizes and sizes[0] >= offset + length
+
+    # what is left is called when the pool is closed
+    pool.append("world")
+    pool.when_durable(lambda: sizes.append(f.durable_size))
+    pool.close()
+    assert sizes[-1] == offset + length + 5
+
+def test_durability_on_rotate(pooldir, monkeypatch):
+    """
+    Tests that the files are synced when they are complete.
+    """
+    from .. import file_pool
+
+    synced = []
+    monkeypatch.setattr(file_pool.os, "fsync", synced.append)
+
+    pool = file_pool.FilePool(pooldir, pattern = "test-%(serial)05d", max_file_size = 10, durability = "on-rotate")
+    pool.append("hello")
+    assert synced == []
+
+    pool.append("test" * 100)
+    pool.wait_completed()
+    assert len(synced) == 1
+
+def test_shards(pooldir):
+    """
+    Tests that each thread writes to its own file in sharded mode and
+    the files are rotated when they are full.
+    """
+    import threading
+    from ..file_pool import FilePool
+
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_file_size = 100, shards = 4)
+
+    results = {}
+    def append(i):
+        results[i] = [pool.append("record-%d;" % i) for j in range(5)]
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    filenames = [set(name for name, offset, length in r) for r in results.values()]
+    assert [len(names) for names in filenames] == [1] * 4
+    assert len(set.union(*filenames)) == 4
+
+    pool.close()
+    for i, r in results.items():
+        for name, offset, length in r:
+            f = open(pool.locate(name))
+            f.seek(offset)
+            assert f.read(length) == "record-%d;" % i
+
+    # the file is complete after 100 bytes
+    pool = FilePool(pooldir, pattern = "test2-%(serial)05d", max_file_size = 100, shards = 1)
+    for i in range(8):
+        pool.append("x" * 20)
+    pool.wait_completed()
+    assert len(glob.glob(pooldir + "/complete/test2-*")) == 1
+    assert len(glob.glob(pooldir + "/partial/test2-?????")) == 1
+
+def test_member_file(tmpdir):
+    """
+    Tests that MemberFile tracks the offsets and releases the
+    preallocated space when closed.
+    """
+    from ..file_pool import MemberFile
+
+    path = tmpdir.join("test").strpath
+    f = MemberFile(path, None, preallocate_size=1024*1024)
+    f.write("hello")
+    f.write("world")
+    assert f.tell() == 10
+    assert os.path.getsize(path) == 10
+    if f.preallocated:
+        assert os.stat(path).st_blocks * 512 >= 1024*1024
+
+    f.close()
+    assert open(path).read() == "helloworld"
+    assert os.stat(path).st_blocks * 512 < 1024*1024
+
+    # reopening continues at the end of the file
+    f = MemberFile(path, None)
+    assert f.tell() == 10
+    f.write("!")
+    f.close()
+    assert open(path).read() == "helloworld!"
+
+def test_max_file_age(pooldir):
+    """
+    Tests that the old files are completed even when nothing is
+    written to them and that the completion hooks are called.
+    """
+    import time
+    from ..file_pool import FilePool
+
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_files = 2, max_file_age = 0.2)
+    completed = []
+    pool.add_completion_hook(completed.append)
+
+    filename, offset, length = pool.append("hello")
+    assert os.path.exists(filename)
+
+    deadline = time.time() + 5
+    while not completed and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert completed == [pooldir + "/complete/" + os.path.basename(filename)]
+    assert open(completed[0]).read() == "hello"
+    assert not os.path.exists(filename)
+
+    # a new file is created for the next record
+    assert pool.append("world")[0] != filename
+    pool.close()
+
+def test_index(pooldir):
+    """
+    Tests that the CDX lines of the records are written to the index
+    of the file, which is sorted and moved to complete/ with the file.
+    """
+    import datetime
+    from .. import cdx
+    from ..file_pool import FilePool
+
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_files = 1, max_file_size = 15, index = True)
+    date = datetime.datetime(2012, 5, 1)
+
+    filename, offset, length = pool.append("hello", cdx.make_entry("http://b.com/", date, "text/plain", 200, None, 5))
+    assert open(filename + ".cdx").read() == cdx.CDX_HEADER + \
+        "com,b)/ 20120501000000 http://b.com/ text/plain 200 - - - 5 0 test-00000\n"
+
+    with pool.get_file() as f:
+        f.write("world")
+        f.add_index([(cdx.make_entry("http://a.com/", date, "text/plain", 200, None, 5), 5)])
+    pool.append("!!!!!", cdx.make_entry("http://c.com/", date, "text/plain", 200, None, 5))
+    pool.wait_completed()
+
+    complete_name = pooldir + "/complete/test-00000"
+    assert open(complete_name).read() == "helloworld!!!!!"
+    assert not os.path.exists(filename + ".cdx")
+    assert open(complete_name + ".cdx").read() == cdx.CDX_HEADER + \
+        "com,a)/ 20120501000000 http://a.com/ text/plain 200 - - - 5 5 test-00000\n" + \
+        "com,b)/ 20120501000000 http://b.com/ text/plain 200 - - - 5 0 test-00000\n" + \
+        "com,c)/ 20120501000000 http://c.com/ text/plain 200 - - - 5 10 test-00000\n"
+    pool.close()
+
+def test_recover(pooldir):
+    """
+    Tests that the files left in partial/ are cut at the last complete
+    gzip member and moved to complete/ with their index, and that the
+    files still being written are left alone.
+    """
+    import datetime
+    import gzip
+    from .. import cdx
+    from ..filetools import GzipMember
+    from ..file_pool import FilePool
+
+    def member(text):
+        f = GzipMember()
+        f.write(text)
+        f.close()
+        return f.getvalue()
+
+    date = datetime.datetime(2012, 5, 1)
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_files = 1, index = True)
+    for i in range(3):
+        data = member("record %d" % i)
+        filename, offset, length = pool.append(data, cdx.make_entry("http://example.com/%d" % i, date, "text/plain", 200, None, len(data)))
+    pool.close()
+    size = os.path.getsize(filename)
+    assert open(filename + ".offsets").read().splitlines()[-1] == str(size)
+
+    # crash while writing the next record
+    torn = member("record 3")
+    with open(filename, "ab") as f:
+        f.write(torn[:10])
+    with open(filename + ".cdx", "a") as f:
+        f.write(cdx.format_line(cdx.make_entry("http://example.com/3", date, "text/plain", 200, None, len(torn)), size, filename))
+
+    # a file of a running process
+    pool2 = FilePool(pooldir, pattern = "test2-%(serial)05d", max_files = 1)
+    filename2 = pool2.append(member("hello"))[0]
+
+    recovered = []
+    pool3 = FilePool(pooldir, pattern = "test3-%(serial)05d")
+    pool3.add_completion_hook(recovered.append)
+    assert pool3.recover() == recovered == [pooldir + "/complete/test-00000"]
+
+    complete_name = recovered[0]
+    assert os.path.getsize(complete_name) == size
+    assert gzip.open(complete_name).read() == "record 0record 1record 2"
+    lines = open(complete_name + ".cdx").read().splitlines()
+    assert [line.split()[2] for line in lines[1:]] == ["http://example.com/0", "http://example.com/1", "http://example.com/2"]
+    assert sorted(os.listdir(pooldir + "/partial")) == ["test2-00000", "test2-00000.offsets"]
+
+    pool2.close()
+
+def test_recover_without_journal(pooldir):
+    """
+    Tests that the files are recovered by reading all the gzip members
+    when the journal is lost.
+    """
+    import gzip
+    from ..filetools import GzipMember
+    from ..file_pool import FilePool
+
+    pool = FilePool(pooldir, pattern = "test-%(serial)05d", max_files = 1)
+    for text in ["hello", "world"]:
+        f = GzipMember(pool.get_file())
+        f.write(text)
+        f.close()
+        pool.return_file(f.fileobj)
+    filename = f.fileobj.name
+    pool.close()
+
+    os.remove(filename + ".offsets")
+    with open(filename, "ab") as f:
+        f.write("garbage")
+
+    assert FilePool(pooldir).recover() == [pooldir + "/complete/test-00000"]
+    assert gzip.open(pooldir + "/complete/test-00000").read() == "helloworld"
+    assert os.listdir(pooldir + "/partial") == []
@@ -50,3 +50,56 @@ def test_fileiter():
     # what if we ask for more data than we have?
     f = StringIO("helloworld" + "helloworld" + "end")
     assert list(filetools.fileiter(f, 40, chunk_size=10)) == ["helloworld", "helloworld", "end"]
+
+class TestGzipMember:
+    def decompress(self, data):
+        import gzip
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_memory(self):
+        f = filetools.GzipMember()
+        f.write("hello ")
+        f.write("world")
+        f.close()
+        data = f.getvalue()
+        assert f.size == len(data)
+        assert self.decompress(data) == "hello world"
+
+    def test_fileobj(self):
+        # members written one after the other make a valid gzip file
+        fileobj = StringIO()
+        for text in ["foo", "bar" * 1000]:
+            f = filetools.GzipMember(fileobj, level=1)
+            f.write(text)
+            f.close()
+        assert self.decompress(fileobj.getvalue()) == "foo" + "bar" * 1000
+
+    def test_level(self):
+        text = " ".join(str(i * i) for i in range(10000))
+        sizes = []
+        for level in [1, 9]:
+            f = filetools.GzipMember(level=level)
+            f.write(text)
+            f.close()
+            assert self.decompress(f.getvalue()) == text
+            sizes.append(f.size)
+        assert sizes[0] > sizes[1]
+
+def test_find_members_end():
+    members = []
+    for text in ["foo", "bar" * 100000, ""]:
+        f = filetools.GzipMember()
+        f.write(text)
+        f.close()
+        members.append(f.getvalue())
+    data = "".join(members)
+    ends = [len("".join(members[:i])) for i in range(len(members) + 1)]
+
+    assert filetools.find_members_end(StringIO(data)) == len(data)
+    assert filetools.find_members_end(StringIO(data), offset=ends[1]) == len(data)
+    assert filetools.find_members_end(StringIO(data + "\0" * 100)) == len(data)
+
+    # the members cut short are left out
+    for size in range(len(data)):
+        expected = max(end for end in ends if end <= size)
+        assert filetools.find_members_end(StringIO(data[:size]), chunk_size=16) == expected
@@ -0,0 +1,50 @@
+import threading
+import time
+
+from ..host_limiter import HostLimiter
+
+def test_limit():
+    limiter = HostLimiter(max_per_host=2, queue_timeout=0.1)
+    assert limiter.acquire("a.com")
+    assert limiter.acquire("a.com")
+    assert limiter.acquire("b.com")
+    assert limiter.in_flight("a.com") == 2
+
+    t0 = time.time()
+    assert not limiter.acquire("a.com")
+    assert time.time() - t0 >= 0.1
+    assert limiter.waiting("a.com") == 0
+
+    limiter.release("a.com")
+    assert limiter.acquire("a.com")
+
+    for host in ["a.com", "a.com", "b.com"]:
+        limiter.release(host)
+    assert limiter.in_flight("a.com") == 0
+    assert limiter.in_flight("b.com") == 0
+
+def test_fifo():
+    limiter = HostLimiter(max_per_host=1, queue_timeout=5)
+    limiter.acquire("a.com")
+
+    order = []
+    def fetch(i):
+        limiter.acquire("a.com")
+        order.append(i)
+        limiter.release("a.com")
+
+    threads = []
+    for i in range(5):
+        t = threading.Thread(target=fetch, args=(i,))
+        t.start()
+        threads.append(t)
+        # make sure the threads get queued in order
+        while limiter.waiting("a.com") < i + 1:
+            time.sleep(0.01)
+
+    limiter.release("a.com")
+    for t in threads:
+        t.join()
+
+    assert order == range(5)
+    assert limiter.in_flight("a.com") == 0
@@ -0,0 +1,120 @@
+import httplib
+
+import pytest
+
+from .. import httpparse
+
+HEAD = "\r\n".join([
+    "HTTP/1.1 200 OK",
+    "Content-Type: text/html; charset=UTF-8",
+    "Set-Cookie: a=1",
+    "Set-Cookie: b=2",
+    "X-Long: foo",
+    "  bar",
+    "Content-Length: 5",
+    "", ""])
+
+def parse(data, blocksize=None):
+    parser = httpparse.ResponseHeadParser()
+    blocksize = blocksize or max(len(data), 1)
+    for i in range(0, len(data), blocksize):
+        if parser.feed(data[i:i+blocksize]):
+            return parser
+    parser.feed_eof()
+
+class TestResponseHeadParser:
+    def test_parse(self):
+        parser = parse(HEAD + "hello")
+        head = parser.head
+        assert (head.version, head.status, head.reason) == (11, 200, "OK")
+        assert head.content_type == "text/html"
+        assert head.content_length == 5
+        assert head.chunked is False
+        assert head.getheader("set-cookie") == "a=1, b=2"
+        assert head.getheader("X-LONG") == "foo bar"
+        assert parser.head_data == HEAD
+        assert parser.rest == "hello"
+
+    def test_blocks(self):
+        # the end of headers can be split across blocks
+        for blocksize in [1, 2, 3, 7]:
+            parser = parse(HEAD + "hello", blocksize)
+            assert parser.head_data == HEAD
+            assert parser.head.getheaders() == parse(HEAD).head.getheaders()
+
+    def test_lf_only(self):
+        parser = parse("HTTP/1.0 404 Not Found\nContent-Type: text/plain\n\nhello")
+        assert (parser.head.version, parser.head.status) == (10, 404)
+        assert parser.rest == "hello"
+
+    def test_continue(self):
+        data = "HTTP/1.1 100 Continue\r\n\r\n" + HEAD
+        parser = parse(data, 10)
+        assert parser.head.status == 200
+        assert parser.head_data == data
+
+    def test_http09(self):
+        parser = parse("<html>hello</html>")
+        assert (parser.head.version, parser.head.status) == (9, 200)
+        assert parser.head_data == ""
+        assert parser.rest == "<html>hello</html>"
+
+    def test_bad_status(self):
+        with pytest.raises(httplib.BadStatusLine):
+            parse("HTTP/1.1 OK\r\n\r\n")
+        with pytest.raises(httplib.UnknownProtocol):
+            parse("HTTP/2.0 200 OK\r\n\r\n")
+
+    def test_eof(self):
+        with pytest.raises(httplib.BadStatusLine):
+            parse("")
+        with pytest.raises(httplib.BadStatusLine):
+            parse("HTTP/1.1 200 OK\r\nServer: foo\r\n")
+
+    def test_chunked(self):
+        head = parse("HTTP/1.1 200 OK\r\nContent-Length: 10\r\nTransfer-Encoding: Chunked\r\n\r\n").head
+        assert head.chunked is True
+        assert head.content_length is None
+
+    def test_will_close(self):
+        assert parse("HTTP/1.1 200 OK\r\n\r\n").head.will_close() is False
+        assert parse("HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n").head.will_close() is True
+        assert parse("HTTP/1.0 200 OK\r\n\r\n").head.will_close() is True
+        assert parse("HTTP/1.0 200 OK\r\nConnection: Keep-Alive\r\n\r\n").head.will_close() is False
+
+class TestChunkedDecoder:
+    PAYLOAD = "5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n"
+
+    def test_decode(self):
+        assert httpparse.decode_chunked(self.PAYLOAD) == "hello world"
+
+    def test_blocks(self):
+        for blocksize in [1, 2, 5, 8]:
+            decoder = httpparse.ChunkedDecoder()
+            consumed = 0
+            for i in range(0, len(self.PAYLOAD), blocksize):
+                consumed += decoder.feed(self.PAYLOAD[i:i+blocksize])
+            assert decoder.done
+            assert consumed == len(self.PAYLOAD)
+            assert decoder.read() == "hello world"
+
+    def test_end(self):
+        # data after the end of payload is not consumed
+        decoder = httpparse.ChunkedDecoder()
+        assert decoder.feed(self.PAYLOAD + "HTTP/1.1") == len(self.PAYLOAD)
+        assert decoder.done
+
+    def test_eof(self):
+        decoder = httpparse.ChunkedDecoder()
+        decoder.feed("5\r\nhello\r\n0\r\n")
+        assert not decoder.done
+        assert decoder.complete_at_eof()
+
+        decoder = httpparse.ChunkedDecoder()
+        decoder.feed("5\r\nhel")
+        assert not decoder.complete_at_eof()
+
+    def test_invalid_size(self):
+        decoder = httpparse.ChunkedDecoder()
+        with pytest.raises(httplib.IncompleteRead):
+            decoder.feed("xyz\r\nhello\r\n")
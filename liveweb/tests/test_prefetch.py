@@ -0,0 +1,128 @@
+import gzip
+import time
+from cStringIO import StringIO
+
+from .. import prefetch, proxy
+
+HTML = """
+<html>
+<head>
+  <link rel="stylesheet" href="/style.css">
+  <link rel="shortcut icon" href="favicon.ico">
+  <link rel="alternate" href="/feed.xml">
+  <script src="http://cdn.example.net/app.js"></script>
+</head>
+<body>
+  <img src="a.png#top"><img src="a.png"/>
+  <img src="data:image/png;base64,AAAA">
+  <a href="/next.html">next</a>
+</body>
+</html>
+"""
+
+def make_response(html, headers=[]):
+    head = ["HTTP/1.1 200 OK", "Content-Type: text/html; charset=utf-8",
+            "Content-Length: %d" % len(html)] + headers
+    sock = proxy._FakeSocket(StringIO("\r\n".join(head) + "\r\n\r\n" + html))
+    response = proxy.ProxyHTTPResponse("http://example.com/dir/page.html", sock)
+    response.begin()
+    return response
+
+def test_extract_resources():
+    assert prefetch.extract_resources(HTML, "http://example.com/dir/page.html") == [
+        "http://example.com/style.css",
+        "http://example.com/dir/favicon.ico",
+        "http://cdn.example.net/app.js",
+        "http://example.com/dir/a.png",
+    ]
+
+def test_extract_base():
+    html = '<base href="http://static.example.com/"><img src="a.png">'
+    assert prefetch.extract_resources(html, "http://example.com/") == ["http://static.example.com/a.png"]
+
+def test_get_html():
+    assert prefetch.get_html(make_response(HTML)) == HTML
+
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="w")
+    f.write(HTML)
+    f.close()
+    response = make_response(buf.getvalue(), ["Content-Encoding: gzip"])
+    assert prefetch.get_html(response) == HTML
+
+class TestPrefetcher:
+    def test_prefetch(self):
+        fetched = []
+        p = prefetch.Prefetcher(fetched.append, budget=3)
+        p.start()
+
+        p.page_captured(make_response(HTML))
+        p.queue.join()
+        assert sorted(fetched) == [
+            "http://cdn.example.net/app.js",
+            "http://example.com/dir/favicon.ico",
+            "http://example.com/style.css",
+        ]
+
+    def test_not_html(self):
+        fetched = []
+        p = prefetch.Prefetcher(fetched.append)
+        p.start()
+
+        response = make_response(HTML)
+        response.content_type = "text/plain"
+        p.page_captured(response)
+        p.queue.join()
+        assert fetched == []
+
+    def test_parsed_in_background(self, monkeypatch):
+        import threading
+        threads = []
+        get_html = prefetch.get_html
+        def record_thread(response):
+            threads.append(threading.current_thread().name)
+            return get_html(response)
+        monkeypatch.setattr(prefetch, "get_html", record_thread)
+
+        fetched = []
+        p = prefetch.Prefetcher(fetched.append, num_threads=1)
+        p.page_captured(make_response(HTML))
+        assert threads == []
+
+        p.start()
+        p.queue.join()
+        assert threads == ["prefetch-0"]
+        assert len(fetched) == 4
+
+    def test_submit(self):
+        # the fetches are completed later, no thread waits for them
+        fetched = []
+        callbacks = []
+        def submit(url, on_done):
+            callbacks.append(lambda: on_done(lambda: fetched.append(url)))
+            return True
+        p = prefetch.Prefetcher(None, budget=3, submit=submit, num_threads=1)
+        p.start()
+
+        p.page_captured(make_response(HTML))
+        while len(callbacks) < 3:
+            time.sleep(0.01)
+        assert fetched == []
+        assert p.queue.unfinished_tasks == 3
+
+        for callback in callbacks:
+            callback()
+        p.queue.join()
+        assert sorted(fetched) == [
+            "http://cdn.example.net/app.js",
+            "http://example.com/dir/favicon.ico",
+            "http://example.com/style.css",
+        ]
+
+    def test_queue_full(self):
+        # without starting the threads, nothing is taken out of the queue
+        p = prefetch.Prefetcher(None, queue_size=2, max_pages=1)
+        p.page_captured(make_response(HTML))
+        p.page_captured(make_response(HTML))
+        assert p.queue.qsize() == 1
+        assert p.dropped == 1
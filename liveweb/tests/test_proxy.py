@@ -1,11 +1,16 @@
-from .. import proxy, config
+from .. import proxy, config, file_pool, cdx
 
 from cStringIO import StringIO
+import base64
 import datetime
+import gzip
+import hashlib
 import subprocess
 import os
 import urllib
 import time
+import socket
+import threading
 
 import pytest
 
@@ -34,6 +39,23 @@ class TestRecord:
         record = proxy.Record(path.strpath, 800, 100, None)
         assert record.read_all() == "helloworld" * 10
 
+    def test_copy(self):
+        content = "helloworld" * 100
+        record = proxy.Record(None, 0, len(content), iter([content]))
+
+        copies = [record.copy() for i in range(3)]
+        assert ["".join(r) for r in copies] == [content] * 3
+        assert record.read_all() == content
+
+    def test_copy_big(self, tmpdir):
+        path = tmpdir.join("foo.txt")
+        path.write("a" * (proxy.MEG + 10))
+
+        record = proxy.Record(path.strpath, 10, proxy.MEG, None)
+        copy = record.copy()
+        assert copy.content_iter is not record.content_iter
+        assert "".join(copy) == "a" * proxy.MEG
+
 
 def test_split_type_host():
     assert proxy.split_type_host("http://www.archive.org/details/test") == ("http", "www.archive.org", "/details/test")
@@ -108,11 +130,105 @@ class TestProxyResponse:
         self._test_arc_record(SAMPLE_RESPONSE)
         self._test_arc_record(SAMPLE_RESPONSE_CHUNKED)
 
+    def test_continue(self):
+        http_payload = "HTTP/1.1 100 Continue\r\n\r\n" + SAMPLE_RESPONSE
+        response = self.make_response(http_payload)
+        assert response.status == 200
+        assert response.buf.getvalue() == http_payload
+        assert "".join(response.get_payload()) == "helloworld"
+
+    def test_http09(self):
+        response = self.make_response("helloworld")
+        assert response.status == 200
+        assert response.getheaders() == []
+        assert "".join(response.get_payload()) == "helloworld"
+
+    def test_extra_data(self):
+        # data beyond content-length is not part of the response
+        response = self.make_response(SAMPLE_RESPONSE + "HTTP/1.1 200 OK\r\n")
+        assert response.buf.getvalue() == SAMPLE_RESPONSE
+        assert response.isclosed()
+
+    def test_write_warc(self, pooldir):
+        config.init_defaults()
+        pool = file_pool.FilePool(pooldir)
+
+        response = self.make_response(SAMPLE_RESPONSE_CHUNKED)
+        response.request_data = "GET /hello HTTP/1.1\r\nHost: example.com\r\n\r\n"
+        record = response.write_warc(pool)
+
+        data = gzip.GzipFile(fileobj=StringIO(record.read_all())).read()
+        head, block = data.split("\r\n\r\n", 1)
+        headers = dict(line.split(": ", 1) for line in head.split("\r\n")[1:])
+        assert head.startswith("WARC/1.0\r\n")
+        assert headers["WARC-Type"] == "response"
+        assert headers["WARC-Target-URI"] == "http://example.com/hello"
+        assert block == SAMPLE_RESPONSE_CHUNKED + "\r\n\r\n"
+        assert int(headers["Content-Length"]) == len(SAMPLE_RESPONSE_CHUNKED)
+
+        payload = SAMPLE_RESPONSE_CHUNKED.split("\r\n\r\n", 1)[1]
+        assert headers["WARC-Block-Digest"] == proxy.warc_digest(hashlib.sha1(SAMPLE_RESPONSE_CHUNKED))
+        assert headers["WARC-Payload-Digest"] == proxy.warc_digest(hashlib.sha1(payload))
+
+        # the request record follows the response
+        with open(record.filename) as f:
+            f.seek(record.offset + record.content_length)
+            request = gzip.GzipFile(fileobj=StringIO(f.read())).read()
+        assert "WARC-Type: request\r\n" in request
+        assert "WARC-Concurrent-To: %s\r\n" % headers["WARC-Record-ID"] in request
+        assert request.endswith("\r\n\r\n" + response.request_data + "\r\n\r\n")
+
+    def test_write_index(self, pooldir):
+        config.init_defaults()
+        pool = file_pool.FilePool(pooldir, index=True)
+
+        response = self.make_response(SAMPLE_RESPONSE_CHUNKED)
+        record = response.write_warc(pool)
+        pool.close()
+
+        lines = open(record.filename + ".cdx").read().splitlines()
+        payload = SAMPLE_RESPONSE_CHUNKED.split("\r\n\r\n", 1)[1]
+        assert lines[0] == cdx.CDX_HEADER.rstrip("\n")
+        assert lines[1:] == ["com,example)/hello %s http://example.com/hello text/plain 200 %s - - %d %d %s" % (
+            response.capture_date.strftime("%Y%m%d%H%M%S"),
+            base64.b32encode(hashlib.sha1(payload).digest()),
+            record.content_length,
+            record.offset,
+            os.path.basename(record.filename))]
+
+    def test_write_warc_error(self, pooldir):
+        config.init_defaults()
+        response = proxy.ProxyHTTPResponse("http://example.com/hello", None)
+        response.error_bad_gateway()
+        record = response.write_warc(file_pool.FilePool(pooldir))
+
+        data = gzip.GzipFile(fileobj=StringIO(record.read_all())).read()
+        assert "WARC-Type: response\r\n" in data
+        assert data.endswith("\r\n\r\nHTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n\r\n\r\n")
+
     def _test_arc_record(self, http_payload):
         response = self.make_response(http_payload)
         arc = response._make_arc_record()
         assert str(arc.header) == "http://example.com/hello 0.0.0.0 20100908070605 text/plain %d" % len(http_payload)
 
+    def test_write_arc(self, pooldir):
+        config.init_defaults()
+        pool = file_pool.FilePool(pooldir)
+
+        small = SAMPLE_RESPONSE
+        payload = "helloworld" * (proxy.MEG / 5)
+        big = SAMPLE_RESPONSE.replace("10", str(len(payload))).replace("helloworld", payload)
+        for http_payload in [small, big]:
+            record = self.make_response(http_payload).write_arc(pool)
+            with open(record.filename) as f:
+                f.seek(record.offset)
+                data = f.read(record.content_length)
+                # the record is a complete gzip member at the end of the file
+                assert f.read() == ""
+            assert gzip.GzipFile(fileobj=StringIO(data)).read().endswith("\n" + http_payload + "\n")
+            if record.content_iter is not None:
+                assert record.read_all() == data
+
 
 class FakeSocket:
     def __init__(self, content, delay_per_byte=0):
@@ -128,6 +244,14 @@ class FakeSocket:
 
         return data
 
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
     def dummy(self, *a, **kw):
         pass
     
@@ -157,6 +281,41 @@ class TestSocketWrapper:
         e = excinfo.value
         assert (e.errcode, e.errmsg) == proxy.ERR_RESPONSE_TOO_BIG
 
+class TestSocketReader:
+    def test_readline(self):
+        f = proxy.SocketReader(FakeSocket("a\nbb\n" + "c" * 20 + "\nd"), bufsize=8)
+        assert f.readline() == "a\n"
+        assert f.readline() == "bb\n"
+        assert f.readline(10) == "c" * 10
+        assert f.readline() == "c" * 10 + "\n"
+        assert f.readline() == "d"
+        assert f.readline() == ""
+
+    def test_read(self):
+        f = proxy.SocketReader(FakeSocket("helloworld" * 10), bufsize=8)
+        assert f.readline(3) == "hel"
+        assert f.read(7) == "loworld"
+        assert f.read(25) == "helloworld" * 2 + "hello"
+        assert f.read() == "world" + "helloworld" * 6
+        assert f.read() == ""
+
+    def test_read1(self):
+        f = proxy.SocketReader(FakeSocket("helloworld"), bufsize=8)
+        assert f.read1(100) == "hellowor"
+        assert f.read1(1) == "l"
+        assert f.read1(100) == "d"
+        assert f.read1(100) == ""
+
+    def test_limits(self):
+        sock = proxy.SocketWrapper(FakeSocket("a" * 1200), max_size=1001)
+        f = proxy.SocketReader(sock, bufsize=1000)
+        assert f.read(1000) == "a" * 1000
+
+        with pytest.raises(proxy.ProxyError) as excinfo:
+            f.read(100)
+        e = excinfo.value
+        assert (e.errcode, e.errmsg) == proxy.ERR_RESPONSE_TOO_BIG
+
 class TestErrors:
     def assert_error_code(self, excinfo, error):
         e = excinfo.value
@@ -229,3 +388,156 @@ class TestErrors:
 
 def test_webtest(webtest):
     assert urllib.urlopen(webtest.url + "/echo/hello").read() == "hello\n"
+
+
+class TestConnectionReuse:
+    def test_reuse(self, monkeypatch, keepalive_server):
+        from ..connection_pool import ConnectionPool
+        monkeypatch.setattr(proxy, "connection_pool", ConnectionPool())
+
+        for i in range(3):
+            response = proxy._urlopen(keepalive_server.url + "/")
+            assert "".join(response.get_payload()) == "hello, world!\n"
+
+        assert keepalive_server.connections == 1
+
+    def test_no_pool(self, keepalive_server):
+        for i in range(3):
+            proxy._urlopen(keepalive_server.url + "/")
+        assert keepalive_server.connections == 3
+
+    def test_stale_connection(self, monkeypatch, keepalive_server):
+        from ..connection_pool import ConnectionPool
+        monkeypatch.setattr(proxy, "connection_pool", ConnectionPool())
+
+        proxy._urlopen(keepalive_server.url + "/")
+
+        # close the socket of the pooled connection, as if the server has closed it
+        key = proxy._connection_key("http", keepalive_server.url[len("http://"):])
+        conn = proxy.connection_pool.get(key)
+        conn.sock._sock.shutdown(socket.SHUT_RDWR)
+        proxy.connection_pool.put(key, conn)
+
+        response = proxy._urlopen(keepalive_server.url + "/")
+        assert "".join(response.get_payload()) == "hello, world!\n"
+        assert keepalive_server.connections == 2
+
+def test_dns_cache(monkeypatch, webtest):
+    from ..resolver import DNSCache
+    monkeypatch.setattr(proxy, "dns_cache", DNSCache())
+
+    proxy._urlopen(webtest.url + "/")
+    proxy._urlopen(webtest.url + "/")
+    assert proxy.dns_cache.stats()['hits'] == 1
+
+    for i in range(2):
+        with pytest.raises(proxy.ProxyError) as excinfo:
+            proxy._urlopen("http://invalid.com2/")
+        assert excinfo.value.errcode == proxy.ERR_INVALID_DOMAIN[0]
+    assert proxy.dns_cache.stats()['negative_hits'] == 1
+
+def test_stub_resolver(monkeypatch, dnsserver):
+    from ..resolver import StubResolver
+    dnsserver.ignore.append("slow.com")
+    monkeypatch.setattr(proxy, "dns_resolver", StubResolver(nameservers=[dnsserver.address]))
+    monkeypatch.setattr(config, "dns_timeout", 0.2)
+
+    with pytest.raises(proxy.ProxyError) as excinfo:
+        proxy._urlopen("http://slow.com/")
+    assert excinfo.value.errcode == proxy.ERR_DNS_TIMEOUT[0]
+
+    with pytest.raises(proxy.ProxyError) as excinfo:
+        proxy._urlopen("http://invalid.com2/")
+    assert excinfo.value.errcode == proxy.ERR_INVALID_DOMAIN[0]
+
+
+class TestStreaming:
+    def test_stream(self, webtest):
+        response = proxy._urlopen(webtest.url + "/echo/hello?repeats=3", stream=True)
+        assert response.status == 200
+        assert response.buf.tell() == response.header_offset
+
+        payload = "".join(response.iter_payload(chunk_size=4))
+        assert payload == "hello\n" * 3
+        assert response.buf.getvalue()[response.header_offset:] == payload
+
+    def test_stream_chunked(self):
+        sock = proxy._FakeSocket(StringIO(SAMPLE_RESPONSE_CHUNKED))
+        response = proxy.ProxyHTTPResponse("http://example.com/hello", sock, stream=True)
+        response.begin()
+        assert "".join(response.iter_payload()) == "5\r\nhello\r\n5\r\nworld\r\n0\r\n"
+        assert response.buf.getvalue() == SAMPLE_RESPONSE_CHUNKED
+
+    def test_stream_too_big(self, monkeypatch, webtest):
+        monkeypatch.setattr(config, "max_response_size", 1000)
+        response = proxy._urlopen(webtest.url + "/echo/helloworld?repeats=100&delay=0.001", stream=True)
+        assert response.status == 200
+        list(response.iter_payload(chunk_size=100))
+        assert response.status == 502
+
+    def test_stream_dropped(self, webtest):
+        response = proxy._urlopen(webtest.url + "/drop", stream=True)
+        list(response.iter_payload())
+        assert response.status == 502
+
+    def test_stream_reuse(self, monkeypatch, keepalive_server):
+        from ..connection_pool import ConnectionPool
+        monkeypatch.setattr(proxy, "connection_pool", ConnectionPool())
+
+        for i in range(3):
+            response = proxy._urlopen(keepalive_server.url + "/", stream=True)
+            assert "".join(response.iter_payload()) == "hello, world!\n"
+        assert keepalive_server.connections == 1
+
+
+class TestHostLimiter:
+    def test_host_busy(self, monkeypatch, keepalive_server):
+        from ..host_limiter import HostLimiter
+        monkeypatch.setattr(proxy, "host_limiter", HostLimiter(max_per_host=1, queue_timeout=0.1))
+
+        t = threading.Thread(target=proxy._urlopen, args=(keepalive_server.url + "/delay/0.5",))
+        t.start()
+        time.sleep(0.1)
+
+        with pytest.raises(proxy.ProxyError) as excinfo:
+            proxy._urlopen(keepalive_server.url + "/")
+        assert excinfo.value.errcode == proxy.ERR_HOST_BUSY[0]
+        t.join()
+
+        # the slot is released once the fetch is over
+        assert proxy._urlopen(keepalive_server.url + "/").status == 200
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 0
+
+    def test_stream(self, monkeypatch, keepalive_server):
+        from ..host_limiter import HostLimiter
+        monkeypatch.setattr(proxy, "host_limiter", HostLimiter(max_per_host=1, queue_timeout=0.1))
+
+        response = proxy._urlopen(keepalive_server.url + "/", stream=True)
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 1
+        assert "".join(response.iter_payload()) == "hello, world!\n"
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 0
+
+class TestHTTPS:
+    def make_context(self, certfile):
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(certfile)
+        # the certificate is issued for localhost
+        context.check_hostname = False
+        return context
+
+    def test_https(self, monkeypatch, tls_server):
+        monkeypatch.setattr(proxy, "ssl_context", self.make_context(tls_server.certfile))
+        for i in range(3):
+            response = proxy._urlopen(tls_server.url + "/")
+            assert response.status == 200
+            assert response.get_payload().next() == "hello, world!\n"
+
+    def test_verify(self, monkeypatch, tls_server):
+        import ssl
+        # the self-signed certificate is not trusted by the default context
+        monkeypatch.setattr(proxy, "ssl_context", ssl._create_default_https_context())
+        with pytest.raises(proxy.ProxyError) as excinfo:
+            proxy._urlopen(tls_server.url + "/")
+        assert isinstance(excinfo.value.cause, ssl.SSLError)
@@ -0,0 +1,190 @@
+import errno
+import socket
+import time
+
+import pytest
+
+from .. import resolver
+
+class FakeResolver:
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.calls = []
+
+    def __call__(self, host, port):
+        self.calls.append(host)
+        if host not in self.hosts:
+            raise socket.gaierror(-2, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (self.hosts[host], port))]
+
+class TestDNSCache:
+    def test_hit(self):
+        r = FakeResolver({"example.com": "1.2.3.4"})
+        cache = resolver.DNSCache(getaddrinfo=r)
+
+        for i in range(3):
+            addrinfo = cache.getaddrinfo("example.com", 80)
+            assert addrinfo[0][4] == ("1.2.3.4", 80)
+
+        assert r.calls == ["example.com"]
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses']) == (2, 1)
+
+    def test_negative(self):
+        r = FakeResolver({})
+        cache = resolver.DNSCache(getaddrinfo=r)
+
+        for i in range(3):
+            with pytest.raises(socket.gaierror):
+                cache.getaddrinfo("invalid.com2", 80)
+
+        assert r.calls == ["invalid.com2"]
+        assert cache.stats()['negative_hits'] == 2
+
+    def test_expiry(self, monkeypatch):
+        r = FakeResolver({"example.com": "1.2.3.4"})
+        cache = resolver.DNSCache(ttl=10, negative_ttl=1, getaddrinfo=r)
+
+        cache.getaddrinfo("example.com", 80)
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo("invalid.com2", 80)
+
+        t = time.time() + 5
+        monkeypatch.setattr(time, "time", lambda: t)
+
+        cache.getaddrinfo("example.com", 80)
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo("invalid.com2", 80)
+
+        assert r.calls == ["example.com", "invalid.com2", "invalid.com2"]
+
+    def test_max_entries(self):
+        r = FakeResolver({"a.com": "1.1.1.1", "b.com": "2.2.2.2"})
+        cache = resolver.DNSCache(max_entries=1, getaddrinfo=r)
+        cache.getaddrinfo("a.com", 80)
+        cache.getaddrinfo("b.com", 80)
+        assert cache.stats()['entries'] == 1
+
+def test_create_connection(webtest):
+    calls = []
+    def getaddrinfo(host, port):
+        calls.append((host, port))
+        return socket.getaddrinfo("127.0.0.1", port, 0, socket.SOCK_STREAM)
+
+    sock = resolver.create_connection(("example.com", webtest.port), 1, getaddrinfo=getaddrinfo)
+    assert sock.getpeername() == ("127.0.0.1", webtest.port)
+    assert calls == [("example.com", webtest.port)]
+    sock.close()
+
+def blackhole_address():
+    """Returns a listening socket and an address that never accepts connections.
+
+    The backlog of the listening socket is kept full, so that the
+    new connection attempts hang.
+    """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(0)
+    filler = socket.create_connection(sock.getsockname())
+    return [sock, filler], sock.getsockname()
+
+def addrinfo(*addresses):
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', address) for address in addresses]
+
+class TestConnectionRacing:
+    def test_interleave_families(self):
+        v4 = [(socket.AF_INET, 1, 6, '', ("1.1.1.%d" % i, 80)) for i in range(3)]
+        v6 = [(socket.AF_INET6, 1, 6, '', ("::%d" % i, 80, 0, 0)) for i in range(2)]
+        assert resolver.interleave_families(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+
+    def test_dead_address(self, webtest):
+        socks, dead = blackhole_address()
+        good = ("127.0.0.1", webtest.port)
+
+        t0 = time.time()
+        sock = resolver.create_connection(("example.com", 80), 5, getaddrinfo=lambda host, port: addrinfo(dead, good), attempt_delay=0.1)
+        assert time.time() - t0 < 1
+        assert sock.getpeername() == good
+        assert sock.gettimeout() == 5
+        sock.close()
+
+    def test_refused(self, webtest):
+        # find a port that nobody is listening on
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        closed = s.getsockname()
+        s.close()
+
+        good = ("127.0.0.1", webtest.port)
+        t0 = time.time()
+        sock = resolver.create_connection(("example.com", 80), 5, getaddrinfo=lambda host, port: addrinfo(closed, good), attempt_delay=2)
+        # the next attempt should start as soon as the first one fails
+        assert time.time() - t0 < 1
+        assert sock.getpeername() == good
+        sock.close()
+
+        with pytest.raises(socket.error) as excinfo:
+            resolver.create_connection(("example.com", 80), 5, getaddrinfo=lambda host, port: addrinfo(closed))
+        assert excinfo.value.errno == errno.ECONNREFUSED
+
+    def test_timeout(self):
+        socks, dead = blackhole_address()
+        t0 = time.time()
+        with pytest.raises(socket.timeout):
+            resolver.create_connection(("example.com", 80), 0.3, getaddrinfo=lambda host, port: addrinfo(dead, dead), attempt_delay=0.1)
+        # the attempts run in parallel
+        assert time.time() - t0 < 0.6
+
+class TestStubResolver:
+    def make_resolver(self, dnsserver, tmpdir):
+        hosts = tmpdir.join("hosts")
+        hosts.write("127.0.0.1 localhost\n::1 localhost ip6-localhost  # comment\n")
+        return resolver.StubResolver(nameservers=[dnsserver.address], hosts_file=hosts.strpath)
+
+    def test_resolve(self, dnsserver, tmpdir):
+        dnsserver.records["example.com"] = ["1.2.3.4", "2001:db8::1"]
+        dnsserver.ttl = 42
+        r = self.make_resolver(dnsserver, tmpdir)
+
+        addresses, ttl = r.resolve("example.com", timeout=1)
+        assert addresses == [(socket.AF_INET, "1.2.3.4"), (socket.AF_INET6, "2001:db8::1")]
+        assert ttl == 42
+        assert sorted(dnsserver.queries) == [("example.com", resolver.TYPE_A), ("example.com", resolver.TYPE_AAAA)]
+
+        addrinfo = r.getaddrinfo("example.com", 80)
+        assert [a[4] for a in addrinfo] == [("1.2.3.4", 80), ("2001:db8::1", 80, 0, 0)]
+        assert addrinfo.ttl == 42
+
+    def test_nxdomain(self, dnsserver, tmpdir):
+        r = self.make_resolver(dnsserver, tmpdir)
+        with pytest.raises(socket.gaierror) as excinfo:
+            r.resolve("invalid.com2", timeout=1)
+        assert excinfo.value.errno == resolver.EAI_NONAME
+
+    def test_timeout(self, dnsserver, tmpdir):
+        dnsserver.ignore.append("slow.com")
+        r = self.make_resolver(dnsserver, tmpdir)
+
+        t0 = time.time()
+        with pytest.raises(socket.gaierror) as excinfo:
+            r.resolve("slow.com", timeout=0.2)
+        assert excinfo.value.errno == resolver.EAI_AGAIN
+        assert time.time() - t0 < 0.5
+
+    def test_hosts(self, dnsserver, tmpdir):
+        r = self.make_resolver(dnsserver, tmpdir)
+        assert r.resolve("localhost")[0] == [(socket.AF_INET, "127.0.0.1"), (socket.AF_INET6, "::1")]
+        assert r.resolve("1.2.3.4")[0] == [(socket.AF_INET, "1.2.3.4")]
+        assert r.resolve("::1")[0] == [(socket.AF_INET6, "::1")]
+        assert dnsserver.queries == []
+
+    def test_dns_cache(self, dnsserver, tmpdir):
+        dnsserver.records["example.com"] = ["1.2.3.4"]
+        dnsserver.ttl = 0
+        r = self.make_resolver(dnsserver, tmpdir)
+        cache = resolver.DNSCache(getaddrinfo=r.getaddrinfo)
+
+        # ttl of the records is zero, so the cache should not keep it
+        cache.getaddrinfo("example.com", 80)
+        cache.getaddrinfo("example.com", 80)
+        assert len(dnsserver.queries) == 4
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from ..singleflight import SingleFlight
+
+def test_do():
+    sf = SingleFlight()
+    assert sf.do("a", lambda x: x * 2, 21) == 42
+    assert sf.in_flight() == 0
+
+def test_coalescing():
+    sf = SingleFlight()
+    calls = []
+
+    def f():
+        calls.append(1)
+        time.sleep(0.2)
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(sf.do("a", f))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert calls == [1]
+    assert results == [1] * 5
+
+    # once the call is complete, the next one should make a new call
+    assert sf.do("a", f) == 2
+
+def test_exception():
+    sf = SingleFlight()
+
+    def f():
+        time.sleep(0.1)
+        raise ValueError("bad")
+
+    errors = []
+    def g():
+        try:
+            sf.do("a", f)
+        except ValueError, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=g) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 3
+    assert sf.in_flight() == 0
+
+def test_begin_end():
+    sf = SingleFlight()
+    assert sf.begin("a")
+    assert not sf.begin("a")
+
+    # do waits for the call started by begin
+    results = []
+    t = threading.Thread(target=lambda: results.append(sf.do("a", lambda: "new call")))
+    t.start()
+    time.sleep(0.1)
+    assert results == []
+    sf.end("a", "result")
+    t.join()
+    assert results == ["result"]
+    assert sf.in_flight() == 0
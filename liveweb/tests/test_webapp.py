@@ -1,3 +1,9 @@
+import gzip
+import os
+from cStringIO import StringIO
+
+from .. import config, dedup, webapp
+from ..file_pool import FilePool
 from ..webapp import application
 
 class Test_application:
@@ -25,3 +31,402 @@ class Test_application:
         app = application(environ, None)
         app.parse_request()
         assert app.url == "http://www.example.com/foo/bar"
+
+class MemCache:
+    """In-memory cache with the same interface as RedisCache.
+    """
+    def __init__(self, max_record_size=None):
+        self.records = {}
+        self.validators = {}
+        self.max_record_size = max_record_size
+        self.locks = set()
+        self.fetched = {}
+
+    def get(self, url):
+        return self.records.get(url)
+
+    def set(self, url, record):
+        if self.max_record_size is None or record.content_length <= self.max_record_size:
+            self.records[url] = record.read_all()
+
+    def acquire_fetch_lock(self, url, timeout):
+        if url in self.locks:
+            return False
+        self.locks.add(url)
+        self.fetched.pop(url, None)
+        return True
+
+    def release_fetch_lock(self, url):
+        self.locks.discard(url)
+
+    def set_fetched(self, url, record, timeout):
+        self.fetched[url] = dict(filename=record.filename, offset=record.offset, content_length=record.content_length)
+
+    def get_fetched(self, url):
+        return self.fetched.get(url)
+
+    def get_validators(self, url):
+        return self.validators.get(url)
+
+    def set_validators(self, url, validators):
+        self.validators[url] = validators
+
+class TestRevalidation:
+    def setup_app(self, monkeypatch, pooldir, url):
+        monkeypatch.setattr(config, "cache", "redis")
+        monkeypatch.setattr(config, "redis_revalidate", True)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url}, None)
+        app.parse_request()
+        return app
+
+    def test_revalidate(self, monkeypatch, pooldir, keepalive_server):
+        url = keepalive_server.url + "/"
+        app = self.setup_app(monkeypatch, pooldir, url)
+
+        record = app.fetch_record()
+        data = record.read_all()
+        validators = webapp._cache.get_validators(url)
+        assert validators["etag"] == '"hello"'
+        assert (validators["offset"], validators["content_length"]) == (record.offset, record.content_length)
+
+        # cache entry has expired
+        del webapp._cache.records[url]
+
+        record2 = app.fetch_record()
+        assert keepalive_server.not_modified == 1
+        assert (record2.filename, record2.offset) == (record.filename, record.offset)
+        assert record2.read_all() == data
+        assert webapp._cache.records[url] == data
+
+        # the 304 response is archived as well
+        assert os.path.getsize(record.filename) > record.offset + record.content_length
+
+    def test_capture_gone(self, monkeypatch, pooldir, keepalive_server):
+        url = keepalive_server.url + "/"
+        app = self.setup_app(monkeypatch, pooldir, url)
+
+        record = app.fetch_record()
+        webapp._cache.validators[url]["filename"] = "/nonexistent/partial/foo.arc.gz"
+        del webapp._cache.records[url]
+
+        record2 = app.fetch_record()
+        assert keepalive_server.not_modified == 1
+        assert record2.offset > record.offset
+        assert "hello, world!" in gzip.GzipFile(fileobj=StringIO(record2.read_all())).read()
+
+class TestCoalesce:
+    def setup_app(self, monkeypatch, pooldir, url):
+        monkeypatch.setattr(config, "cache", "redis")
+        monkeypatch.setattr(config, "redis_coalesce", True)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        # the records are too big to be cached
+        monkeypatch.setattr(webapp, "_cache", MemCache(max_record_size=0))
+
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url}, None)
+        app.parse_request()
+        return app
+
+    def test_big_record(self, monkeypatch, pooldir, keepalive_server):
+        import threading
+        import time
+
+        url = keepalive_server.url + "/"
+        app = self.setup_app(monkeypatch, pooldir, url)
+        record = app.fetch_record()
+        assert webapp._cache.get(url) is None
+        assert webapp._cache.locks == set()
+
+        # another worker is fetching the url
+        webapp._cache.acquire_fetch_lock(url, 10)
+        def other_worker():
+            time.sleep(0.3)
+            webapp._cache.set_fetched(url, record, 10)
+            webapp._cache.release_fetch_lock(url)
+        threading.Thread(target=other_worker).start()
+
+        def fetch_again():
+            raise AssertionError("fetched again")
+        monkeypatch.setattr(app, "_fetch_record", fetch_again)
+
+        # the record written by the other worker is used
+        record2 = app.fetch_record()
+        assert (record2.filename, record2.offset, record2.content_length) == (record.filename, record.offset, record.content_length)
+
+class TestWARC:
+    def test_fetch(self, monkeypatch, pooldir, keepalive_server):
+        monkeypatch.setattr(config, "archive_format", "warc")
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir, init_file_func=webapp.init_warc_file))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+
+        url = keepalive_server.url + "/"
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url}, None)
+        app.parse_request()
+        record = app.fetch_record()
+
+        data = gzip.GzipFile(record.filename).read()
+        types = [line for line in data.split("\r\n") if line.startswith("WARC-Type: ")]
+        assert types == ["WARC-Type: warcinfo", "WARC-Type: response", "WARC-Type: request"]
+        assert "GET / HTTP/1.1\r\n" in data
+
+        def start_response(status, headers):
+            self.status = status
+        app.start_response = start_response
+        assert "".join(app.proxy_response(record)) == "hello, world!\n"
+        assert self.status == "200 OK"
+
+class TestDedup:
+    def test_revisit(self, monkeypatch, pooldir, keepalive_server, tmpdir):
+        monkeypatch.setattr(config, "archive_format", "warc")
+        monkeypatch.setattr(config, "dedup_min_size", 0)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+        monkeypatch.setattr(webapp, "digest_index", dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath))
+
+        url = keepalive_server.url + "/"
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url}, None)
+        app.parse_request()
+
+        record = app.fetch_record()
+        record2 = app.fetch_record()
+
+        # the client gets the full response, though it is not archived
+        assert record2.filename is None
+        data = gzip.GzipFile(fileobj=StringIO(record2.read_all())).read()
+        assert "WARC-Type: response\r\n" in data
+        assert data.endswith("hello, world!\n\r\n\r\n")
+
+        warc = gzip.GzipFile(record.filename).read()
+        assert warc.count("WARC-Type: response\r\n") == 1
+        assert warc.count("WARC-Type: revisit\r\n") == 1
+        assert warc.count("hello, world!") == 1
+        assert webapp.digest_index.stats()["revisits"] == 1
+
+    def test_other_url(self, monkeypatch, pooldir, keepalive_server, tmpdir):
+        # both the urls have the same payload
+        monkeypatch.setattr(config, "archive_format", "warc")
+        monkeypatch.setattr(config, "dedup_min_size", 0)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+        monkeypatch.setattr(webapp, "digest_index", dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath))
+
+        records = []
+        for path in ["/a", "/b"]:
+            app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": keepalive_server.url + path}, None)
+            app.parse_request()
+            records.append(app.fetch_record())
+        assert webapp.digest_index.stats()["revisits"] == 1
+
+        # the client and the cache get the record of /b, not the one of /a
+        data = gzip.GzipFile(fileobj=StringIO(records[1].read_all())).read()
+        assert "WARC-Target-URI: %s/b\r\n" % keepalive_server.url in data
+        assert "hello, world!" in data
+        assert webapp._cache.records[keepalive_server.url + "/b"] == records[1].read_all()
+
+        warc = gzip.GzipFile(records[0].filename).read()
+        assert "WARC-Refers-To-Target-URI: %s/a\r\n" % keepalive_server.url in warc
+
+    def test_sqlite_cache(self, monkeypatch, pooldir, keepalive_server, tmpdir):
+        from ..cache import SqliteCache
+        monkeypatch.setattr(config, "archive_format", "warc")
+        monkeypatch.setattr(config, "dedup_min_size", 0)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", SqliteCache(tmpdir.join("cache.db").strpath))
+        monkeypatch.setattr(webapp, "digest_index", dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath))
+
+        apps = []
+        for path in ["/a", "/b"]:
+            app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": keepalive_server.url + path}, None)
+            app.parse_request()
+            apps.append(app)
+            app.get_record()
+        assert webapp.digest_index.stats()["revisits"] == 1
+
+        # the record of the revisit is not in any file, so it is not cached
+        assert webapp._cache.get(keepalive_server.url + "/b") is None
+        data = gzip.GzipFile(fileobj=StringIO(apps[1].get_record().read_all())).read()
+        assert "WARC-Target-URI: %s/b\r\n" % keepalive_server.url in data
+
+    def test_small(self, monkeypatch, pooldir, keepalive_server, tmpdir):
+        monkeypatch.setattr(config, "archive_format", "warc")
+        monkeypatch.setattr(config, "dedup_min_size", 1024)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+        monkeypatch.setattr(webapp, "digest_index", dedup.SqliteDigestIndex(tmpdir.join("dedup.db").strpath))
+
+        url = keepalive_server.url + "/"
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url}, None)
+        app.parse_request()
+
+        record = app.fetch_record()
+        record2 = app.fetch_record()
+        assert record2.offset > record.offset
+        assert webapp.digest_index.stats()["revisits"] == 0
+
+class TestBatch:
+    def make_app(self, monkeypatch, pooldir, body):
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "REQUEST_URI": "/_batch",
+            "PATH_INFO": "/_batch",
+            "HTTP_HOST": "localhost:7070",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": StringIO(body)
+        }
+        self.status = None
+        def start_response(status, headers):
+            self.status = status
+            self.headers = dict(headers)
+        return application(environ, start_response)
+
+    def test_batch(self, monkeypatch, pooldir, keepalive_server):
+        urls = [keepalive_server.url + "/", keepalive_server.url + "/delay/0.1", keepalive_server.url + "/"]
+        app = self.make_app(monkeypatch, pooldir, "\n".join(urls) + "\n")
+        data = "".join(app)
+        assert self.status == "200 OK"
+        assert int(self.headers["Content-Length"]) == len(data)
+
+        index, records = data.split("\n\n", 1)
+        index = [line.split(" ") for line in index.split("\n")]
+        assert [url for offset, length, url in index] == urls
+
+        for offset, length, url in index:
+            record = records[int(offset):int(offset)+int(length)]
+            arc = gzip.GzipFile(fileobj=StringIO(record)).read()
+            assert arc.startswith(url + " ")
+            assert arc.endswith("hello, world!\n\n")
+
+    def test_fetch_engine(self, monkeypatch, pooldir, keepalive_server):
+        import time
+        from .. import proxy
+        from ..fetch_engine import FetchEngine
+
+        engine = FetchEngine()
+        engine.start()
+        monkeypatch.setattr(proxy, "fetch_engine", engine)
+        # with the fetch engine, no thread waits for each url
+        monkeypatch.setattr(config, "batch_concurrency", 1)
+
+        # 0.5, 0.50, 0.500 etc.
+        urls = [keepalive_server.url + "/delay/0.5" + "0" * i for i in range(5)]
+        app = self.make_app(monkeypatch, pooldir, "\n".join(urls) + "\n")
+        t0 = time.time()
+        try:
+            data = "".join(app)
+        finally:
+            engine.stop()
+        assert time.time() - t0 < 2
+        assert self.status == "200 OK"
+        assert webapp._inflight.in_flight() == 0
+
+        index, records = data.split("\n\n", 1)
+        index = [line.split(" ") for line in index.split("\n")]
+        assert [url for offset, length, url in index] == urls
+        for offset, length, url in index:
+            record = records[int(offset):int(offset)+int(length)]
+            arc = gzip.GzipFile(fileobj=StringIO(record)).read()
+            assert arc.startswith(url + " ")
+            assert arc.endswith("hello, world!\n\n")
+        assert sorted(webapp._cache.records) == sorted(urls)
+
+    def test_host_busy(self, monkeypatch, pooldir, keepalive_server):
+        from .. import proxy
+        from ..host_limiter import HostLimiter
+
+        limiter = HostLimiter(max_per_host=1, queue_timeout=0.1)
+        limiter.acquire("localhost")
+        monkeypatch.setattr(proxy, "host_limiter", limiter)
+
+        # too many fetches from localhost, the url is not fetched at all
+        urls = [keepalive_server.url + "/", "http://localhost:1/", keepalive_server.url + "/"]
+        app = self.make_app(monkeypatch, pooldir, "\n".join(urls) + "\n")
+        data = "".join(app)
+        assert self.status == "200 OK"
+        assert int(self.headers["Content-Length"]) == len(data)
+
+        # the other urls are returned even though one of them failed
+        index, records = data.split("\n\n", 1)
+        index = [line.split(" ") for line in index.split("\n")]
+        assert index[1] == ["-", "-", urls[1]]
+        assert [url for offset, length, url in index] == urls
+        for offset, length, url in [index[0], index[2]]:
+            record = records[int(offset):int(offset)+int(length)]
+            assert gzip.GzipFile(fileobj=StringIO(record)).read().startswith(url + " ")
+        assert int(index[2][0]) + int(index[2][1]) == len(records)
+
+    def test_bad_request(self, monkeypatch, pooldir):
+        "".join(self.make_app(monkeypatch, pooldir, ""))
+        assert self.status == "400 Bad Request"
+
+        "".join(self.make_app(monkeypatch, pooldir, "http://example.com/\nfoo\n"))
+        assert self.status == "400 Bad Request"
+
+    def test_too_many(self, monkeypatch, pooldir):
+        monkeypatch.setattr(config, "max_batch_size", 2)
+        "".join(self.make_app(monkeypatch, pooldir, "http://a.com/\nhttp://b.com/\nhttp://c.com/\n"))
+        assert self.status == "413 Request Entity Too Large"
+
+class TestHostBusy:
+    def test_busy(self, monkeypatch, pooldir, keepalive_server):
+        from .. import proxy
+        from ..host_limiter import HostLimiter
+
+        limiter = HostLimiter(max_per_host=1, queue_timeout=0.1)
+        limiter.acquire("127.0.0.1")
+        monkeypatch.setattr(proxy, "host_limiter", limiter)
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+
+        url = keepalive_server.url + "/"
+        statuses = []
+        app = application({"REQUEST_METHOD": "GET", "REQUEST_URI": url},
+                          lambda status, headers: statuses.append(status))
+        assert "".join(app) == ""
+
+        # the client can try again, nothing is archived or cached
+        assert statuses == ["503 Service Unavailable"]
+        assert webapp._cache.records == {}
+        assert os.listdir(pooldir + "/partial") == []
+
+class TestStreaming:
+    def setup_app(self, monkeypatch, pooldir, url):
+        from .. import proxy
+        from ..host_limiter import HostLimiter
+
+        monkeypatch.setattr(config, "http_passthrough", True)
+        monkeypatch.setattr(config, "streaming", True)
+        monkeypatch.setattr(proxy, "host_limiter", HostLimiter(max_per_host=1, queue_timeout=0.1))
+        monkeypatch.setattr(webapp, "pool", FilePool(pooldir))
+        monkeypatch.setattr(webapp, "_cache", MemCache())
+
+        self.statuses = []
+        return application({"REQUEST_METHOD": "GET", "REQUEST_URI": url},
+                           lambda status, headers: self.statuses.append(status))
+
+    def test_stream(self, monkeypatch, pooldir, keepalive_server):
+        from .. import proxy
+        url = keepalive_server.url + "/"
+        app = self.setup_app(monkeypatch, pooldir, url)
+        assert "".join(app) == "hello, world!\n"
+        app.close()
+        assert self.statuses == ["200 OK"]
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 0
+        assert url in webapp._cache.records
+
+    def test_close_before_iteration(self, monkeypatch, pooldir, keepalive_server):
+        from .. import proxy
+        url = keepalive_server.url + "/"
+        app = self.setup_app(monkeypatch, pooldir, url)
+
+        # the client goes away before the payload is sent
+        iter(app)
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 1
+        app.close()
+
+        # the capture is completed and the slot is released
+        assert proxy.host_limiter.in_flight("127.0.0.1") == 0
+        assert url in webapp._cache.records
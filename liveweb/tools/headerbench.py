@@ -0,0 +1,124 @@
+"""Benchmark of parsing response headers in the capture path.
+
+Compares httplib's line-by-line parsing, as used by the proxy before,
+with liveweb.httpparse on a corpus of response headers seen in the
+wild.
+
+USAGE: python -m liveweb.tools.headerbench [iterations]
+"""
+
+import httplib
+import sys
+import time
+from cStringIO import StringIO
+
+from .. import filetools
+from .. import httpparse
+
+CORPUS = [
+    """HTTP/1.1 200 OK
+Date: Tue, 12 Jun 2012 10:12:39 GMT
+Server: Apache/2.2.22 (Ubuntu)
+X-Powered-By: PHP/5.3.10-1ubuntu3.1
+Set-Cookie: PHPSESSID=8ko4kn3dg4sk0rrd5qtugtbv33; path=/
+Expires: Thu, 19 Nov 1981 08:52:00 GMT
+Cache-Control: no-store, no-cache, must-revalidate, post-check=0, pre-check=0
+Pragma: no-cache
+Vary: Accept-Encoding
+Content-Length: 5120
+Keep-Alive: timeout=5, max=100
+Connection: Keep-Alive
+Content-Type: text/html; charset=UTF-8
+""",
+    """HTTP/1.1 200 OK
+Server: nginx/1.2.1
+Date: Tue, 12 Jun 2012 10:12:40 GMT
+Content-Type: image/png
+Content-Length: 10240
+Last-Modified: Mon, 04 Jun 2012 19:25:11 GMT
+Connection: keep-alive
+Expires: Thu, 12 Jul 2012 10:12:40 GMT
+Cache-Control: max-age=2592000
+Accept-Ranges: bytes
+""",
+    """HTTP/1.1 200 OK
+Cache-Control: private, max-age=0
+Content-Type: text/html; charset=UTF-8
+Date: Tue, 12 Jun 2012 10:12:41 GMT
+Expires: -1
+P3P: CP="This is not a P3P policy! See http://www.google.com/support/accounts/bin/answer.py?hl=en&answer=151657 for more info."
+Set-Cookie: PREF=ID=1f0b1b5a7e8b7f7c:FF=0:TM=1339495961:LM=1339495961:S=4xVGmO2eW3KZ0t1O; expires=Thu, 12-Jun-2014 10:12:41 GMT; path=/; domain=.google.com
+Set-Cookie: NID=60=yLPbEpQvS2Xj6vKQp9bqD0HqFjzW4; expires=Wed, 12-Dec-2012 10:12:41 GMT; path=/; domain=.google.com; HttpOnly
+Server: gws
+X-XSS-Protection: 1; mode=block
+X-Frame-Options: SAMEORIGIN
+Transfer-Encoding: chunked
+""",
+    """HTTP/1.1 200 OK
+Cache-Control: private
+Content-Length: 2048
+Content-Type: text/html; charset=utf-8
+Server: Microsoft-IIS/7.5
+X-AspNet-Version: 4.0.30319
+X-Powered-By: ASP.NET
+Date: Tue, 12 Jun 2012 10:12:42 GMT
+""",
+    """HTTP/1.1 200 OK
+x-amz-id-2: Tqr2Ji8cPXbUJ5zq4OGqPGfZs3ZJbjq5vRkFqF+FRgmCYJ8nXzh7wvXq
+x-amz-request-id: 4B3F0A1C2D3E4F50
+Date: Tue, 12 Jun 2012 10:12:43 GMT
+Last-Modified: Fri, 01 Jun 2012 12:00:00 GMT
+ETag: "d41d8cd98f00b204e9800998ecf8427e"
+Accept-Ranges: bytes
+Content-Type: application/javascript
+Content-Length: 4096
+Server: AmazonS3
+""",
+    """HTTP/1.0 301 Moved Permanently
+Location: http://www.example.com/
+Content-Type: text/html
+Content-Length: 0
+""",
+]
+
+CORPUS = [h.replace("\n", "\r\n") + "\r\n" for h in CORPUS]
+
+def parse_httplib(data):
+    fp = filetools.SpyFile(StringIO(data), spy=filetools.MemFile())
+    response = httplib.HTTPResponse(_Socket(fp))
+    response.begin()
+    response.getheader("content-type")
+    return fp.buf.tell()
+
+def parse_httpparse(data):
+    parser = httpparse.ResponseHeadParser()
+    parser.feed(data)
+    parser.head.content_type
+    return len(parser.head_data)
+
+class _Socket:
+    def __init__(self, fp):
+        self.fp = fp
+
+    def makefile(self, mode, bufsize=0):
+        return self.fp
+
+def bench(f, iterations):
+    t0 = time.time()
+    for i in xrange(iterations):
+        for data in CORPUS:
+            f(data)
+    return (time.time() - t0) / (iterations * len(CORPUS))
+
+def main(iterations=2000):
+    for data in CORPUS:
+        assert parse_httplib(data) == parse_httpparse(data)
+
+    old = bench(parse_httplib, iterations)
+    new = bench(parse_httpparse, iterations)
+    print "httplib:   %6.1f usec per response" % (old * 1e6)
+    print "httpparse: %6.1f usec per response" % (new * 1e6)
+    print "speedup:   %6.1fx" % (old / new)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
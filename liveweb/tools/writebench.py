@@ -0,0 +1,62 @@
+"""Benchmark of writing records to the file pool in each durability mode.
+
+Appends records from many threads, like the request threads of a
+worker, and reports the records and megabytes written per second.
+Run it on the disk used for the output-directory, as the cost of
+fsync depends a lot on the disk.
+
+USAGE: python -m liveweb.tools.writebench [directory [threads [records [record_size [shards]]]]]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from .. import file_pool
+
+def bench(directory, durability, threads, records, record_size, shards=0):
+    """Returns the number of records written per second.
+    """
+    os.makedirs(os.path.join(directory, "partial"))
+    os.makedirs(os.path.join(directory, "complete"))
+    pool = file_pool.FilePool(directory, pattern="bench-%(serial)05d.warc.gz",
+                              max_file_size=100*1024*1024,
+                              durability=durability, sync_interval=0.1,
+                              shards=shards)
+    data = os.urandom(record_size)
+
+    def run():
+        for i in xrange(records):
+            pool.append(data)
+
+    t0 = time.time()
+    workers = [threading.Thread(target=run) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - t0
+
+    pool.close()
+    return threads * records / elapsed
+
+def main(directory=None, threads=10, records=200, record_size=10*1024, shards=0):
+    directory = directory or tempfile.gettempdir()
+    print "%d threads writing %d records of %d bytes each, in %s" % (threads, records, record_size, directory)
+    if shards:
+        print "sharded mode with %d files" % shards
+    print "%-10s %12s %10s" % ("durability", "records/sec", "MB/sec")
+    for durability in file_pool.DURABILITY_MODES:
+        path = tempfile.mkdtemp(prefix="writebench-", dir=directory)
+        try:
+            rate = bench(path, durability, threads, records, record_size, shards)
+        finally:
+            shutil.rmtree(path)
+        print "%-10s %12.0f %10.1f" % (durability, rate, rate * record_size / 1024.0 / 1024.0)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*(args[:1] + [int(a) for a in args[1:]]))
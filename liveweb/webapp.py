@@ -3,21 +3,53 @@
 
 from cStringIO import StringIO
 import gzip
+import itertools
 import logging
+import os
+import pipes
+import Queue
 import socket
+import ssl
+import subprocess
+import sys
 import datetime
+import time
+from multiprocessing.pool import ThreadPool
 
 from warc.arc import ARCRecord, ARCFile
+from warc.warc import WARCHeader
 
 from . import proxy
+from . import filetools
 from . import errors
 from . import config
 from . import file_pool
 from . import cache
+from . import dedup
+from . import connection_pool
+from . import fetch_engine
+from . import host_limiter
+from . import singleflight
+from . import resolver
+from . import prefetch
 
 pool = None
 _cache = None
 
+# Index of the payload digests of the captures, for writing revisit records.
+# Initialized by setup when dedup is enabled.
+digest_index = None
+
+# Prefetcher of the resources of the captured pages.
+# Initialized by setup when prefetch is enabled.
+prefetcher = None
+
+# POST requests to this path are handled as batch requests
+BATCH_PATH = "/_batch"
+
+# URLs being fetched by this process
+_inflight = singleflight.SingleFlight()
+
 def init_arc_file(fileobj):
     """Writes the ARC file headers when a new file is created.
     """
@@ -33,14 +65,68 @@ def init_arc_file(fileobj):
     afile.close()
     fileobj.flush()
 
+def record_content_type():
+    """Returns the content type of the records sent to the client.
+    """
+    if config.archive_format == "warc":
+        return "application/x-warc-record"
+    else:
+        return "application/x-arc-record"
+
+def init_warc_file(fileobj):
+    """Writes the warcinfo record when a new WARC file is created.
+    """
+    fields = [
+        ("software", "liveweb"),
+        ("format", "WARC File Format 1.0"),
+        ("hostname", socket.gethostname()),
+        ("ip", socket.gethostbyname(socket.gethostname())),
+        ("operator", "InternetArchive"),
+        ("http-header-user-agent", config.user_agent)
+    ]
+    data = "".join("%s: %s\r\n" % field for field in fields)
+
+    header = WARCHeader({
+        "WARC-Type": "warcinfo",
+        "WARC-Filename": os.path.basename(fileobj.name),
+        "Content-Type": "application/warc-fields",
+        "Content-Length": str(len(data))
+    }, defaults=True)
+
+    member = filetools.GzipMember(fileobj, level=config.compression_level)
+    proxy.write_warc_record(member, header, StringIO(data))
+    member.close()
+    fileobj.flush()
+
+def run_completion_command(path):
+    """Runs the completion_command with the path of the complete file as argument.
+    """
+    status = subprocess.call(config.completion_command + " " + pipes.quote(path), shell=True)
+    if status != 0:
+        logging.error("completion command exited with status %d for %s", status, path)
+
+def conditional_headers(validators):
+    """Returns the headers to make a conditional request using the
+    validators of the previous capture.
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
 def setup():
     """This is called from main to initialize the requires globals.
     """
-    global pool, _cache
+    global pool, _cache, prefetcher, digest_index
 
-    # Write ARC file header if the archive format is "arc"
+    # Write ARC file header or warcinfo record depending on the archive format
     if config.archive_format == "arc":
         init_file = init_arc_file
+    elif config.archive_format == "warc":
+        init_file = init_warc_file
     else:
         init_file = None
 
@@ -48,16 +134,162 @@ def setup():
                               pattern=config.filename_pattern,
                               max_files=config.num_writers,
                               max_file_size=config.filesize_limit,
-                              init_file_func=init_file)
+                              init_file_func=init_file,
+                              durability=config.durability,
+                              sync_interval=config.sync_interval,
+                              shards=config.file_shards,
+                              preallocate=config.preallocate,
+                              max_file_age=config.max_file_age,
+                              index=config.cdx)
+    if config.completion_command:
+        pool.add_completion_hook(run_completion_command)
+    if config.recovery_threads:
+        pool.recover(config.recovery_threads)
     _cache = cache.create(type=config.cache, config=config)
 
+    if config.dedup != "none":
+        if config.archive_format == "warc":
+            digest_index = dedup.create(type=config.dedup, config=config)
+        else:
+            logging.warn("dedup is supported only for warc archive format, ignoring it")
+
     # For redis cache, use redis for keeping track of file number sequence
     if config.cache == 'redis':
         pool.set_sequence(_cache)
 
+    if config.max_idle_connections:
+        proxy.connection_pool = connection_pool.ConnectionPool(max_per_host=config.max_idle_connections,
+                                                               idle_timeout=config.idle_connection_timeout,
+                                                               max_idle=config.max_total_idle_connections)
+
+    # same as what httplib creates for each connection by default
+    proxy.ssl_context = ssl._create_default_https_context()
+
+    if config.max_host_connections:
+        proxy.host_limiter = host_limiter.HostLimiter(max_per_host=config.max_host_connections,
+                                                      queue_timeout=config.host_queue_timeout)
+
+    if config.resolver == "stub":
+        nameservers = config.nameservers and config.nameservers.split(",")
+        proxy.dns_resolver = resolver.StubResolver(nameservers=nameservers)
+
+    if config.dns_cache_ttl:
+        proxy.dns_cache = resolver.DNSCache(ttl=config.dns_cache_ttl,
+                                            negative_ttl=config.dns_negative_ttl,
+                                            getaddrinfo=proxy.dns_resolver and proxy.dns_resolver.getaddrinfo)
+
+    if config.prefetch and config.cache != "none":
+        prefetcher = prefetch.Prefetcher(prefetch_record,
+                                         submit=prefetch_submit,
+                                         num_threads=config.prefetch_threads,
+                                         queue_size=config.prefetch_queue_size,
+                                         budget=config.prefetch_budget)
+        prefetcher.start()
+
+    if config.fetch_engine == "async":
+        proxy.fetch_engine = fetch_engine.FetchEngine()
+        proxy.fetch_engine.start()
+
+def write_record(http_response):
+    """Writes the response to the pool and returns the Record.
+
+    If the same payload has been captured recently, a revisit record is
+    written instead. The Record returned is then that of the full
+    response, compressed in memory, as the client must get the status,
+    headers and URL of this response, not those of the previous
+    capture, which may even be of another URL.
+    """
+    digest = None
+    if digest_index and http_response.status == 200 and http_response.payload_length >= config.dedup_min_size:
+        digest = http_response.get_payload_digest()
+
+    if digest:
+        original = digest_index.get(digest)
+        filename = original and pool.locate(original["filename"])
+        if filename:
+            logging.info("duplicate of %s %s - %s", original["url"], original["date"], http_response.url)
+            revisit = http_response.write_revisit(pool, original)
+            digest_index.revisited(original["content_length"] - revisit.content_length)
+            return http_response.make_warc_record()
+
+    record = http_response.write_record(pool)
+    if digest:
+        capture = dict(url=http_response.url,
+                       date=http_response.warc_date,
+                       record_id=http_response.warc_record_id,
+                       filename=record.filename,
+                       offset=record.offset,
+                       content_length=record.content_length)
+        # revisits can refer to the record only once it is durable
+        pool.when_durable(lambda: digest_index.set(digest, capture))
+    return record
+
+def prefetch_record(url):
+    """Fetches the url into the cache, unless it is already there.
+    """
+    app = application({}, None)
+    app.url = url
+    app.prefetching = True
+    app.get_record()
+
+def prefetch_submit(url, on_done):
+    """Starts fetching the url into the cache using the fetch engine,
+    unless it is already there.
+
+    on_done is called with a function completing the capture once the
+    fetch is complete. Returns False if the url must be fetched using
+    `prefetch_record` instead.
+    """
+    app = application({}, None)
+    app.url = url
+    app.prefetching = True
+    if _cache.get(url) is not None:
+        on_done(lambda: None)
+        return True
+    return app.submit(lambda app: on_done(app.complete))
+
+class StreamingBody:
+    """The payload of a response sent to the client while it is being fetched.
+
+    The capture is completed when the iteration is over or when close
+    is called, whichever happens first. The WSGI server calls close
+    even if the client goes away before the payload is sent, and that
+    releases the connection and the host-limiter slot of the fetch.
+    """
+    def __init__(self, response, save):
+        self.response = response
+        self.chunks = response.iter_payload()
+        self.save = save
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # complete the capture even if the client has gone away
+        for chunk in self.chunks:
+            pass
+        self.save(self.response)
+
 class application:
     """WSGI application for liveweb proxy.
     """
+    # True when fetching a resource for the prefetcher
+    prefetching = False
+
+    # The iterable sent to the client, when it must be closed
+    body = None
+
+    # The fetch started by submit, or the response when it failed to start
+    _fetch = None
+    _response = None
+    _validators = None
+
     def __init__(self, environ, start_response):
         self.environ = environ
         self.start_response = start_response
@@ -84,11 +316,25 @@ class application:
         try:
             self.parse_request()
 
+            if self.method == "POST" and self.environ.get("PATH_INFO") == BATCH_PATH:
+                return self.batch()
+
+            if config.http_passthrough and config.streaming:
+                self.body = self.stream_response()
+                return iter(self.body)
+
             record = self.get_record()
             if config.http_passthrough:
                 return self.proxy_response(record)
             else:
                 return self.success(record.content_length, record.content_iter)
+        except proxy.ProxyError, e:
+            if e.errcode != proxy.ERR_HOST_BUSY[0]:
+                logging.error("Internal Error - %s", self.url, exc_info=True)
+                return self.error("500 Internal Server Error")
+            # nothing is archived or cached, the client can try again later
+            logging.warn("%s - %s", e, self.url)
+            return self.error("503 Service Unavailable")
         except:
             logging.error("Internal Error - %s", self.url, exc_info=True)
             return self.error("500 Internal Server Error")
@@ -98,22 +344,335 @@ class application:
         """
         record = _cache.get(self.url)
         if record is None:
+            # Concurrent requests for the same URL share a single fetch.
+            # Each of them gets a copy as the content_iter can be consumed only once.
+            record = _inflight.do(self.url, self.fetch_record).copy()
+        return record
+
+    def submit(self, on_done):
+        """Starts capturing the URL using the fetch engine, without a
+        thread waiting for the fetch.
+
+        on_done is called with this application by the event-loop
+        thread once the fetch is complete, and `complete` then writes
+        the record and returns it. Returns False if the URL must be
+        captured using `get_record` instead: when the fetch engine
+        can't fetch it, when redis-coalesce is enabled or when the URL
+        is already being fetched by this worker.
+        """
+        if not proxy.can_submit(self.url) or (config.cache == "redis" and config.redis_coalesce):
+            return False
+        if not _inflight.begin(self.url):
+            return False
+
+        try:
+            self._validators = self.get_validators()
+            headers = conditional_headers(self._validators)
+            try:
+                self._fetch = proxy.submit(self.url, lambda fetch: on_done(self), headers=headers)
+            except proxy.ProxyError, e:
+                if e.errcode == proxy.ERR_HOST_BUSY[0]:
+                    raise
+                self._response = proxy.error_response(self.url, e)
+                on_done(self)
+        except:
+            _inflight.end(self.url, exc_info=sys.exc_info())
+            raise
+        return True
+
+    def complete(self, timeout=None):
+        """Completes the capture started by `submit` and returns the record.
+
+        The fetch is waited for at most timeout seconds when given,
+        and archived as failed after that.
+        """
+        try:
+            response = self._response
+            if response is None:
+                response = proxy.get_response(self._fetch, timeout)
+            record = self.save_response(response, self._validators)
+        except:
+            _inflight.end(self.url, exc_info=sys.exc_info())
+            raise
+        _inflight.end(self.url, record)
+        return record.copy()
+
+    def fetch_record(self):
+        """Fetches the URL, writes the record and puts it in the cache.
+        """
+        if config.cache == "redis" and config.redis_coalesce:
+            return self._fetch_record_once()
+        return self._fetch_record()
+
+    def _fetch_record(self):
+        validators = self.get_validators()
+        http_response = proxy.urlopen(self.url, headers=conditional_headers(validators))
+        return self.save_response(http_response, validators)
+
+    def get_validators(self):
+        """Returns the validators of the previous capture of the URL, if revalidation is enabled.
+        """
+        if config.cache == "redis" and config.redis_revalidate:
+            return _cache.get_validators(self.url)
+
+    def save_response(self, http_response, validators=None):
+        """Writes the response to the pool, puts the record in the cache and returns it.
+
+        If the response is "304 Not Modified" for a request made using
+        the validators, the record of the previous capture is returned.
+        """
+        if validators and http_response.status == 304:
+            record = self.revalidated(http_response, validators)
+            if record is not None:
+                return record
+            # The previous capture is gone, fetch it again
             http_response = proxy.urlopen(self.url)
-            record = http_response.write_arc(pool)
-            _cache.set(self.url, record)
+
+        record = write_record(http_response)
+        # the record is sent to the client right away, but put in the
+        # cache only once it is durable
+        pool.when_durable(lambda: self.publish(http_response, record.copy()))
+
+        if prefetcher and not self.prefetching:
+            prefetcher.page_captured(http_response)
         return record
 
+    def publish(self, http_response, record):
+        """Puts the record in the cache, along with the validators of the response.
+        """
+        _cache.set(self.url, record)
+
+        # records of revisits are not in any file, so they can't be served again
+        if config.cache == "redis" and config.redis_revalidate and record.filename:
+            validators = http_response.get_validators()
+            if validators:
+                validators.update(filename=record.filename, offset=record.offset, content_length=record.content_length)
+                _cache.set_validators(self.url, validators)
+
+    def revalidated(self, http_response, validators):
+        """Called when the server says that the previous capture is
+        still valid. Writes the 304 response to the pool and returns
+        the record of the previous capture, renewing its cache entry.
+
+        Returns None if the previous capture is not available anymore.
+        """
+        filename = pool.locate(validators["filename"])
+        if filename is None:
+            logging.warn("previous capture %s not found - %s", validators["filename"], self.url)
+            return None
+
+        logging.info("not modified - %s", self.url)
+        http_response.write_record(pool)
+
+        record = proxy.Record(filename, offset=validators["offset"], content_length=validators["content_length"])
+        _cache.set(self.url, record)
+        _cache.set_validators(self.url, dict(validators, filename=filename))
+        return record
+
+    def _fetch_record_once(self):
+        """Makes sure the URL is fetched only by one worker at a time.
+
+        If some other worker is fetching the URL, waits for it to finish
+        and uses the record from the cache. Records too big to be cached
+        are read from the file the other worker wrote them to. If that
+        file is not available to this worker, the URL is fetched again,
+        without waiting for the other waiting workers.
+        """
+        timeout = config.max_request_time
+        deadline = time.time() + timeout
+
+        while not _cache.acquire_fetch_lock(self.url, timeout):
+            time.sleep(0.1)
+            record = _cache.get(self.url)
+            if record is not None:
+                return record
+
+            fetched = _cache.get_fetched(self.url)
+            if fetched is not None:
+                filename = pool.locate(fetched["filename"])
+                if filename is None:
+                    return self._fetch_record()
+                return proxy.Record(filename, offset=fetched["offset"], content_length=fetched["content_length"])
+
+            if time.time() > deadline:
+                logging.warn("timed out waiting for another worker to fetch %s", self.url)
+                return self._fetch_record()
+
+        try:
+            record = self._fetch_record()
+            if record.filename:
+                _cache.set_fetched(self.url, record, timeout)
+            return record
+        finally:
+            _cache.release_fetch_lock(self.url)
+
+    def stream_response(self):
+        """Sends the response to the client while it is being fetched
+        from the server and archives it once the payload is complete.
+        """
+        record = _cache.get(self.url)
+        if record is not None:
+            return self.proxy_response(record)
+
+        validators = self.get_validators()
+        response = proxy.urlopen(self.url, stream=True, headers=conditional_headers(validators))
+        if not response.stream or (validators and response.status == 304):
+            # failed before getting the headers, fetched by the async
+            # engine or the previous capture is still valid
+            for chunk in response.iter_payload():
+                pass
+            record = self.save_response(response, validators)
+            return self.proxy_response(record)
+
+        body = StreamingBody(response, self.save_response)
+        try:
+            status = "%d %s" % (response.status, response.reason)
+            self.start_response(status, response.getheaders())
+        except:
+            body.close()
+            raise
+        return body
+
+    def close(self):
+        """Called by the WSGI server when the response is over, even if it
+        has not been sent completely.
+        """
+        if self.body is not None and hasattr(self.body, "close"):
+            self.body.close()
+
+    def batch(self):
+        """Fetches the URLs in the request body concurrently and sends
+        back the records of all of them.
+
+        The request body has one URL per line. The response starts with
+        an index having a line "offset length url" for each URL, in the
+        same order, followed by an empty line and the records. The
+        offsets are relative to the end of the index. The URLs that
+        couldn't be captured have "- - url" in the index and no record.
+        """
+        try:
+            length = int(self.environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = self.environ["wsgi.input"].read(length)
+        urls = [line.strip() for line in body.splitlines() if line.strip()]
+
+        if not urls or [url for url in urls if not url.startswith(("http://", "https://"))]:
+            return self.error("400 Bad Request")
+        if len(urls) > config.max_batch_size:
+            return self.error("413 Request Entity Too Large")
+
+        records = self._get_batch_records(urls)
+
+        index = []
+        offset = 0
+        for url, record in zip(urls, records):
+            if record is None:
+                index.append("- - %s\n" % url)
+                continue
+            index.append("%d %d %s\n" % (offset, record.content_length, url))
+            offset += record.content_length
+        index = "".join(index) + "\n"
+        records = [record for record in records if record is not None]
+
+        if config.archive_format == "warc":
+            content_type = "application/x-warc-records"
+        else:
+            content_type = "application/x-arc-records"
+        headers = [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(index) + offset))
+        ]
+        self.start_response("200 OK", headers)
+        return itertools.chain([index], *records)
+
+    def _get_batch_records(self, urls):
+        """Returns the records of the URLs of the batch, None for those
+        that couldn't be captured.
+
+        The URLs that the fetch engine can fetch are all submitted to it
+        at once, and their records are written by this thread as their
+        fetches complete. The other URLs are fetched by
+        batch_concurrency threads in the meanwhile.
+        """
+        apps = []
+        for url in urls:
+            app = application(self.environ, None)
+            app.url = url
+            apps.append(app)
+
+        records = [None] * len(urls)
+        done = Queue.Queue()
+        submitted = set()
+        others = []
+        def start(i, app):
+            record = _cache.get(app.url)
+            if record is None:
+                if app.submit(lambda app: done.put(i)):
+                    submitted.add(i)
+                else:
+                    others.append(i)
+            return record
+
+        for i, app in enumerate(apps):
+            records[i] = self._batch_call(app.url, start, i, app)
+
+        if others:
+            workers = ThreadPool(min(len(others), config.batch_concurrency))
+            result = workers.map_async(lambda i: self._batch_call(apps[i].url, apps[i].get_record), others)
+
+        # the fetches end by themselves within max_request_time, unless
+        # the event-loop is stuck
+        deadline = None
+        if config.max_request_time is not None:
+            deadline = time.time() + config.max_request_time + fetch_engine.WAIT_MARGIN
+        while submitted:
+            try:
+                i = done.get(timeout=deadline and max(deadline - time.time(), 0))
+            except Queue.Empty:
+                i = submitted.pop()
+                records[i] = self._batch_call(apps[i].url, apps[i].complete, 0)
+                continue
+            submitted.discard(i)
+            records[i] = self._batch_call(apps[i].url, apps[i].complete)
+
+        if others:
+            try:
+                for i, record in zip(others, result.get()):
+                    records[i] = record
+            finally:
+                workers.close()
+        return records
+
+    def _batch_call(self, url, func, *args):
+        """Returns func(*args), or None if it fails, for a URL of the batch.
+        """
+        try:
+            return func(*args)
+        except proxy.ProxyError, e:
+            if e.errcode != proxy.ERR_HOST_BUSY[0]:
+                logging.error("Internal Error - %s", url, exc_info=True)
+            else:
+                logging.warn("%s - %s", e, url)
+        except:
+            logging.error("Internal Error - %s", url, exc_info=True)
+
     def proxy_response(self, record):
         """Send the response data as it is """
         # TODO: This is very inefficient. Improve.
 
-        # Now we only have the ARC record data. 
+        # Now we only have the ARC/WARC record data. 
         record_payload = record.read_all()
         record_payload = gzip.GzipFile(fileobj=StringIO(record_payload)).read()        
-        arc = ARCRecord.from_string(record_payload, version=1)
+        if config.archive_format == "warc":
+            # The HTTP response is the block of the record, between
+            # the WARC headers and the closing CRLFs.
+            http_payload = record_payload.split("\r\n\r\n", 1)[1][:-4]
+        else:
+            http_payload = ARCRecord.from_string(record_payload, version=1).payload
 
         # Create a FakeSocket and read HTTP headers and payload.
-        sock = proxy._FakeSocket(StringIO(arc.payload))
+        sock = proxy._FakeSocket(StringIO(http_payload))
         response = proxy.ProxyHTTPResponse(self.url, sock)
         response.begin()
 
@@ -125,7 +684,7 @@ class application:
     def success(self, clen, data):
         status = '200 OK'
         response_headers = [
-            ('Content-type', 'application/x-arc-record'),
+            ('Content-type', record_content_type()),
             ('Content-Length', str(clen))
         ]
         self.start_response(status, response_headers)